@@ -22,6 +22,7 @@
  *
  * ----------------------------------------------------------------------- */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <librsync.h>
 #define RS_JOB_BLOCKSIZE 65536
@@ -37,6 +38,98 @@ _librsync_seterror(rs_result result, char *location)
   PyErr_SetString(librsyncError, error_string);
 }
 
+/* Run job over the input in inbuf, writing up to outbuf_length bytes
+   to outbuf.  The GIL is released while librsync works, so other
+   threads can run their own jobs meanwhile; busy keeps two threads
+   from running the same job.  Returns 1 if the job is done, 0 if it
+   needs more input or output space, and -1 with the error set.
+*/
+static int
+_librsync_job_iter(rs_job_t *job, int *busy, Py_buffer *inbuf,
+                   char *outbuf, Py_ssize_t outbuf_length, int eof,
+                   char *location, Py_ssize_t *used, Py_ssize_t *written)
+{
+  rs_buffers_t buf;
+  rs_result result;
+
+  if (*busy) {
+    PyErr_SetString(librsyncError, "job already running in another thread");
+    return -1;
+  }
+  *busy = 1;
+
+  buf.next_in = inbuf->buf;
+  buf.avail_in = (size_t)inbuf->len;
+  buf.next_out = outbuf;
+  buf.avail_out = (size_t)outbuf_length;
+  buf.eof_in = eof;
+
+  Py_BEGIN_ALLOW_THREADS
+  result = rs_job_iter(job, &buf);
+  Py_END_ALLOW_THREADS
+  *busy = 0;
+
+  if (result != RS_DONE && result != RS_BLOCKED) {
+    _librsync_seterror(result, location);
+    return -1;
+  }
+  *used = inbuf->len - (Py_ssize_t)buf.avail_in;
+  *written = outbuf_length - (Py_ssize_t)buf.avail_out;
+  return (result == RS_DONE);
+}
+
+/* Take an input buffer, and return a triple (done, bytes_used,
+   output_string), where done is true iff no more output is coming and
+   bytes_used is the number of bytes of the input processed.  An empty
+   input means no more input is coming.
+*/
+static PyObject *
+_librsync_cycle(rs_job_t *job, int *busy, PyObject *args, char *location)
+{
+  char outbuf[RS_JOB_BLOCKSIZE];
+  Py_buffer inbuf;
+  Py_ssize_t used, written;
+  int done;
+
+  if (!PyArg_ParseTuple(args, "s*:cycle", &inbuf))
+    return NULL;
+
+  done = _librsync_job_iter(job, busy, &inbuf, outbuf, RS_JOB_BLOCKSIZE,
+                            (inbuf.len == 0), location, &used, &written);
+  PyBuffer_Release(&inbuf);
+  if (done < 0)
+    return NULL;
+
+  return Py_BuildValue("(ins#)", done, used, outbuf, written);
+}
+
+/* Like cycle, but write the output into the writable buffer given as
+   the second argument, and return (done, bytes_used, bytes_written).
+   The optional third argument tells whether more input is coming,
+   by default only an empty input is the last.
+*/
+static PyObject *
+_librsync_cycle_into(rs_job_t *job, int *busy, PyObject *args, char *location)
+{
+  Py_buffer inbuf, outbuf;
+  Py_ssize_t used, written;
+  int eof = -1, done;
+
+  if (!PyArg_ParseTuple(args, "s*w*|i:cycle_into", &inbuf, &outbuf, &eof))
+    return NULL;
+  if (eof < 0)
+    eof = (inbuf.len == 0);
+
+  done = _librsync_job_iter(job, busy, &inbuf, outbuf.buf, outbuf.len,
+                            eof, location, &used, &written);
+  PyBuffer_Release(&inbuf);
+  PyBuffer_Release(&outbuf);
+  if (done < 0)
+    return NULL;
+
+  return Py_BuildValue("(inn)", done, used, written);
+}
+
 
 /* --------------- SigMaker Object for incremental signatures */
 static PyTypeObject _librsync_SigMakerType;
@@ -44,6 +137,7 @@ static PyTypeObject _librsync_SigMakerType;
 typedef struct {
   PyObject_HEAD
   rs_job_t *sig_job;
+  int busy;
 } _librsync_SigMakerObject;
 
 static PyObject*
@@ -65,6 +159,7 @@ _librsync_new_sigmaker(PyObject* self, PyObject* args)
   sm->sig_job = rs_sig_begin((size_t)blocklen,
                              (size_t)8, RS_MD4_SIG_MAGIC);
 #endif
+  sm->busy = 0;
   return (PyObject*)sm;
 }
 
@@ -75,42 +170,25 @@ _librsync_sigmaker_dealloc(PyObject* self)
   PyObject_Del(self);
 }
 
-/* Take an input string, and generate a signature from it.  The output
-   will be a triple (done, bytes_used, signature_string), where done
-   is true iff there is no more data coming and bytes_used is the
-   number of bytes of the input string processed.
+/* Take input data, and generate a signature from it (see
+   _librsync_cycle and _librsync_cycle_into above).
 */
 static PyObject *
 _librsync_sigmaker_cycle(_librsync_SigMakerObject *self, PyObject *args)
 {
-  char *inbuf, outbuf[RS_JOB_BLOCKSIZE];
-  int inbuf_length;
-  rs_buffers_t buf;
-  rs_result result;
-
-  if (!PyArg_ParseTuple(args, "s#:cycle", &inbuf, &inbuf_length))
-    return NULL;
-
-  buf.next_in = inbuf;
-  buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
-  buf.eof_in = (inbuf_length == 0);
-
-  result = rs_job_iter(self->sig_job, &buf);
-
-  if (result != RS_DONE && result != RS_BLOCKED) {
-    _librsync_seterror(result, "signature cycle");
-    return NULL;
-  }
+  return _librsync_cycle(self->sig_job, &self->busy, args, "signature cycle");
+}
 
-  return Py_BuildValue("(ils#)", (result == RS_DONE),
-                       (long)inbuf_length - (long)buf.avail_in,
-                       outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
+static PyObject *
+_librsync_sigmaker_cycle_into(_librsync_SigMakerObject *self, PyObject *args)
+{
+  return _librsync_cycle_into(self->sig_job, &self->busy, args,
+                              "signature cycle");
 }
 
 static PyMethodDef _librsync_sigmaker_methods[] = {
   {"cycle", (PyCFunction)_librsync_sigmaker_cycle, METH_VARARGS},
+  {"cycle_into", (PyCFunction)_librsync_sigmaker_cycle_into, METH_VARARGS},
   {NULL, NULL, 0, NULL}  /* sentinel */
 };
 
@@ -154,6 +232,7 @@ typedef struct {
   PyObject_HEAD
   rs_job_t *delta_job;
   rs_signature_t *sig_ptr;
+  int busy;
 } _librsync_DeltaMakerObject;
 
 /* Call with the entire signature loaded into one big string */
@@ -162,38 +241,46 @@ _librsync_new_deltamaker(PyObject* self, PyObject* args)
 {
   _librsync_DeltaMakerObject* dm;
   char *sig_string, outbuf[RS_JOB_BLOCKSIZE];
-  int sig_length;
+  Py_ssize_t sig_length;
   rs_job_t *sig_loader;
   rs_signature_t *sig_ptr;
   rs_buffers_t buf;
-  rs_result result;
+  rs_result result, hash_result = RS_DONE;
 
   if (!PyArg_ParseTuple(args,"s#:new_deltamaker", &sig_string, &sig_length))
     return NULL;
 
-  dm = PyObject_New(_librsync_DeltaMakerObject, &_librsync_DeltaMakerType);
-  if (dm == NULL) return NULL;
-
-  /* Put signature at sig_ptr and build hash */
+  /* Put signature at sig_ptr and build hash, which takes a while for
+     large signatures, so let other threads run */
   sig_loader = rs_loadsig_begin(&sig_ptr);
   buf.next_in = sig_string;
   buf.avail_in = (size_t)sig_length;
   buf.next_out = outbuf;
   buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
   buf.eof_in = 1;
+  Py_BEGIN_ALLOW_THREADS
   result = rs_job_iter(sig_loader, &buf);
   rs_job_free(sig_loader);
+  if (result == RS_DONE)
+    hash_result = rs_build_hash_table(sig_ptr);
+  Py_END_ALLOW_THREADS
   if (result != RS_DONE) {
     _librsync_seterror(result, "delta rs_signature_t builder");
     return NULL;
   }
-  if ((result = rs_build_hash_table(sig_ptr)) != RS_DONE) {
-    _librsync_seterror(result, "delta rs_build_hash_table");
+  if (hash_result != RS_DONE) {
+    _librsync_seterror(hash_result, "delta rs_build_hash_table");
     return NULL;
   }
 
+  dm = PyObject_New(_librsync_DeltaMakerObject, &_librsync_DeltaMakerType);
+  if (dm == NULL) {
+    rs_free_sumset(sig_ptr);
+    return NULL;
+  }
   dm->sig_ptr = sig_ptr;
   dm->delta_job = rs_delta_begin(sig_ptr);
+  dm->busy = 0;
   return (PyObject*)dm;
 }
 
@@ -208,41 +295,26 @@ _librsync_deltamaker_dealloc(PyObject* self)
   PyObject_Del(self);
 }
 
-/* Take a chunk of the new file in an input string, and return a
-   triple (done bytes_used, delta_string), where done is true iff no
-   more data is coming and bytes_used is the number of bytes of the
-   input string processed.
+/* Take a chunk of the new file, and generate delta data from it (see
+   _librsync_cycle and _librsync_cycle_into above).
 */
 static PyObject *
 _librsync_deltamaker_cycle(_librsync_DeltaMakerObject *self, PyObject *args)
 {
-  char *inbuf, outbuf[RS_JOB_BLOCKSIZE];
-  int inbuf_length;
-  rs_buffers_t buf;
-  rs_result result;
-
-  if (!PyArg_ParseTuple(args, "s#:cycle", &inbuf, &inbuf_length))
-    return NULL;
-
-  buf.next_in = inbuf;
-  buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
-  buf.eof_in = (inbuf_length == 0);
-
-  result = rs_job_iter(self->delta_job, &buf);
-  if (result != RS_DONE && result != RS_BLOCKED) {
-    _librsync_seterror(result, "delta cycle");
-    return NULL;
-  }
+  return _librsync_cycle(self->delta_job, &self->busy, args, "delta cycle");
+}
 
-  return Py_BuildValue("(ils#)", (result == RS_DONE),
-                       (long)inbuf_length - (long)buf.avail_in,
-                       outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
+static PyObject *
+_librsync_deltamaker_cycle_into(_librsync_DeltaMakerObject *self,
+                                PyObject *args)
+{
+  return _librsync_cycle_into(self->delta_job, &self->busy, args,
+                              "delta cycle");
 }
 
 static PyMethodDef _librsync_deltamaker_methods[] = {
   {"cycle", (PyCFunction)_librsync_deltamaker_cycle, METH_VARARGS},
+  {"cycle_into", (PyCFunction)_librsync_deltamaker_cycle_into, METH_VARARGS},
   {NULL, NULL, 0, NULL}  /* sentinel */
 };
 
@@ -287,32 +359,49 @@ typedef struct {
   PyObject_HEAD
   rs_job_t *patch_job;
   PyObject *basis_file;
+  FILE *cfile;
+  rs_long_t basis_offset;
+  int busy;
 } _librsync_PatchMakerObject;
 
-/* Call with the basis file */
+/* Read the basis file for librsync, with positions counted from the
+   basis offset, so a delta can be applied to a part of the file */
+static rs_result
+_librsync_patchmaker_copy_cb(void *opaque, rs_long_t pos,
+                             size_t *len, void **buf)
+{
+  _librsync_PatchMakerObject *pm = (_librsync_PatchMakerObject *)opaque;
+  return rs_file_copy_cb(pm->cfile, pm->basis_offset + pos, len, buf);
+}
+
+/* Call with the basis file, and optionally the offset in it that the
+   delta's copy commands count from */
 static PyObject*
 _librsync_new_patchmaker(PyObject* self, PyObject* args)
 {
   _librsync_PatchMakerObject* pm;
   PyObject *python_file;
+  PY_LONG_LONG basis_offset = 0;
   int fd;
-  FILE *cfile;
 
-  if (!PyArg_ParseTuple(args, "O:new_patchmaker", &python_file))
+  if (!PyArg_ParseTuple(args, "O|L:new_patchmaker", &python_file,
+                        &basis_offset))
     return NULL;
   fd = PyObject_AsFileDescriptor(python_file);
   if (fd == -1) {
     PyErr_SetString(PyExc_TypeError, "Need true file object");
     return NULL;
   }
-  Py_INCREF(python_file);
 
   pm = PyObject_New(_librsync_PatchMakerObject, &_librsync_PatchMakerType);
   if (pm == NULL) return NULL;
 
+  Py_INCREF(python_file);
   pm->basis_file = python_file;
-  cfile = fdopen(fd, "rb");
-  pm->patch_job = rs_patch_begin(rs_file_copy_cb, cfile);
+  pm->cfile = fdopen(fd, "rb");
+  pm->basis_offset = basis_offset;
+  pm->patch_job = rs_patch_begin(_librsync_patchmaker_copy_cb, pm);
+  pm->busy = 0;
 
   return (PyObject*)pm;
 }
@@ -326,41 +415,27 @@ _librsync_patchmaker_dealloc(PyObject* self)
   PyObject_Del(self);
 }
 
-/* Take a chunk of the delta file in an input string, and return a
-   triple (done, bytes_used, patched_string), where done is true iff
-   there is no more data coming out and bytes_used is the number of
-   bytes of the input string processed.
+/* Take a chunk of the delta file, and generate patched data from it
+   (see _librsync_cycle and _librsync_cycle_into above).  The basis
+   file is read in C, with the GIL released.
 */
 static PyObject *
 _librsync_patchmaker_cycle(_librsync_PatchMakerObject *self, PyObject *args)
 {
-  char *inbuf, outbuf[RS_JOB_BLOCKSIZE];
-  int inbuf_length;
-  rs_buffers_t buf;
-  rs_result result;
-
-  if (!PyArg_ParseTuple(args, "s#:cycle", &inbuf, &inbuf_length))
-    return NULL;
-
-  buf.next_in = inbuf;
-  buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
-  buf.eof_in = (inbuf_length == 0);
-
-  result = rs_job_iter(self->patch_job, &buf);
-  if (result != RS_DONE && result != RS_BLOCKED) {
-    _librsync_seterror(result, "patch cycle");
-    return NULL;
-  }
+  return _librsync_cycle(self->patch_job, &self->busy, args, "patch cycle");
+}
 
-  return Py_BuildValue("(ils#)", (result == RS_DONE),
-                       (long)inbuf_length - (long)buf.avail_in,
-                       outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
+static PyObject *
+_librsync_patchmaker_cycle_into(_librsync_PatchMakerObject *self,
+                                PyObject *args)
+{
+  return _librsync_cycle_into(self->patch_job, &self->busy, args,
+                              "patch cycle");
 }
 
 static PyMethodDef _librsync_patchmaker_methods[] = {
   {"cycle", (PyCFunction)_librsync_patchmaker_cycle, METH_VARARGS},
+  {"cycle_into", (PyCFunction)_librsync_patchmaker_cycle_into, METH_VARARGS},
   {NULL, NULL, 0, NULL}  /* sentinel */
 };
 
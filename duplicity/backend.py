@@ -25,9 +25,12 @@ intended to be used by the backends themselves.
 """
 
 import errno
+import httplib
 import os
+import random
 import sys
 import socket
+import threading
 import time
 import re
 import getpass
@@ -43,6 +46,7 @@ from duplicity import globals
 from duplicity import log
 from duplicity import path
 from duplicity import progress
+from duplicity import timing
 from duplicity import util
 
 from duplicity.util import exception_traceback
@@ -63,6 +67,64 @@ socket.setdefaulttimeout(globals.timeout)
 _backends = {}
 _backend_prefixes = {}
 
+# Module in duplicity/backends that registers each URL scheme, so that
+# only the backend a URL asks for is imported rather than all of them
+# (and the libraries they pull in).  Keep in sync with the backends.
+_backend_modules = {
+    'azure': 'azurebackend',
+    'cf+http': 'cfbackend',
+    'cf+hubic': 'hubicbackend',
+    'copy': 'copycombackend',
+    'dpbx': 'dpbxbackend',
+    'file': 'localbackend',
+    'fish': 'lftpbackend',
+    'ftp': 'lftpbackend',
+    'ftps': 'lftpbackend',
+    'gdata+gdocs': 'gdocsbackend',
+    'gdocs': 'pydrivebackend',
+    'gs': 'botobackend',
+    'hsi': 'hsibackend',
+    'http': 'webdavbackend',
+    'https': 'webdavbackend',
+    'imap': 'imapbackend',
+    'imaps': 'imapbackend',
+    'lftp+fish': 'lftpbackend',
+    'lftp+ftp': 'lftpbackend',
+    'lftp+ftps': 'lftpbackend',
+    'lftp+http': 'lftpbackend',
+    'lftp+https': 'lftpbackend',
+    'lftp+sftp': 'lftpbackend',
+    'lftp+webdav': 'lftpbackend',
+    'lftp+webdavs': 'lftpbackend',
+    'mega': 'megabackend',
+    'multi': 'multibackend',
+    'ncftp+ftp': 'ncftpbackend',
+    'onedrive': 'onedrivebackend',
+    'paramiko+scp': 'ssh_paramiko_backend',
+    'paramiko+sftp': 'ssh_paramiko_backend',
+    'pexpect+scp': 'ssh_pexpect_backend',
+    'pexpect+sftp': 'ssh_pexpect_backend',
+    'pydrive': 'pydrivebackend',
+    'pydrive+gdocs': 'pydrivebackend',
+    'rsync': 'rsyncbackend',
+    's3': 'botobackend',
+    's3+http': 'botobackend',
+    'scp': 'ssh_paramiko_backend',
+    'sftp': 'ssh_paramiko_backend',
+    'swift': 'swiftbackend',
+    'sx': 'sxbackend',
+    'tahoe': 'tahoebackend',
+    'webdav': 'webdavbackend',
+    'webdavs': 'webdavbackend',
+}
+
+# Same for the prefixes of meta backends, as in par2+scheme://
+_backend_prefix_modules = {
+    'gio': 'giobackend',
+    'par2': 'par2backend',
+    'sim': 'simbackend',
+}
+
 # These URL schemes have a backend with a notion of an RFC "network location".
 # The 'file' and 's3+http' schemes should not be in this list.
 # 'http' and 'https' are not actually used for duplicity backend urls, but are needed
@@ -73,8 +135,15 @@ _backend_prefixes = {}
 # that list for parsing, only creating urls.  And doesn't include our custom
 # schemes anyway.  So we keep our own here for our own use.
 #
-# NOTE: this is filled by the respective backends during registering
-uses_netloc = []
+# NOTE: URLs are parsed before their backend is imported, so new backends
+# add their schemes here rather than at registration.
+uses_netloc = ['copy', 'fish', 'ftp', 'ftps', 'gdata+gdocs', 'gdocs', 'hsi',
+               'http', 'https', 'imap', 'imaps', 'lftp+fish', 'lftp+ftp',
+               'lftp+ftps', 'lftp+http', 'lftp+https', 'lftp+sftp',
+               'lftp+webdav', 'lftp+webdavs', 'mega', 'ncftp+ftp',
+               'paramiko+scp', 'paramiko+sftp', 'pexpect+scp', 'pexpect+sftp',
+               'pydrive', 'pydrive+gdocs', 'rsync', 's3', 'scp', 'sftp',
+               'webdav', 'webdavs']
 
 
 def import_backends():
@@ -82,6 +151,9 @@ def import_backends():
     Import files in the duplicity/backends directory where
     the filename ends in 'backend.py' and ignore the rest.
 
+    Duplicity itself only imports the backend it needs, see
+    import_backend().
+
     @rtype: void
     @return: void
     """
@@ -104,6 +176,24 @@ def import_backends():
             continue
 
 
+def import_backend(module):
+    """
+    Import the given module from the duplicity/backends directory, which
+    registers its schemes.
+
+    Raise BackendException if the module cannot be imported.
+    """
+    imp = "duplicity.backends.%s" % (module,)
+    if imp in sys.modules:
+        return
+    try:
+        __import__(imp)
+    except Exception:
+        log.Log(_("Import of %s %s") % (imp, "Failed: " + str(sys.exc_info()[1])), log.INFO)
+        raise BackendException(_("Could not initialize backend: %s") % str(sys.exc_info()[1]))
+    log.Log(_("Import of %s %s") % (imp, "Succeeded"), log.INFO)
+
+
 def register_backend(scheme, backend_factory):
     """
     Register a given backend factory responsible for URL:s with the
@@ -193,6 +283,12 @@ def get_backend_object(url_string):
 
     factory = None
 
+    for prefix in _backend_prefix_modules:
+        if url_string.startswith(prefix + '+'):
+            import_backend(_backend_prefix_modules[prefix])
+    if pu.scheme in _backend_modules:
+        import_backend(_backend_modules[pu.scheme])
+
     for prefix in _backend_prefixes:
         if url_string.startswith(prefix + '+'):
             factory = _backend_prefixes[prefix]
@@ -355,6 +451,85 @@ def _get_code_from_exception(backend, operation, e):
     return log.ErrorCode.backend_error
 
 
+# Retries made by all backends during this run and the seconds spent
+# waiting for them, reported with the backup statistics.
+retry_count = 0
+retry_time = 0.0
+_retry_lock = threading.Lock()
+
+
+def parse_retry_after(value):
+    """
+    Return the seconds to wait given by an HTTP Retry-After header value,
+    which is either a number of seconds or a date, or None if unusable.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+def _is_connection_reset(e):
+    """
+    Return true if e looks like a dropped connection, which a quick
+    reconnect usually cures.
+    """
+    if isinstance(e, (httplib.BadStatusLine, httplib.IncompleteRead)):
+        return True
+    if isinstance(e, socket.error) and not isinstance(e, socket.timeout):
+        return e.errno in [errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE]
+    return False
+
+
+def _get_retry_delay(e, n):
+    """
+    Return the seconds to wait after attempt n failed with exception e.
+
+    A delay asked for by the backend (e.g. from a Retry-After header) is
+    honoured.  Otherwise the delay doubles with each attempt, starting at
+    one second for dropped connections, at globals.retry_delay for most
+    errors and at three times that when the backend reports load.  Half
+    of it is random, so clients throttled together don't retry together.
+    """
+    retry_after = getattr(e, 'retry_after', None)
+    if retry_after is not None:
+        return min(retry_after, globals.retry_max_delay)
+    if _is_connection_reset(e):
+        base = 1
+    elif isinstance(e, TemporaryLoadException):
+        base = 3 * globals.retry_delay
+    else:
+        base = globals.retry_delay
+    delay = min(base * 2 ** (n - 1), globals.retry_max_delay)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def _use_retry():
+    """
+    Count a retry against the budget of the run.  Return false if the
+    budget is used up.
+    """
+    global retry_count
+    with _retry_lock:
+        if globals.retry_budget is not None and retry_count >= globals.retry_budget:
+            return False
+        retry_count += 1
+        return True
+
+
+def _add_retry_time(seconds):
+    global retry_time
+    with _retry_lock:
+        retry_time += seconds
+
+
 def retry(operation, fatal=True):
     # Decorators with arguments introduce a new level of indirection.  So we
     # have to return a decorator function (which itself returns a function!)
@@ -376,6 +551,9 @@ def retry(operation, fatal=True):
                         # If we tried to do something, but the file just isn't there,
                         # no need to retry.
                         at_end = True
+                    if not at_end and not _use_retry():
+                        log.Warn(_("Retry budget of %d exhausted.") % globals.retry_budget)
+                        at_end = True
                     if at_end and fatal:
                         def make_filename(f):
                             if isinstance(f, path.ROPath):
@@ -390,12 +568,15 @@ def retry(operation, fatal=True):
                         log.Warn(_("Attempt %s failed. %s: %s")
                                  % (n, e.__class__.__name__, util.uexc(e)))
                     if not at_end:
-                        if isinstance(e, TemporaryLoadException):
-                            time.sleep(90)  # wait longer before trying again
-                        else:
-                            time.sleep(30)  # wait a bit before trying again
+                        delay = _get_retry_delay(e, n)
+                        log.Info(_("Retrying in %.1f seconds") % delay)
+                        start = time.time()
+                        time.sleep(delay)
                         if hasattr(self.backend, '_retry_cleanup'):
                             self.backend._retry_cleanup()
+                        _add_retry_time(time.time() - start)
+                    else:
+                        break
 
         return inner_retry
     return outer_retry
@@ -498,7 +679,15 @@ class BackendWrapper(object):
     def __do_put(self, source_path, remote_filename):
         if hasattr(self.backend, '_put'):
             log.Info(_("Writing %s") % util.ufn(remote_filename))
-            self.backend._put(source_path, remote_filename)
+            step = timing.begin("backend.put")
+            nbytes = 0
+            try:
+                # before a local backend moves the file away
+                size = step and os.path.getsize(source_path.name)
+                self.backend._put(source_path, remote_filename)
+                nbytes = size
+            finally:
+                timing.end(step, nbytes)
         else:
             raise NotImplementedError()
 
@@ -535,14 +724,33 @@ class BackendWrapper(object):
     def get(self, remote_filename, local_path):
         """Retrieve remote_filename and place in local_path"""
         if hasattr(self.backend, '_get'):
-            self.backend._get(remote_filename, local_path)
-            local_path.setdata()
+            step = timing.begin("backend.get")
+            nbytes = 0
+            try:
+                self.backend._get(remote_filename, local_path)
+                local_path.setdata()
+                nbytes = step and local_path.exists() and local_path.getsize()
+            finally:
+                timing.end(step, nbytes)
             if not local_path.exists():
                 raise BackendException(_("File %s not found locally after get "
                                          "from backend") % util.ufn(local_path.name))
         else:
             raise NotImplementedError()
 
+    def repair(self, remote_filename, local_path):
+        """
+        Try to repair local_path, a corrupt copy of remote_filename, with
+        recovery data kept by the backend.  Return true if the backend
+        considers local_path intact afterwards.
+        """
+        if hasattr(self.backend, '_repair'):
+            try:
+                return self.backend._repair(remote_filename, local_path)
+            finally:
+                local_path.setdata()
+        return False
+
     @retry('list', fatal=True)
     def list(self):
         """
@@ -21,6 +21,6 @@
 
 """
 Imports of backends should not be done directly in this module.  All
-backend imports are done via import_backends() in backend.py.  This
+backend imports are done via import_backend() in backend.py.  This
 file is only to instantiate the duplicity.backends module itself.
 """
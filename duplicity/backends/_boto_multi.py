@@ -20,6 +20,7 @@
 # along with duplicity; if not, write to the Free Software Foundation,
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
+import mmap
 import os
 import sys
 import threading
@@ -77,10 +78,18 @@ class BotoBackend(BotoSingleBackend):
     with your Amazon Web Services key id and secret respectively.
     Alternatively you can export the environment variables
     AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY.
+
+    The worker pool lives as long as the backend does.  Every worker
+    keeps its own connection to the bucket between parts, and failed
+    parts are handed back to the pool instead of restarting the upload.
     """
 
     def __init__(self, parsed_url):
         BotoSingleBackend.__init__(self, parsed_url)
+        self._manager = None
+        self._queue = None
+        self._consumer = None
+        self._pool = None
         self._setup_pool()
 
     def _setup_pool(self):
@@ -94,18 +103,34 @@ class BotoBackend(BotoSingleBackend):
             self._pool.join()
             self._pool = None
 
+        # A single queue shares progress data between all pool workers and
+        # a consumer thread, that will collect and report
+        if globals.progress and self._queue is None:
+            self._manager = multiprocessing.Manager()
+            self._queue = self._manager.Queue()
+            self._consumer = ConsumerThread(self._queue)
+            self._consumer.start()
+
         log.Debug("Setting multipart boto backend process pool to %d processes" % number_of_procs)
 
-        self._pool = multiprocessing.Pool(processes=number_of_procs)
+        self._pool = multiprocessing.Pool(processes=number_of_procs,
+                                          initializer=multipart_worker_init,
+                                          initargs=(self.scheme, self.parsed_url,
+                                                    self.boto_uri_str, self.bucket_name,
+                                                    self._queue))
 
     def _close(self):
         BotoSingleBackend._close(self)
         log.Debug("Closing pool")
         self._pool.terminate()
         self._pool.join()
+        if self._consumer is not None:
+            self._consumer.finish = True
+            self._consumer.join()
+            self._manager.shutdown()
+            self._consumer = self._queue = self._manager = None
 
     def upload(self, filename, key, headers=None):
-        import boto
         chunk_size = globals.s3_multipart_chunk_size
 
         # Check minimum chunk size for S3
@@ -127,47 +152,37 @@ class BotoBackend(BotoSingleBackend):
 
         mp = self.bucket.initiate_multipart_upload(key.key, headers, encrypt_key=globals.s3_use_sse)
 
-        # Initiate a queue to share progress data between the pool
-        # workers and a consumer thread, that will collect and report
-        queue = None
-        if globals.progress:
-            manager = multiprocessing.Manager()
-            queue = manager.Queue()
-            consumer = ConsumerThread(queue)
-            consumer.start()
-        tasks = []
-        for n in range(chunks):
-            storage_uri = boto.storage_uri(self.boto_uri_str)
-            params = [self.scheme, self.parsed_url, storage_uri, self.bucket_name,
-                      mp.id, filename, n, chunk_size, globals.num_retries,
-                      queue]
-            tasks.append(self._pool.apply_async(multipart_upload_worker, params))
+        def submit(n):
+            params = [mp.key_name, mp.id, filename, n, chunk_size]
+            return self._pool.apply_async(multipart_upload_worker, params)
+
+        tasks = [(n, submit(n)) for n in range(chunks)]
+        attempts = dict.fromkeys(range(chunks), 1)
 
         log.Debug("Waiting for the pool to finish processing %s tasks" % len(tasks))
         while tasks:
+            n, task = tasks[0]
             try:
-                tasks[0].wait(timeout=globals.s3_multipart_max_timeout)
-                if tasks[0].ready():
-                    if tasks[0].successful():
-                        del tasks[0]
-                    else:
-                        log.Debug("Part upload not successful, aborting multipart upload.")
-                        self._setup_pool()
-                        break
-                else:
+                task.wait(timeout=globals.s3_multipart_max_timeout)
+                if not task.ready():
                     raise multiprocessing.TimeoutError
             except multiprocessing.TimeoutError:
                 log.Debug("%s tasks did not finish by the specified timeout, aborting multipart upload and resetting pool." % len(tasks))
+                # a hung worker can only be gotten rid of with its pool
                 self._setup_pool()
                 break
+            del tasks[0]
+            if task.successful():
+                continue
+            if attempts[n] >= globals.num_retries:
+                log.Debug("Part %d failed %d times, aborting multipart upload." % (n + 1, attempts[n]))
+                break
+            log.Debug("Part %d upload not successful, retrying it." % (n + 1))
+            attempts[n] += 1
+            tasks.append((n, submit(n)))
 
         log.Debug("Done waiting for the pool to finish processing")
 
-        # Terminate the consumer thread, if any
-        if globals.progress:
-            consumer.finish = True
-            consumer.join()
-
         if len(tasks) > 0 or len(mp.get_all_parts()) < chunks:
             mp.cancel_upload()
             raise BackendException("Multipart upload failed. Aborted.")
@@ -175,50 +190,102 @@ class BotoBackend(BotoSingleBackend):
         return mp.complete_upload()
 
 
-def multipart_upload_worker(scheme, parsed_url, storage_uri, bucket_name, multipart_id,
-                            filename, offset, bytes, num_retries, queue):
+# State of a single pool worker, kept between the parts it uploads.
+_worker = threading.local()
+
+
+def multipart_worker_init(scheme, parsed_url, boto_uri_str, bucket_name, queue):
+    """
+    Pool initializer, remembers what each worker needs to connect on
+    its own.  The connection itself is opened lazily by the first part.
+    """
+    if multiprocessing.__name__ == 'multiprocessing':
+        # A forked worker inherits boto's cached connection of the parent,
+        # whose pooled sockets it must not share.
+        from boto.storage_uri import StorageUri
+        StorageUri.provider_pool.clear()
+    _worker.args = (scheme, parsed_url, boto_uri_str, bucket_name)
+    _worker.queue = queue
+    _worker.conn = None
+    _worker.bucket = None
+
+
+def _worker_bucket():
+    """
+    Return the bucket of this worker's persistent connection
+    """
+    if _worker.bucket is None:
+        import boto
+        scheme, parsed_url, boto_uri_str, bucket_name = _worker.args
+        storage_uri = boto.storage_uri(boto_uri_str)
+        _worker.conn = get_connection(scheme, parsed_url, storage_uri)
+        _worker.bucket = _worker.conn.get_bucket(bucket_name, validate=False)
+    return _worker.bucket
+
+
+def _worker_reset():
+    """
+    Drop this worker's connection so the next part reconnects
+    """
+    if _worker.conn is not None:
+        try:
+            _worker.conn.close()
+        except Exception:
+            pass
+    _worker.conn = None
+    _worker.bucket = None
+
+
+def _worker_part(filename, offset, bytes):
+    """
+    Return a read-only view of bytes bytes of filename from offset on.
+
+    The part is mapped rather than read so that all workers share the
+    same page cache pages.  The volume is closed once mapped, so no
+    worker keeps it open after its part, and a deleted volume does not
+    stay on disk.  Returns a FileChunkIO when the offset cannot be
+    mapped.
+    """
+    with open(filename, 'rb') as volume:
+        fileno = volume.fileno()
+        length = min(bytes, os.fstat(fileno).st_size - offset)
+        if length > 0 and offset % mmap.ALLOCATIONGRANULARITY == 0:
+            return mmap.mmap(fileno, length, access=mmap.ACCESS_READ, offset=offset)
+    return FileChunkIO(filename, 'r', offset=offset, bytes=bytes)
+
+
+def multipart_upload_worker(key_name, multipart_id, filename, offset, bytes):
     """
     Worker method for uploading a file chunk to S3 using multipart upload.
-    Note that the file chunk is read into memory, so it's important to keep
-    this number reasonably small.
+    Failures are raised back to the backend, which decides whether to
+    resubmit the part; the worker reconnects before its next part.
     """
+    from boto.s3.multipart import MultiPartUpload
+    worker_name = multiprocessing.current_process().name
 
     def _upload_callback(uploaded, total):
-        worker_name = multiprocessing.current_process().name
         log.Debug("%s: Uploaded %s/%s bytes" % (worker_name, uploaded, total))
-        if queue is not None:
-            queue.put([uploaded, total])  # Push data to the consumer thread
-
-    def _upload(num_retries):
-        worker_name = multiprocessing.current_process().name
-        log.Debug("%s: Uploading chunk %d" % (worker_name, offset + 1))
+        if _worker.queue is not None:
+            _worker.queue.put([uploaded, total])  # Push data to the consumer thread
+
+    log.Debug("%s: Uploading chunk %d" % (worker_name, offset + 1))
+    try:
+        mp = MultiPartUpload(_worker_bucket())
+        mp.key_name = key_name
+        mp.id = multipart_id
+        fd = _worker_part(filename, offset * bytes, bytes)
         try:
-            conn = get_connection(scheme, parsed_url, storage_uri)
-            bucket = conn.lookup(bucket_name)
-
-            for mp in bucket.list_multipart_uploads():
-                if mp.id == multipart_id:
-                    with FileChunkIO(filename, 'r', offset=offset * bytes, bytes=bytes) as fd:
-                        start = time.time()
-                        mp.upload_part_from_file(fd, offset + 1, cb=_upload_callback,
-                                                 num_cb=max(2, 8 * bytes / (1024 * 1024))
-                                                 )  # Max num of callbacks = 8 times x megabyte
-                        end = time.time()
-                        log.Debug("{name}: Uploaded chunk {chunk} at roughly {speed} bytes/second".format(name=worker_name, chunk=offset + 1, speed=(bytes / max(1, abs(end - start)))))
-                    break
-            conn.close()
-            conn = None
-            bucket = None
-            del conn
-        except Exception as e:
-            traceback.print_exc()
-            if num_retries:
-                log.Debug("%s: Upload of chunk %d failed. Retrying %d more times..." % (
-                    worker_name, offset + 1, num_retries - 1))
-                return _upload(num_retries - 1)
-            log.Debug("%s: Upload of chunk %d failed. Aborting..." % (
-                worker_name, offset + 1))
-            raise e
-        log.Debug("%s: Upload of chunk %d complete" % (worker_name, offset + 1))
-
-    return _upload(num_retries)
+            start = time.time()
+            mp.upload_part_from_file(fd, offset + 1, cb=_upload_callback,
+                                     num_cb=max(2, 8 * bytes / (1024 * 1024))
+                                     )  # Max num of callbacks = 8 times x megabyte
+            end = time.time()
+            log.Debug("{name}: Uploaded chunk {chunk} at roughly {speed} bytes/second".format(name=worker_name, chunk=offset + 1, speed=(bytes / max(1, abs(end - start)))))
+        finally:
+            fd.close()
+    except Exception as e:
+        traceback.print_exc()
+        log.Debug("%s: Upload of chunk %d failed." % (worker_name, offset + 1))
+        _worker_reset()
+        raise e
+    log.Debug("%s: Upload of chunk %d complete" % (worker_name, offset + 1))
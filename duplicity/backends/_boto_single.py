@@ -93,6 +93,11 @@ def get_connection(scheme, parsed_url, storage_uri):
     if not parsed_url.hostname:
         # Use the default host.
         conn = storage_uri.connect(is_secure=(not globals.s3_unencrypted_connection))
+    elif parsed_url.port:
+        # S3 compatible services do not necessarily live on the default port
+        assert scheme == 's3'
+        conn = storage_uri.connect(host=parsed_url.hostname, port=parsed_url.port,
+                                   is_secure=(not globals.s3_unencrypted_connection))
     else:
         assert scheme == 's3'
         conn = storage_uri.connect(host=parsed_url.hostname,
@@ -317,4 +317,3 @@ class CopyComBackend(duplicity.backend.Backend):
 '''
 
 duplicity.backend.register_backend('copy', CopyComBackend)
-duplicity.backend.uses_netloc.extend(['copy'])
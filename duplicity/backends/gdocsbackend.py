@@ -186,4 +186,3 @@ class GDocsBackend(duplicity.backend.Backend):
 
 """ gdata is an alternate way to access gdocs, currently 05/2015 lacking OAuth support """
 duplicity.backend.register_backend('gdata+gdocs', GDocsBackend)
-duplicity.backend.uses_netloc.extend(['gdata+gdocs'])
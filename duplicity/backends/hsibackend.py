@@ -55,4 +55,3 @@ class HSIBackend(duplicity.backend.Backend):
         self.subprocess_popen(commandline)
 
 duplicity.backend.register_backend("hsi", HSIBackend)
-duplicity.backend.uses_netloc.extend(['hsi'])
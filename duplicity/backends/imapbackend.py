@@ -259,4 +259,3 @@ class ImapBackend(duplicity.backend.Backend):
 
 duplicity.backend.register_backend("imap", ImapBackend)
 duplicity.backend.register_backend("imaps", ImapBackend)
-duplicity.backend.uses_netloc.extend(['imap', 'imaps'])
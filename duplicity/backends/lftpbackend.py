@@ -197,10 +197,3 @@ duplicity.backend.register_backend("lftp+webdav", LFTPBackend)
 duplicity.backend.register_backend("lftp+webdavs", LFTPBackend)
 duplicity.backend.register_backend("lftp+http", LFTPBackend)
 duplicity.backend.register_backend("lftp+https", LFTPBackend)
-
-duplicity.backend.uses_netloc.extend(['ftp', 'ftps', 'fish',
-                                      'lftp+ftp', 'lftp+ftps',
-                                      'lftp+fish', 'lftp+sftp',
-                                      'lftp+webdav', 'lftp+webdavs',
-                                      'lftp+http', 'lftp+https']
-                                     )
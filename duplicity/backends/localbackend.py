@@ -19,13 +19,122 @@
 # along with duplicity; if not, write to the Free Software Foundation,
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
+import errno
 import os
+import sys
 
 import duplicity.backend
 from duplicity import log
 from duplicity import path
+from duplicity import util
 from duplicity.errors import BackendException
 
+# ioctl asking a copy-on-write filesystem (btrfs, XFS, ...) to share the
+# extents of one file with another
+FICLONE = 0x40049409
+
+# Kernel copies that avoid passing the data through userspace.  Neither
+# is exposed by the Python 2 os module, so call them through libc.
+_copy_file_range = None
+_sendfile = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendfile = _libc.sendfile
+        _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.c_void_p, ctypes.c_size_t]
+        _sendfile.restype = ctypes.c_ssize_t
+        # glibc 2.27 and later
+        _copy_file_range = _libc.copy_file_range
+        _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_size_t, ctypes.c_uint]
+        _copy_file_range.restype = ctypes.c_ssize_t
+    except (ImportError, OSError, AttributeError):
+        pass
+
+# errors meaning a copy method is not available for these files
+_unsupported = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY)
+
+
+def _clone(source_fd, target_fd):
+    """Share the extents of source_fd with target_fd, return success"""
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in _unsupported:
+            return False
+        raise
+
+
+def _kernel_copy(copy):
+    """
+    Copy the rest of a file with copy(count), a libc call working on file
+    descriptors, return false if it cannot be used for these files.
+    """
+    copied = 0
+    while True:
+        count = copy(1024 * 1024 * 1024)
+        if count == 0:
+            return True
+        if count < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if copied == 0 and err in _unsupported:
+                return False
+            raise OSError(err, os.strerror(err))
+        copied += count
+
+
+def _copy_range(source_fd, target_fd):
+    """Copy with copy_file_range, return success"""
+    if _copy_file_range is None:
+        return False
+    return _kernel_copy(lambda n: _copy_file_range(source_fd, None, target_fd, None, n, 0))
+
+
+def _send(source_fd, target_fd):
+    """Copy with sendfile, return success"""
+    if _sendfile is None:
+        return False
+    return _kernel_copy(lambda n: _sendfile(target_fd, source_fd, None, n))
+
+
+def copy_file(source_path, target_path):
+    """
+    Copy source_path to target_path without reading the data into
+    userspace where possible: first try a reflink, then copy_file_range
+    (which may clone or copy inside the filesystem), then sendfile, then
+    fall back to an ordinary copy.
+    """
+    source_file = source_path.open("rb")
+    try:
+        target_file = target_path.open("wb")
+        try:
+            source_fd = source_file.fileno()
+            target_fd = target_file.fileno()
+            if not (_clone(source_fd, target_fd) or
+                    _copy_range(source_fd, target_fd) or
+                    _send(source_fd, target_fd)):
+                while True:
+                    buf = source_file.read(64 * 1024)
+                    if not buf:
+                        break
+                    target_file.write(buf)
+        finally:
+            target_file.close()
+    finally:
+        source_file.close()
+    target_path.setdata()
+
 
 class LocalBackend(duplicity.backend.Backend):
     """Use this backend when saving to local disk
@@ -55,11 +164,21 @@ class LocalBackend(duplicity.backend.Backend):
 
     def _put(self, source_path, remote_filename):
         target_path = self.remote_pathdir.append(remote_filename)
-        target_path.writefileobj(source_path.open("rb"))
+        # replace rather than overwrite, the old file may be linked by _get
+        util.ignore_missing(os.unlink, target_path.name)
+        copy_file(source_path, target_path)
 
     def _get(self, filename, local_path):
+        """
+        Volumes are only read once fetched, so a hardlink lets duplicity
+        read the backend file directly when it is on the same filesystem.
+        """
         source_path = self.remote_pathdir.append(filename)
-        local_path.writefileobj(source_path.open("rb"))
+        try:
+            os.link(source_path.name, local_path.name)
+            local_path.setdata()
+        except (OSError, AttributeError):
+            copy_file(source_path, local_path)
 
     def _list(self):
         return self.remote_pathdir.listdir()
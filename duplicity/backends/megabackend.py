@@ -123,4 +123,3 @@ class MegaBackend(duplicity.backend.Backend):
         return result
 
 duplicity.backend.register_backend('mega', MegaBackend)
-duplicity.backend.uses_netloc.extend(['mega'])
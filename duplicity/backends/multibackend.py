@@ -23,7 +23,10 @@
 import os
 import os.path
 import string
+import threading
+import time
 import urllib
+import urlparse
 import json
 
 import duplicity.backend
@@ -34,9 +37,6 @@ from duplicity import log
 class MultiBackend(duplicity.backend.Backend):
     """Store files across multiple remote stores. URL is a path to a local file containing URLs/other config defining the remote store"""
 
-    # the stores we are managing
-    __stores = []
-
     # when we write, we "stripe" via a simple round-robin across
     # remote stores.  It's hard to get too much more sophisticated
     # since we can't rely on the backend to give us any useful meta
@@ -44,9 +44,35 @@ class MultiBackend(duplicity.backend.Backend):
     # a better job of balancing load across stores.
     __write_cursor = 0
 
+    # In 'mirror' mode every file is written to all stores instead, and
+    # a write succeeds once 'quorum' stores hold the file (default: all).
+    # Both are given as URL query parameters:
+    #
+    #   multi:///path/to/config.json?mode=mirror&quorum=2
+    __mode = 'stripe'
+    __quorum = None
+
+    # weight of the newest sample in the per-store response time average
+    __latency_weight = 0.3
+
     def __init__(self, parsed_url):
         duplicity.backend.Backend.__init__(self, parsed_url)
 
+        # the stores we are managing
+        self.__stores = []
+        # which stores (by index) hold each filename, filled by _list
+        # and kept up to date by our own writes and deletes
+        self.__where = {}
+        self.__listed = False
+        # running average of the response time of each store
+        self.__latency = []
+
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(parsed_url.url_string).query))
+        self.__mode = query.get('mode', self.__mode)
+        if self.__mode not in ['stripe', 'mirror']:
+            raise BackendException("MultiBackend: unknown mode %s" % self.__mode)
+        config_path = parsed_url.path
+
         # Init each of the wrapped stores
         #
         # config file is a json formatted collection of values, one for
@@ -78,16 +104,17 @@ class MultiBackend(duplicity.backend.Backend):
         # ]
 
         try:
-            with open(parsed_url.path) as f:
+            with open(config_path) as f:
                 configs = json.load(f)
         except IOError as e:
             log.Log(_("MultiBackend: Could not load config file %s: %s ")
-                    % (parsed_url.path, e),
+                    % (config_path, e),
                     log.ERROR)
             raise BackendException('Could not load config file')
 
         for config in configs:
-            url = config['url']
+            # json hands us unicode, but duplicity deals in byte strings
+            url = config['url'].encode('utf-8')
             log.Log(_("MultiBackend: use store %s")
                     % (url),
                     log.INFO)
@@ -100,12 +127,61 @@ class MultiBackend(duplicity.backend.Backend):
 
             store = duplicity.backend.get_backend(url)
             self.__stores.append(store)
-            # store_list = store.list()
-            # log.Log(_("MultiBackend: at init, store %s has %s files")
-            #         % (url, len(store_list)),
-            #         log.INFO)
+            self.__latency.append(0.0)
+
+        self.__quorum = int(query.get('quorum', len(self.__stores)))
+        if not 0 < self.__quorum <= len(self.__stores):
+            raise BackendException("MultiBackend: quorum must be between 1 and %d"
+                                   % len(self.__stores))
+
+    def __url(self, i):
+        return self.__stores[i].backend.parsed_url.url_string
+
+    def __timed(self, i, fn, *args):
+        """
+        Call fn(*args) on behalf of store i and fold its duration into
+        the store's running average response time.
+        """
+        start = time.time()
+        result = fn(*args)
+        elapsed = time.time() - start
+        self.__latency[i] += self.__latency_weight * (elapsed - self.__latency[i])
+        return result
+
+    def __parallel(self, fn, indexes):
+        """
+        Call fn(i) for each store index in its own thread.  Return a
+        list of (i, result, exception) tuples in the order of indexes.
+        """
+        results = [None] * len(indexes)
+
+        def run(n, i):
+            try:
+                results[n] = (i, self.__timed(i, fn, i), None)
+            except Exception as e:
+                results[n] = (i, None, e)
+
+        threads = [threading.Thread(target=run, args=(n, i))
+                   for n, i in enumerate(indexes)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def __locate(self, filename):
+        """
+        Return the indexes of the stores holding filename, fastest first
+        """
+        if filename not in self.__where and not self.__listed:
+            self._list()
+        return sorted(self.__where.get(filename, []),
+                      key=lambda i: self.__latency[i])
 
     def _put(self, source_path, remote_filename):
+        if self.__mode == 'mirror':
+            return self.__put_mirror(source_path, remote_filename)
+
         first = self.__write_cursor
         while True:
             store = self.__stores[self.__write_cursor]
@@ -117,6 +193,7 @@ class MultiBackend(duplicity.backend.Backend):
                         % (self.__write_cursor, store.backend.parsed_url.url_string),
                         log.DEBUG)
                 store.put(source_path, remote_filename)
+                self.__where[remote_filename] = [self.__write_cursor]
                 self.__write_cursor = next
                 break
             except Exception as e:
@@ -131,59 +208,99 @@ class MultiBackend(duplicity.backend.Backend):
                             log.ERROR)
                     raise BackendException("failed to write")
 
+    def __put_mirror(self, source_path, remote_filename):
+        # Stores that already got the file in an earlier attempt of this
+        # put are not written again when the put is retried.
+        have = set(self.__where.get(remote_filename, []))
+        todo = [i for i in range(len(self.__stores)) if i not in have]
+
+        def put(i):
+            log.Log(_("MultiBackend: _put: write to store #%s (%s)")
+                    % (i, self.__url(i)),
+                    log.DEBUG)
+            self.__stores[i].backend._put(source_path, remote_filename)
+
+        for i, result, e in self.__parallel(put, todo):
+            if e is None:
+                have.add(i)
+            else:
+                log.Log(_("MultiBackend: failed to write to store #%s (%s), Exception: %s")
+                        % (i, self.__url(i), e),
+                        log.INFO)
+        self.__where[remote_filename] = sorted(have)
+
+        if len(have) < self.__quorum:
+            log.Log(_("MultiBackend: failed to write %s. Only %s of %s required stores succeeded")
+                    % (source_path, len(have), self.__quorum),
+                    log.ERROR)
+            raise BackendException("failed to write")
+
     def _get(self, remote_filename, local_path):
-        # since the backend operations will be retried, we can't
-        # simply try to get from the store, if not found, move to the
-        # next store (since each failure will be retried n times
-        # before finally giving up).  So we need to get the list first
-        # before we try to fetch
-        # ENHANCEME: maintain a cached list for each store
-        for s in self.__stores:
-            list = s.list()
-            if remote_filename in list:
-                s.get(remote_filename, local_path)
+        # Only the stores known to hold the file are asked for it, the
+        # fastest mirror first.  The other mirrors are tried right away
+        # if it fails, rather than waiting for the retry of the whole get.
+        for i in self.__locate(remote_filename):
+            try:
+                self.__timed(i, self.__stores[i].backend._get, remote_filename, local_path)
                 return
-            log.Log(_("MultiBackend: failed to get %s to %s from %s")
-                    % (remote_filename, local_path, s.backend.parsed_url.url_string),
-                    log.INFO)
+            except Exception as e:
+                log.Log(_("MultiBackend: failed to get %s to %s from %s: %s")
+                        % (remote_filename, local_path, self.__url(i), e),
+                        log.INFO)
         log.Log(_("MultiBackend: failed to get %s. Tried all backing stores and none succeeded")
                 % (remote_filename),
                 log.ERROR)
+        # the file may have appeared since we last listed
+        self.__listed = False
         raise BackendException("failed to get")
 
     def _list(self):
-        lists = []
-        for s in self.__stores:
-            l = s.list()
+        def list(i):
+            return self.__stores[i].backend._list()
+
+        where = {}
+        result = []
+        answered = 0
+        for i, l, e in self.__parallel(list, range(len(self.__stores))):
+            if e is not None:
+                # striped files are only complete with all stores, but
+                # any mirror that answers will do
+                if self.__mode != 'mirror':
+                    raise e
+                log.Log(_("MultiBackend: failed to list %s: %s")
+                        % (self.__url(i), e),
+                        log.WARNING)
+                continue
+            answered += 1
             log.Log(_("MultiBackend: list from %s: %s")
-                    % (s.backend.parsed_url.url_string, l),
+                    % (self.__url(i), l),
                     log.DEBUG)
-            lists.append(s.list())
-        # combine the lists into a single flat list:
-        result = [item for sublist in lists for item in sublist]
+            for item in l:
+                # mirrors hold the same files, report each only once
+                if item not in where:
+                    where[item] = []
+                    result.append(item)
+                where[item].append(i)
+        if not answered:
+            raise BackendException("failed to list")
+        self.__where = where
+        self.__listed = True
         log.Log(_("MultiBackend: combined list: %s")
                 % (result),
                 log.DEBUG)
         return result
 
     def _delete(self, filename):
-        # since the backend operations will be retried, we can't
-        # simply try to get from the store, if not found, move to the
-        # next store (since each failure will be retried n times
-        # before finally giving up).  So we need to get the list first
-        # before we try to delete
-        # ENHANCEME: maintain a cached list for each store
-        for s in self.__stores:
-            list = s.list()
-            if filename in list:
-                s._do_delete(filename)
-                return
-            log.Log(_("MultiBackend: failed to delete %s from %s")
-                    % (filename, s.backend.parsed_url.url_string),
-                    log.INFO)
-        log.Log(_("MultiBackend: failed to delete %s. Tried all backing stores and none succeeded")
-                % (filename),
-                log.ERROR)
-#        raise BackendException("failed to delete")
+        # the stores to delete from come from the cached listing
+        indexes = self.__locate(filename)
+        if not indexes:
+            log.Log(_("MultiBackend: failed to delete %s. Tried all backing stores and none succeeded")
+                    % (filename),
+                    log.ERROR)
+#            raise BackendException("failed to delete")
+            return
+        for i in indexes:
+            self.__stores[i]._do_delete(filename)
+        del self.__where[filename]
 
 duplicity.backend.register_backend('multi', MultiBackend)
@@ -116,4 +116,3 @@ class NCFTPBackend(duplicity.backend.Backend):
         self.subprocess_popen(commandline)
 
 duplicity.backend.register_backend("ncftp+ftp", NCFTPBackend)
-duplicity.backend.uses_netloc.extend(['ncftp+ftp'])
@@ -20,7 +20,11 @@ from future_builtins import filter
 
 import os
 import re
+import shlex
+import subprocess
+import threading
 from duplicity import backend
+from duplicity import file_naming
 from duplicity.errors import BackendException
 from duplicity import log
 from duplicity import globals
@@ -30,8 +34,13 @@ class Par2Backend(backend.Backend):
     """This backend wrap around other backends and create Par2 recovery files
     before the file and the Par2 files are transfered with the wrapped backend.
 
-    If a received file is corrupt it will try to repair it on the fly.
+    Recovery files are created in the background while duplicity builds the
+    next volume and are uploaded right before it.  If a received file turns
+    out to be corrupt, duplicity asks this backend to repair it.
     """
+    # number of Par2-volumes transfered at once for a repair
+    repair_threads = 4
+
     def __init__(self, parsed_url):
         backend.Backend.__init__(self, parsed_url)
         self.parsed_url = parsed_url
@@ -47,67 +56,176 @@ class Par2Backend(backend.Backend):
 
         self.wrapped_backend = backend.get_backend_object(parsed_url.url_string)
 
+        # par2 job of the last transfered file, see create_parity()
+        self.pending = None
+
         for attr in ['_get', '_put', '_list', '_delete', '_delete_list',
                      '_query', '_query_list', '_retry_cleanup', '_error_code',
-                     '_move', '_close']:
+                     '_move']:
             if hasattr(self.wrapped_backend, attr):
                 setattr(self, attr, getattr(self, attr[1:]))
 
-    def transfer(self, method, source_path, remote_filename):
-        """create Par2 files and transfer the given file and the Par2 files
-        with the wrapped backend.
+        # pending recovery files must be uploaded even if the wrapped
+        # backend has nothing to close
+        self._close = self.close
+        self._repair = self.repair
+
+    def create_parity(self, source_path, remote_filename):
+        """start "par2 create" for source_path in the background and return
+        the job, which transfer_parity() finishes.
 
         Par2 must run on the real filename or it would restore the
-        temp-filename later on. So first of all create a tempdir and symlink
-        the soure_path with remote_filename into this.
+        temp-filename later on. So first of all create a tempdir and link
+        the soure_path with remote_filename into this.  A hardlink keeps the
+        data around even after the volume has been moved or deleted.
         """
-        import pexpect
-
         par2temp = source_path.get_temp_in_same_dir()
         par2temp.mkdir()
-        source_symlink = par2temp.append(remote_filename)
-        source_target = source_path.get_canonical()
-        if not os.path.isabs(source_target):
-            source_target = os.path.join(os.getcwd(), source_target)
-        os.symlink(source_target, source_symlink.get_canonical())
-        source_symlink.setdata()
+        source_link = par2temp.append(remote_filename)
+        try:
+            os.link(source_path.name, source_link.name)
+            wait = False
+        except OSError:
+            source_target = source_path.get_canonical()
+            if not os.path.isabs(source_target):
+                source_target = os.path.join(os.getcwd(), source_target)
+            os.symlink(source_target, source_link.get_canonical())
+            wait = True
+        source_link.setdata()
 
         log.Info("Create Par2 recovery files")
-        par2create = 'par2 c -r%d -n1 %s %s' % (self.redundancy, self.common_options, source_symlink.get_canonical())
-        out, returncode = pexpect.run(par2create, None, True)
+        par2create = ['par2', 'c', '-r%d' % self.redundancy, '-n1']
+        par2create += shlex.split(self.common_options)
+        par2create.append(source_link.get_canonical())
+        devnull = open(os.devnull, 'w')
+        try:
+            process = subprocess.Popen(par2create, stdin=devnull,
+                                       stdout=devnull, stderr=devnull)
+        except OSError as e:
+            par2temp.deltree()
+            raise BackendException("Failed to run par2: %s" % e)
+        finally:
+            devnull.close()
 
-        source_symlink.delete()
-        files_to_transfer = []
-        if not returncode:
-            for file in par2temp.listdir():
-                files_to_transfer.append(par2temp.append(file))
+        if wait:
+            # a symlink does not survive a move of the source
+            process.wait()
+        return (process, par2temp, source_link, remote_filename)
 
-        method(source_path, remote_filename)
-        for file in files_to_transfer:
-            method(file, file.get_filename())
+    def transfer_parity(self):
+        """wait for the pending par2 job and transfer its recovery files
+        with the wrapped backend.
 
+        The job is only dropped once all files are transfered, so a retry
+        of the next operation tries again.
+        """
+        if self.pending is None:
+            return
+        process, par2temp, source_link, remote_filename = self.pending
+        returncode = process.wait()
+        source_link.delete()
+        if not returncode:
+            for filename in par2temp.listdir():
+                self.wrapped_backend._put(par2temp.append(filename), filename)
+        else:
+            log.Warn("Failed to create Par2 recovery files for %s" % remote_filename)
+        par2temp.deltree()
+        self.pending = None
+
+    def discard_parity(self, job):
+        """stop the par2 job and remove its tempdir"""
+        process, par2temp, source_link, remote_filename = job
+        if process.poll() is None:
+            process.kill()
+            process.wait()
         par2temp.deltree()
 
+    def transfer(self, method, source_path, remote_filename):
+        """create Par2 files and transfer the given file and the Par2 files
+        with the wrapped backend.
+
+        The recovery files of the previous file are transfered first, then
+        par2 starts on this file and runs while it is transfered and while
+        duplicity goes on with the next volume.
+        """
+        self.transfer_parity()
+
+        job = self.create_parity(source_path, remote_filename)
+        try:
+            result = method(source_path, remote_filename)
+        except Exception:
+            self.discard_parity(job)
+            raise
+        if result is False:
+            self.discard_parity(job)
+            return False
+        self.pending = job
+
     def put(self, local, remote):
         self.transfer(self.wrapped_backend._put, local, remote)
 
     def move(self, local, remote):
-        self.transfer(self.wrapped_backend._move, local, remote)
+        return self.transfer(self.wrapped_backend._move, local, remote)
 
     def get(self, remote_filename, local_path):
-        """transfer remote_filename and the related .par2 file into
-        a temp-dir. remote_filename will be renamed into local_path before
-        finishing.
+        """transfer remote_filename into local_path.
+
+        Volumes are checked against the hash in the manifest by duplicity,
+        which calls repair() only if that check fails.  Other files carry
+        no hash, so they are verified with "par2 verify" right away.
+        """
+        self.transfer_parity()
+        self.wrapped_backend._get(remote_filename, local_path)
+
+        pr = file_naming.parse(remote_filename)
+        if not pr or pr.type not in ["full", "inc"]:
+            self.repair(remote_filename, local_path)
+
+    def get_volumes(self, filenames, par2temp):
+        """transfer the given Par2-volumes into par2temp in parallel.
+
+        Backends are not thread safe, so each worker uses an instance of
+        its own.  Volumes that cannot be transfered are skipped, par2 may
+        manage without them.
+        """
+        queue = list(filenames)
+        lock = threading.Lock()
+
+        def worker():
+            wrapped = backend.get_backend_object(self.parsed_url.url_string)
+            try:
+                while True:
+                    with lock:
+                        if not queue:
+                            return
+                        filename = queue.pop()
+                    try:
+                        wrapped._get(filename, par2temp.append(filename))
+                    except Exception as e:
+                        log.Warn("Failed to transfer %s: %s" % (filename, e))
+            finally:
+                if hasattr(wrapped, '_close'):
+                    wrapped._close()
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(len(queue), self.repair_threads))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def repair(self, remote_filename, local_path):
+        """transfer the .par2 file of remote_filename into a temp-dir and
+        "par2 verify" local_path with it.
 
         If "par2 verify" detect an error transfer the Par2-volumes into the
-        temp-dir and try to repair.
+        temp-dir and try to repair.  Return True if local_path is intact.
         """
         import pexpect
         par2temp = local_path.get_temp_in_same_dir()
         par2temp.mkdir()
         local_path_temp = par2temp.append(remote_filename)
-
-        self.wrapped_backend._get(remote_filename, local_path_temp)
+        local_path.rename(local_path_temp)
 
         try:
             par2file = par2temp.append(remote_filename + '.par2')
@@ -118,12 +236,9 @@ class Par2Backend(backend.Backend):
 
             if returncode:
                 log.Warn("File is corrupt. Try to repair %s" % remote_filename)
-                par2volumes = filter(re.compile(r'%s\.vol[\d+]*\.par2' % remote_filename).match,
+                par2volumes = filter(re.compile(r'%s\.vol[\d+]*\.par2' % re.escape(remote_filename)).match,
                                      self.wrapped_backend._list())
-
-                for filename in par2volumes:
-                    file = par2temp.append(filename)
-                    self.wrapped_backend._get(filename, file)
+                self.get_volumes(par2volumes, par2temp)
 
                 par2repair = 'par2 r %s %s %s' % (self.common_options, par2file.get_canonical(), local_path_temp.get_canonical())
                 out, returncode = pexpect.run(par2repair, None, True)
@@ -132,9 +247,10 @@ class Par2Backend(backend.Backend):
                     log.Error("Failed to repair %s" % remote_filename)
                 else:
                     log.Warn("Repair successful %s" % remote_filename)
-        except BackendException:
+            return not returncode
+        except (BackendException, EnvironmentError):
             # par2 file not available
-            pass
+            return False
         finally:
             local_path_temp.rename(local_path)
             par2temp.deltree()
@@ -142,6 +258,7 @@ class Par2Backend(backend.Backend):
     def delete(self, filename):
         """delete given filename and its .par2 files
         """
+        self.transfer_parity()
         self.wrapped_backend._delete(filename)
 
         remote_list = self.list()
@@ -154,6 +271,7 @@ class Par2Backend(backend.Backend):
     def delete_list(self, filename_list):
         """delete given filename_list and all .par2 files that belong to them
         """
+        self.transfer_parity()
         remote_list = self.list()
 
         for filename in filename_list[:]:
@@ -192,6 +310,8 @@ class Par2Backend(backend.Backend):
         return self.wrapped_backend._query(filename_list)
 
     def close(self):
-        self.wrapped_backend._close()
+        self.transfer_parity()
+        if hasattr(self.wrapped_backend, '_close'):
+            self.wrapped_backend._close()
 
 backend.register_backend_prefix('par2', Par2Backend)
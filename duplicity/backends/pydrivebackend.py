@@ -121,5 +121,3 @@ duplicity.backend.register_backend('pydrive', PyDriveBackend)
 duplicity.backend.register_backend('pydrive+gdocs', PyDriveBackend)
 """ register pydrive as the default way to access gdocs """
 duplicity.backend.register_backend('gdocs', PyDriveBackend)
-
-duplicity.backend.uses_netloc.extend(['pydrive', 'pydrive+gdocs', 'gdocs'])
@@ -156,4 +156,3 @@ class RsyncBackend(duplicity.backend.Backend):
         os.rmdir(dir)
 
 duplicity.backend.register_backend("rsync", RsyncBackend)
-duplicity.backend.uses_netloc.extend(['rsync'])
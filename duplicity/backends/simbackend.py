@@ -0,0 +1,228 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import os
+import random
+import re
+import threading
+import time
+import urlparse
+
+from duplicity import backend
+from duplicity import log
+from duplicity.errors import BackendException
+from duplicity.errors import TemporaryLoadException
+
+_size_re = re.compile(r"^(\d+(?:\.\d*)?)([kmg]?)b?$", re.I)
+
+
+def _parse_size(value):
+    """Return bytes of a size like 512k, 10M or 1.5G"""
+    m = _size_re.match(value)
+    if not m:
+        raise ValueError(value)
+    return float(m.group(1)) * 1024 ** " kmg".index(m.group(2).lower() or " ")
+
+
+def _parse_rate(value):
+    rate = float(value)
+    if not 0 <= rate <= 1:
+        raise ValueError(value)
+    return rate
+
+
+# query options, with a function parsing each and its default
+_options = {
+    'latency': (float, 0.0),
+    'bandwidth': (_parse_size, None),
+    'upload': (_parse_size, None),
+    'download': (_parse_size, None),
+    'page_size': (int, None),
+    'error_rate': (_parse_rate, 0.0),
+    'throttle_rate': (_parse_rate, 0.0),
+    'retry_after': (float, None),
+    'consistency_delay': (float, 0.0),
+    'seed': (int, None),
+}
+
+
+class _Link:
+    """A link of bandwidth bytes per second shared by concurrent transfers"""
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.free_at = 0.0
+
+    def transfer(self, nbytes):
+        """Return seconds until nbytes queued on the link have gone over it"""
+        if not self.bandwidth:
+            return 0.0
+        with self.lock:
+            now = time.time()
+            self.free_at = max(now, self.free_at) + nbytes / self.bandwidth
+            return self.free_at - now
+
+
+class SimBackend(backend.Backend):
+    """Wrap another backend, usually file://, to behave like a remote one
+
+    Urls look like sim+file:///path?latency=0.05&bandwidth=1M&error_rate=0.01
+    with these options:
+
+      latency            seconds added to each request
+      bandwidth          bytes per second of transfers (k, M and G suffixes),
+                         shared by concurrent ones; upload and download
+                         set each direction on its own
+      page_size          names returned by each request of a listing
+      error_rate         fraction of requests failing with an error
+      throttle_rate      fraction of requests failing with a temporary load
+                         error, asking to wait retry_after seconds if given
+      consistency_delay  seconds new files are missing from listings, and
+                         deleted ones still in them
+      seed               seed of the random errors, so runs are repeatable
+
+    Requests are counted in self.stats and logged on close.  The wrapped
+    backend's _move is not used, so every upload takes the time of its size.
+    """
+    def __init__(self, parsed_url):
+        backend.Backend.__init__(self, parsed_url)
+        url, _sep, query = parsed_url.url_string.partition('?')
+        try:
+            for key, values in urlparse.parse_qs(query, strict_parsing=bool(query)).items():
+                parse = _options[key][0]
+                setattr(self, key, parse(values[-1]))
+        except KeyError as e:
+            raise BackendException("Unknown sim backend option %s, not one of %s" %
+                                   (e, ", ".join(sorted(_options))))
+        except ValueError as e:
+            raise BackendException("Bad sim backend options %s: %s" % (query, e))
+        for key, (parse, default) in _options.items():
+            if not hasattr(self, key):
+                setattr(self, key, default)
+
+        self.wrapped_backend = backend.get_backend_object(url)
+        self.upload_link = _Link(self.upload or self.bandwidth)
+        self.download_link = _Link(self.download or self.bandwidth)
+        self.random = random.Random(self.seed)
+        self.lock = threading.Lock()
+        # filename -> (time it shows in listings as it is, whether it exists)
+        self.pending = {}
+        self.stats = {'requests': 0, 'errors': 0, 'throttles': 0,
+                      'bytes_up': 0, 'bytes_down': 0, 'delay': 0.0}
+
+        for attr in ['_get', '_put', '_list', '_delete', '_delete_list',
+                     '_query', '_query_list', '_retry_cleanup', '_error_code']:
+            if hasattr(self.wrapped_backend, attr):
+                setattr(self, attr, getattr(self, attr[1:]))
+        self._close = self.close
+
+    def wait(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+            with self.lock:
+                self.stats['delay'] += seconds
+
+    def request(self, operation):
+        """Take the latency of a request, and maybe fail it"""
+        with self.lock:
+            self.stats['requests'] += 1
+            draw = self.random.random()
+            if draw < self.error_rate:
+                self.stats['errors'] += 1
+            elif draw < self.error_rate + self.throttle_rate:
+                self.stats['throttles'] += 1
+        self.wait(self.latency)
+        if draw < self.error_rate:
+            raise BackendException("Simulated error in %s" % operation)
+        elif draw < self.error_rate + self.throttle_rate:
+            raise TemporaryLoadException("Simulated throttling of %s" % operation,
+                                         retry_after=self.retry_after)
+
+    def changed(self, filename, exists):
+        """Note filename was put or deleted, for consistency_delay"""
+        if self.consistency_delay:
+            with self.lock:
+                self.pending[filename] = (time.time() + self.consistency_delay, exists)
+
+    def put(self, source_path, remote_filename):
+        self.request('put')
+        size = os.path.getsize(source_path.name)
+        self.wait(self.upload_link.transfer(size))
+        self.wrapped_backend._put(source_path, remote_filename)
+        with self.lock:
+            self.stats['bytes_up'] += size
+        self.changed(remote_filename, True)
+
+    def get(self, remote_filename, local_path):
+        self.request('get')
+        self.wrapped_backend._get(remote_filename, local_path)
+        size = os.path.getsize(local_path.name)
+        self.wait(self.download_link.transfer(size))
+        with self.lock:
+            self.stats['bytes_down'] += size
+
+    def list(self):
+        names = set(self.wrapped_backend._list())
+        now = time.time()
+        with self.lock:
+            for filename, (visible_at, exists) in self.pending.items():
+                if visible_at <= now:
+                    del self.pending[filename]
+                elif exists:
+                    names.discard(filename)
+                else:
+                    names.add(filename)
+        names = sorted(names)
+        pages = (len(names) - 1) // self.page_size + 1 if self.page_size else 1
+        for page in range(max(pages, 1)):
+            self.request('list')
+        return names
+
+    def delete(self, filename):
+        self.request('delete')
+        self.wrapped_backend._delete(filename)
+        self.changed(filename, False)
+
+    def delete_list(self, filename_list):
+        self.request('delete')
+        self.wrapped_backend._delete_list(filename_list)
+        for filename in filename_list:
+            self.changed(filename, False)
+
+    def query(self, filename):
+        self.request('query')
+        return self.wrapped_backend._query(filename)
+
+    def query_list(self, filename_list):
+        self.request('query')
+        return self.wrapped_backend._query_list(filename_list)
+
+    def retry_cleanup(self):
+        self.wrapped_backend._retry_cleanup()
+
+    def error_code(self, operation, e):
+        return self.wrapped_backend._error_code(operation, e)
+
+    def close(self):
+        log.Info(_("Simulated backend: %(requests)d requests, %(errors)d errors, "
+                   "%(throttles)d throttled, %(bytes_up)d bytes up, "
+                   "%(bytes_down)d bytes down, %(delay).3fs of delays") % self.stats)
+        if hasattr(self.wrapped_backend, '_close'):
+            self.wrapped_backend._close()
+
+backend.register_backend_prefix('sim', SimBackend)
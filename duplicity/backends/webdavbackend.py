@@ -25,16 +25,20 @@ import base64
 import httplib
 import os
 import re
+import socket
 import urllib
 import urllib2
 import urlparse
-import xml.dom.minidom
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
 import duplicity.backend
 from duplicity import globals
 from duplicity import log
 from duplicity import util
-from duplicity.errors import BackendException, FatalBackendException
+from duplicity.errors import BackendException, FatalBackendException, TemporaryLoadException
 
 
 class CustomMethodRequest(urllib2.Request):
@@ -121,6 +125,9 @@ class WebDAVBackend(duplicity.backend.Backend):
     """
     listbody = ""
 
+    # block size used when streaming volumes to and from the server
+    blocksize = 64 * 1024
+
     """Connect to remote store using WebDAV Protocol"""
     def __init__(self, parsed_url):
         duplicity.backend.Backend.__init__(self, parsed_url)
@@ -146,13 +153,6 @@ class WebDAVBackend(duplicity.backend.Backend):
         else:
             return '/'
 
-    def getText(self, nodelist):
-        rc = ""
-        for node in nodelist:
-            if node.nodeType == node.TEXT_NODE:
-                rc = rc + node.data
-        return rc
-
     def _retry_cleanup(self):
         self.connect(forced=True)
 
@@ -183,12 +183,77 @@ class WebDAVBackend(duplicity.backend.Backend):
         if self.conn:
             self.conn.close()
 
+    def release(self, response):
+        """
+        Consume whatever is left of the response body and close it, so
+        the persistent connection can be reused for the next request.
+        """
+        try:
+            while response.read(self.blocksize):
+                pass
+        except (httplib.HTTPException, socket.error):
+            # the connection is in an undefined state, start over next time
+            self._close()
+        response.close()
+
+    def status_error(self, response):
+        """
+        Release a response with an unexpected status and return the
+        exception to raise for it.  Servers that are overloaded or
+        throttling us may say when to try again.
+        """
+        status = response.status
+        reason = response.reason
+        retry_after = duplicity.backend.parse_retry_after(response.getheader('Retry-After'))
+        self.release(response)
+        msg = "Bad status code %s reason %s." % (status, reason)
+        if status in [429, 503]:
+            return TemporaryLoadException(msg, retry_after=retry_after)
+        return BackendException(msg)
+
+    def data_length(self, data):
+        """
+        Returns the length of a request body given as string or file object
+        """
+        if data is None:
+            return 0
+        if hasattr(data, 'fileno'):
+            return os.fstat(data.fileno()).st_size
+        return len(data)
+
+    def send(self, method, quoted_path, data):
+        """
+        Issue one request on the persistent connection.  A kept-alive
+        connection may have been dropped by the server since its last use,
+        in that case reconnect once right away instead of waiting for the
+        retry machinery.
+        """
+        reused = self.conn.sock is not None
+        if hasattr(data, 'seek'):
+            data.seek(0)
+        try:
+            self.conn.request(method, quoted_path, data, self.headers)
+            return self.conn.getresponse()
+        except (httplib.BadStatusLine, httplib.CannotSendRequest,
+                httplib.ResponseNotReady, socket.error) as e:
+            if not reused:
+                raise
+            log.Info("WebDAV kept-alive connection failed (%s), reconnecting." % util.uexc(e))
+            self.connect(forced=True)
+            if hasattr(data, 'seek'):
+                data.seek(0)
+            self.conn.request(method, quoted_path, data, self.headers)
+            return self.conn.getresponse()
+
     def request(self, method, path, data=None, redirected=0):
         """
         Wraps the connection.request method to retry once if authentication is
-        required
+        required.  The connection is kept alive between requests, so every
+        caller has to consume or release() the returned response.
+
+        data may be a string or a file object, which is then streamed to the
+        server in blocks instead of being read into memory.
         """
-        self._close()  # or we get previous request's data or exception
         self.connect()
 
         quoted_path = urllib.quote(path, "/:~")
@@ -197,14 +262,13 @@ class WebDAVBackend(duplicity.backend.Backend):
             self.headers['Authorization'] = self.get_digest_authorization(path)
 
         log.Info("WebDAV %s %s request with headers: %s " % (method, quoted_path, self.headers))
-        log.Info("WebDAV data length: %s " % len(str(data)))
-        self.conn.request(method, quoted_path, data, self.headers)
-        response = self.conn.getresponse()
+        log.Info("WebDAV data length: %s " % self.data_length(data))
+        response = self.send(method, quoted_path, data)
         log.Info("WebDAV response status %s with reason '%s'." % (response.status, response.reason))
         # resolve redirects and reset url on listing requests (they usually come before everything else)
         if response.status in [301, 302] and method == 'PROPFIND':
             redirect_url = response.getheader('location', None)
-            response.close()
+            self.release(response)
             if redirect_url:
                 log.Notice("WebDAV redirect to: %s " % urllib.unquote(redirect_url))
                 if redirected > 10:
@@ -215,14 +279,12 @@ class WebDAVBackend(duplicity.backend.Backend):
             else:
                 raise FatalBackendException("WebDAV missing location header in redirect response.")
         elif response.status == 401:
-            response.read()
-            response.close()
+            self.release(response)
             self.headers['Authorization'] = self.get_authorization(response, quoted_path)
             log.Info("WebDAV retry request with authentification headers.")
             log.Info("WebDAV %s %s request2 with headers: %s " % (method, quoted_path, self.headers))
-            log.Info("WebDAV data length: %s " % len(str(data)))
-            self.conn.request(method, quoted_path, data, self.headers)
-            response = self.conn.getresponse()
+            log.Info("WebDAV data length: %s " % self.data_length(data))
+            response = self.send(method, quoted_path, data)
             log.Info("WebDAV response2 status %s with reason '%s'." % (response.status, response.reason))
 
         return response
@@ -279,26 +341,19 @@ class WebDAVBackend(duplicity.backend.Backend):
             del self.headers['Depth']
             # if the target collection does not exist, create it.
             if response.status == 404:
-                response.close()  # otherwise next request fails with ResponseNotReady
+                self.release(response)  # otherwise next request fails with ResponseNotReady
                 self.makedir()
                 # just created an empty folder, so return empty
                 return []
-            elif response.status in [200, 207]:
-                document = response.read()
-                response.close()
-            else:
-                status = response.status
-                reason = response.reason
-                response.close()
-                raise BackendException("Bad status code %s reason %s." % (status, reason))
+            elif response.status not in [200, 207]:
+                raise self.status_error(response)
 
-            log.Debug("%s" % (document,))
-            dom = xml.dom.minidom.parseString(document)
             result = []
-            for href in dom.getElementsByTagName('d:href') + dom.getElementsByTagName('D:href'):
+            for href in self.iter_hrefs(response):
                 filename = self.taste_href(href)
                 if filename:
                     result.append(filename)
+            self.release(response)
             return result
         except Exception as e:
             raise e
@@ -306,6 +361,24 @@ class WebDAVBackend(duplicity.backend.Backend):
             if response:
                 response.close()
 
+    def iter_hrefs(self, response):
+        """
+        Incrementally parse a multistatus PROPFIND response and yield the
+        text of every DAV: href element.  Elements are discarded as soon
+        as they have been looked at, so memory use stays flat no matter
+        how many entries the collection holds.
+        """
+        context = iter(ElementTree.iterparse(response, events=("start", "end")))
+        event, root = next(context)
+        for event, elem in context:
+            if event != "end":
+                continue
+            # match on the local name, servers use different namespace prefixes
+            if elem.tag == "href" or elem.tag.endswith("}href"):
+                yield elem.text or ""
+            elif elem.tag.endswith("}response") or elem.tag == "response":
+                root.clear()
+
     def makedir(self):
         """Make (nested) directories on the server."""
         dirs = self.directory.split("/")
@@ -321,22 +394,25 @@ class WebDAVBackend(duplicity.backend.Backend):
             del self.headers['Depth']
 
             log.Info("Checking existence dir %s: %d" % (d, response.status))
+            status = response.status
+            self.release(response)
 
-            if response.status == 404:
+            if status == 404:
                 log.Info("Creating missing directory %s" % d)
 
                 res = self.request("MKCOL", d)
+                self.release(res)
                 if res.status != 201:
                     raise BackendException("WebDAV MKCOL %s failed: %s %s" % (d, res.status, res.reason))
 
     def taste_href(self, href):
         """
-        Internal helper to taste the given href node and, if
+        Internal helper to taste the given href text and, if
         it is a duplicity file, collect it as a result file.
 
         @return: A matching filename, or None if the href did not match.
         """
-        raw_filename = self.getText(href.childNodes).strip()
+        raw_filename = href.strip()
         parsed_url = urlparse.urlparse(urllib.unquote(raw_filename))
         filename = parsed_url.path
         log.Debug("webdav path decoding and translation: "
@@ -373,17 +449,15 @@ class WebDAVBackend(duplicity.backend.Backend):
             target_file = local_path.open("wb")
             response = self.request("GET", url)
             if response.status == 200:
-                # data=response.read()
-                target_file.write(response.read())
-                # import hashlib
-                # log.Info("WebDAV GOT %s bytes with md5=%s" % (len(data),hashlib.md5(data).hexdigest()) )
+                while True:
+                    buf = response.read(self.blocksize)
+                    if not buf:
+                        break
+                    target_file.write(buf)
                 assert not target_file.close()
                 response.close()
             else:
-                status = response.status
-                reason = response.reason
-                response.close()
-                raise BackendException("Bad status code %s reason %s." % (status, reason))
+                raise self.status_error(response)
         except Exception as e:
             raise e
         finally:
@@ -393,21 +467,22 @@ class WebDAVBackend(duplicity.backend.Backend):
     def _put(self, source_path, remote_filename):
         url = self.directory + remote_filename
         response = None
+        source_file = None
         try:
+            # httplib streams file objects in blocks, with the
+            # Content-Length taken from the file itself
             source_file = source_path.open("rb")
-            response = self.request("PUT", url, source_file.read())
+            response = self.request("PUT", url, source_file)
             # 200 is returned if a file is overwritten during restarting
             if response.status in [200, 201, 204]:
-                response.read()
-                response.close()
+                self.release(response)
             else:
-                status = response.status
-                reason = response.reason
-                response.close()
-                raise BackendException("Bad status code %s reason %s." % (status, reason))
+                raise self.status_error(response)
         except Exception as e:
             raise e
         finally:
+            if source_file:
+                source_file.close()
             if response:
                 response.close()
 
@@ -417,13 +492,9 @@ class WebDAVBackend(duplicity.backend.Backend):
         try:
             response = self.request("DELETE", url)
             if response.status in [200, 204]:
-                response.read()
-                response.close()
+                self.release(response)
             else:
-                status = response.status
-                reason = response.reason
-                response.close()
-                raise BackendException("Bad status code %s reason %s." % (status, reason))
+                raise self.status_error(response)
         except Exception as e:
             raise e
         finally:
@@ -434,4 +505,3 @@ duplicity.backend.register_backend("http", WebDAVBackend)
 duplicity.backend.register_backend("https", WebDAVBackend)
 duplicity.backend.register_backend("webdav", WebDAVBackend)
 duplicity.backend.register_backend("webdavs", WebDAVBackend)
-duplicity.backend.uses_netloc.extend(['http', 'https', 'webdav', 'webdavs'])
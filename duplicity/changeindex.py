@@ -0,0 +1,277 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Index of the files changed in the backup sets of a chain
+
+collection-status --file-changed looks up the sets that changed a path,
+or any path under a directory, in a sorted text file in the archive dir
+instead of reading the file lists of all the manifests of the chain.
+The index has a line per file changed in a set, so a binary search on
+its lines finds the changes of a path.  It is brought up to date with
+the chain when used, and after incremental backups once it exists.
+"""
+
+from __future__ import absolute_import
+
+import heapq
+import os
+import re
+import tempfile
+
+from duplicity import dup_time
+from duplicity import globals
+from duplicity import tempdir
+
+_header = "Duplicity change index 1\n"
+
+# Lines sorted in memory at a time when a set is added
+_run_lines = 100000
+
+_index_re = re.compile(r"^duplicity-change-index\.(.+?)(?:\.part)?$")
+_escape_re = re.compile(r"[\x00-\x20\\]")
+_unescape_re = re.compile(r"\\x([0-9a-f]{2})")
+
+
+def get_index_path(start_time):
+    """
+    Return Path of the index of the chain starting at start_time
+    """
+    return globals.archive_dir.append("duplicity-change-index.%s" %
+                                      dup_time.timetostring(start_time))
+
+
+def get_index_names(filename_list):
+    """
+    Return dictionary of change index filenames in filename_list -> start
+    times of their chains
+
+    Files left by an interrupted write of an index are included.
+    """
+    index_names = {}
+    for filename in filename_list:
+        m = _index_re.search(filename)
+        if m:
+            start_time = dup_time.stringtotime(m.group(1))
+            if start_time is not None:
+                index_names[filename] = start_time
+    return index_names
+
+
+def delete_index(start_time):
+    """
+    Delete the index of the chain starting at start_time, if there is one
+    """
+    index_path = get_index_path(start_time)
+    if index_path.exists():
+        index_path.delete()
+
+
+def encode_path(path):
+    """
+    Return path with whitespace, control bytes and backslashes escaped
+
+    Each byte is escaped on its own, so the paths under a directory
+    sort together, right after the directory itself.
+    """
+    return _escape_re.sub(lambda m: "\\x%02x" % ord(m.group()), path)
+
+
+def decode_path(s):
+    """
+    Return path encoded in s by encode_path
+    """
+    return _unescape_re.sub(lambda m: chr(int(m.group(1), 16)), s)
+
+
+def sort_lines(lines):
+    """
+    Return iterator of lines sorted
+
+    At most _run_lines are held in memory, longer runs of sorted lines
+    are kept in temp files and merged.
+    """
+    runs = []
+    run = []
+    for line in lines:
+        run.append(line)
+        if len(run) >= _run_lines:
+            run.sort()
+            fileobj = tempfile.TemporaryFile(dir=tempdir.default().dir())
+            fileobj.writelines(run)
+            fileobj.seek(0)
+            runs.append(fileobj)
+            run = []
+    run.sort()
+    if not runs:
+        return iter(run)
+    return heapq.merge(iter(run), *runs)
+
+
+class ChangeIndex:
+    """
+    Sorted index of the files changed in the sets of a chain
+
+    After a header with the times of the sets indexed, the index has a
+    line "path time action" per changed file, sorted by path and time.
+    """
+    def __init__(self, index_path):
+        """
+        ChangeIndex initializer, reading index_path if it exists
+        """
+        self.index_path = index_path
+        self.fileobj = None
+        self.times = []
+        self.start = self.end = 0
+        if index_path.exists():
+            self.open()
+
+    def open(self):
+        """
+        Open the index file and read its header
+        """
+        fileobj = self.index_path.open("rb")
+        if fileobj.readline() != _header:
+            # written by a later version, or interrupted
+            fileobj.close()
+            return
+        self.times = [int(t) for t in fileobj.readline().split()[1:]]
+        self.start = fileobj.tell()
+        fileobj.seek(0, 2)
+        self.end = fileobj.tell()
+        self.fileobj = fileobj
+
+    def close(self):
+        """
+        Close the index file
+        """
+        if self.fileobj:
+            self.fileobj.close()
+            self.fileobj = None
+        self.times = []
+
+    def lines(self):
+        """
+        Generate the lines of the index after the header
+        """
+        if self.fileobj:
+            self.fileobj.seek(self.start)
+            for line in iter(self.fileobj.readline, ""):
+                yield line
+
+    def add_sets(self, new_sets):
+        """
+        Merge new sets into the index and write it again
+
+        new_sets is a list of (time, files changed) pairs of sets newer
+        than those indexed, the files changed iterating (action, path)
+        pairs as manifest.FileList does.
+        """
+        def set_lines(time, files_changed):
+            for action, path in files_changed:
+                yield "%s %012d %s\n" % (encode_path(path), time, action)
+
+        runs = [self.lines()]
+        for time, files_changed in new_sets:
+            runs.append(sort_lines(set_lines(time, files_changed)))
+        times = self.times + [time for time, files_changed in new_sets]
+
+        part_path = self.index_path.get_parent_dir().append(
+            self.index_path.get_filename() + ".part")
+        fileobj = part_path.open("wb")
+        fileobj.write(_header)
+        fileobj.write("Sets %s\n" % " ".join("%d" % t for t in times))
+        fileobj.writelines(heapq.merge(*runs))
+        assert not fileobj.close()
+        self.close()
+        os.rename(part_path.name, self.index_path.name)
+        self.index_path.setdata()
+        self.open()
+
+    def update(self, backup_sets):
+        """
+        Bring the index up to date with backup_sets, the sets of a chain
+
+        Sets are indexed up to the first one without a local manifest.
+        The index is written again from scratch if it does not match the
+        older sets.
+        """
+        sets = []
+        for backup_set in backup_sets:
+            if not backup_set.local_manifest_path:
+                break
+            sets.append(backup_set)
+        times = [backup_set.get_time() for backup_set in sets]
+        if times[:len(self.times)] != self.times or not self.fileobj:
+            self.close()
+        new_sets = [(backup_set.get_time(), backup_set.get_files_changed())
+                    for backup_set in sets[len(self.times):]]
+        if new_sets or not self.fileobj:
+            self.add_sets(new_sets)
+
+    def find(self, key):
+        """
+        Return offset of the first line not sorting before key
+        """
+        lo, hi = self.start, self.end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            self.fileobj.seek(mid - 1)
+            self.fileobj.readline()
+            line = self.fileobj.readline()
+            if line and line < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.fileobj.seek(lo - 1)
+        self.fileobj.readline()
+        return self.fileobj.tell()
+
+    def lookup(self, filepath):
+        """
+        Return list of changes of filepath, or of the files under it
+
+        The changes are (time, action, path) tuples, sorted by path and
+        time.
+        """
+        key = encode_path(filepath.strip("/"))
+        prefixes = [key + " ", key + "/"] if key else [""]
+        changes = []
+        for prefix in prefixes:
+            self.fileobj.seek(self.find(prefix))
+            for line in iter(self.fileobj.readline, ""):
+                if not line.startswith(prefix):
+                    break
+                path, time, action = line.split()
+                changes.append((int(time), action, decode_path(path)))
+        return changes
+
+
+def add_backup(start_time, prev_time, time, files_changed):
+    """
+    Add a new set to the index of its chain, if it is up to date
+
+    The chain starts at start_time and the set follows the one at
+    prev_time.  Chains without an index are indexed when first used.
+    """
+    index = ChangeIndex(get_index_path(start_time))
+    try:
+        if index.times and index.times[-1] == prev_time:
+            index.add_sets([(time, files_changed)])
+    finally:
+        index.close()
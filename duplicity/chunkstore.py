@@ -0,0 +1,385 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Deduplicated storage of file data in content-defined chunks
+
+With --dedup the data of new files is cut into chunks at boundaries
+found in the data itself, so inserting or removing bytes only changes
+the chunks around the edit.  Each chunk is stored once, in a pack file
+next to the volumes, and the volumes hold a list of chunk references
+instead of the data.  An index in the archive dir remembers which
+chunks were stored in which pack.
+"""
+
+from __future__ import absolute_import
+
+import anydbm
+import binascii
+import collections
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+import zlib
+
+from duplicity import dup_temp
+from duplicity import file_naming
+from duplicity import globals
+from duplicity import gpg
+from duplicity import log
+from duplicity import tempdir
+from duplicity import util
+
+# A chunk ends after an anchor byte if the window of bytes up to it
+# hashes to a multiple of _boundary_mask + 1.  Newlines anchor text,
+# the other byte anchors binary data.
+_min_chunk_size = 16 * 1024
+_max_chunk_size = 256 * 1024
+_anchor_re = re.compile("[\n\x8e]")
+_window_size = 32
+_boundary_mask = 0x7f
+
+# Files smaller than this are stored in the volumes as before
+min_file_size = _min_chunk_size
+
+# Reference to a chunk: sha1, pack id, offset and length.  They have a
+# fixed size, so a restarted backup can skip into a list of them.
+_ref_format = "%40s %20s %012d %08d\n"
+_ref_size = 84
+
+_pack_re = re.compile(r"duplicity-chunks\.([0-9a-f]{20})\.pack(\.gpg|\.g|\.gz|\.z)?$")
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+def find_boundary(buf, start):
+    """
+    Return the end of the chunk starting at start in buf
+
+    Return None if buf ends before the chunk does.
+    """
+    end = min(len(buf), start + _max_chunk_size)
+    for match in _anchor_re.finditer(buf, start + _min_chunk_size, end):
+        pos = match.end()
+        if not zlib.crc32(buf[pos - _window_size:pos]) & _boundary_mask:
+            return pos
+    if start + _max_chunk_size <= len(buf):
+        return start + _max_chunk_size
+    return None
+
+
+def chunk_iter(fileobj, read_size=1024 * 1024):
+    """
+    Generate the chunks of the data in fileobj
+    """
+    buf, pos, eof = "", 0, False
+    while True:
+        end = find_boundary(buf, pos)
+        if end is None:
+            if eof:
+                if pos < len(buf):
+                    yield buf[pos:]
+                return
+            data = fileobj.read(read_size)
+            eof = not data
+            buf = buf[pos:] + data
+            pos = 0
+        else:
+            yield buf[pos:end]
+            pos = end
+
+
+def get_pack_name(pack_id):
+    """
+    Return remote filename of pack pack_id
+    """
+    return "%s%sduplicity-chunks.%s.pack%s" % (
+        globals.file_prefix, globals.file_prefix_archive, pack_id,
+        file_naming.get_suffix(globals.encryption, globals.compression))
+
+
+def get_pack_names(filename_list):
+    """
+    Return dictionary of pack ids -> pack filenames in filename_list
+    """
+    pack_names = {}
+    for filename in filename_list:
+        m = _pack_re.search(filename)
+        if m:
+            pack_names[m.group(1)] = filename
+    return pack_names
+
+
+class ChunkStore:
+    """
+    Store chunks not stored before in packs on the backend
+
+    New chunks are written to a pack, which is compressed or encrypted
+    like the volumes and uploaded with put_pack once it holds a volume
+    worth of data or on flush().  Chunks the index puts into packs no
+    longer on the backend are stored again.
+    """
+    def __init__(self, backend, index_path):
+        """
+        ChunkStore initializer
+
+        index_path is the Path of the chunk index, usually in the
+        archive dir.  put_pack(tdp, remote_filename) uploads a pack; it
+        may be replaced to upload in the background.
+        """
+        self.backend = backend
+        self.pack_ids = set(get_pack_names(backend.list()))
+        self.index = anydbm.open(index_path.name, "c")
+        self.put_pack = self.put
+        self.referenced = set()
+        self.pack = None
+        self.pack_size = 0
+        self.new_chunks, self.new_bytes = 0, 0
+        self.stored_chunks, self.stored_bytes = 0, 0
+
+    def add(self, data):
+        """
+        Store chunk data unless stored already, return its reference
+        """
+        digest = hashlib.sha1(data)
+        try:
+            pack_id, offset = self.index[digest.digest()].split()
+        except KeyError:
+            pack_id = None
+        if pack_id in self.pack_ids:
+            self.stored_chunks += 1
+            self.stored_bytes += len(data)
+            offset = int(offset)
+        else:
+            if not self.pack:
+                self.new_pack()
+            pack_id, offset = self.pack[0], self.pack_size
+            self.pack[1].write(data)
+            self.pack_size += len(data)
+            self.index[digest.digest()] = "%s %d" % (pack_id, offset)
+            self.new_chunks += 1
+            self.new_bytes += len(data)
+        self.referenced.add(pack_id)
+        ref = _ref_format % (digest.hexdigest(), pack_id, offset, len(data))
+        if self.pack_size >= globals.volsize:
+            self.flush()
+        return ref
+
+    def new_pack(self):
+        """
+        Start writing a new pack
+        """
+        pack_id = binascii.hexlify(os.urandom(10))
+        fileobj = tempfile.TemporaryFile(dir=tempdir.default().dir())
+        self.pack = (pack_id, fileobj)
+        self.pack_size = 0
+        self.pack_ids.add(pack_id)
+
+    def flush(self):
+        """
+        Upload the pack being written, if any
+        """
+        if not self.pack:
+            return
+        pack_id, fileobj = self.pack
+        self.pack = None
+        self.pack_size = 0
+        # Encrypted only now, as a gpg process started while the one of
+        # a volume is running keeps that one from seeing the end of its
+        # input.
+        tdp = dup_temp.new_temppath()
+        if globals.encryption:
+            outfp = gpg.GPGFile(True, tdp, globals.gpg_profile)
+        elif globals.compression:
+            outfp = gzip.GzipFile(tdp.name, "wb")
+        else:
+            outfp = tdp.open("wb")
+        fileobj.seek(0)
+        util.copyfileobj(fileobj, outfp)
+        fileobj.close()
+        outfp.close()
+        tdp.setdata()
+        self.put_pack(tdp, get_pack_name(pack_id))
+
+    def put(self, tdp, remote_filename):
+        """
+        Upload pack in tdp and delete it, return its size
+        """
+        size = tdp.getsize()
+        self.backend.put(tdp, remote_filename)
+        if tdp.stat:
+            tdp.delete()
+        return size
+
+    def take_referenced(self):
+        """
+        Return sorted ids of the packs referenced since the last call
+        """
+        referenced = sorted(self.referenced)
+        self.referenced = set()
+        return referenced
+
+    def close(self):
+        """
+        Upload the last pack and close the index
+        """
+        self.flush()
+        self.index.close()
+        log.Info(_("Stored %d new chunks (%d bytes), %d chunks (%d bytes) "
+                   "were stored before") % (self.new_chunks, self.new_bytes,
+                                            self.stored_chunks, self.stored_bytes))
+
+
+class ChunkRefFile:
+    """
+    File-like object reading the chunk references of infile's data
+
+    The chunks are added to store as they are read.
+    """
+    def __init__(self, infile, store):
+        self.infile = infile
+        self.store = store
+        self.chunks = chunk_iter(infile)
+        self.buf = ""
+
+    def read(self, length=-1):
+        while length < 0 or len(self.buf) < length:
+            try:
+                chunk = self.chunks.next()
+            except StopIteration:
+                break
+            self.buf += self.store.add(chunk)
+        if length < 0:
+            length = len(self.buf)
+        result, self.buf = self.buf[:length], self.buf[length:]
+        return result
+
+    def close(self):
+        return self.infile.close()
+
+
+class ChunkReader:
+    """
+    Read chunks back from the packs on the backend
+
+    The last few packs used are kept decrypted in temp files, as the
+    chunks of a file tend to be stored together.
+    """
+    cache_size = 4
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pack_names = None
+        self.packs = collections.OrderedDict()  # pack id -> temp file
+
+    def get_pack(self, pack_id):
+        """
+        Return temp file holding the data of pack pack_id
+        """
+        fp = self.packs.pop(pack_id, None)
+        if not fp:
+            if self.pack_names is None:
+                self.pack_names = get_pack_names(self.backend.list())
+            if pack_id not in self.pack_names:
+                raise ChunkStoreError("Chunk pack %s is missing" % pack_id)
+            filename = self.pack_names[pack_id]
+            tdp = dup_temp.new_temppath()
+            self.backend.get(filename, tdp)
+            if filename.endswith((".gpg", ".g")):
+                infp = gpg.GPGFile(False, tdp, globals.gpg_profile)
+            elif filename.endswith((".gz", ".z")):
+                infp = gzip.GzipFile(tdp.name, "rb")
+            else:
+                infp = tdp.open("rb")
+            fp = tempfile.TemporaryFile(dir=tempdir.default().dir())
+            util.copyfileobj(infp, fp)
+            infp.close()
+            tdp.delete()
+            while len(self.packs) >= self.cache_size:
+                self.packs.popitem(last=False)[1].close()
+        self.packs[pack_id] = fp
+        return fp
+
+    def get_chunk(self, ref):
+        """
+        Return data of the chunk with reference ref
+        """
+        hexdigest, pack_id, offset, length = ref.split()
+        fp = self.get_pack(pack_id)
+        fp.seek(int(offset))
+        data = fp.read(int(length))
+        if hashlib.sha1(data).hexdigest() != hexdigest:
+            raise ChunkStoreError("Chunk %s in pack %s is corrupt" %
+                                  (hexdigest, pack_id))
+        return data
+
+
+_reader = None
+
+
+def get_reader():
+    """
+    Return ChunkReader of globals.backend
+    """
+    global _reader
+    if not _reader or _reader.backend is not globals.backend:
+        _reader = ChunkReader(globals.backend)
+    return _reader
+
+
+class ChunkedFile:
+    """
+    File-like object reading the data of the chunk references in reffile
+    """
+    def __init__(self, reffile, reader=None):
+        self.reffile = reffile
+        self.reader = reader
+        self.buf = ""
+
+    def read_ref(self):
+        """
+        Return next reference in reffile, or "" at its end
+        """
+        ref = ""
+        while len(ref) < _ref_size:
+            buf = self.reffile.read(_ref_size - len(ref))
+            if not buf:
+                break
+            ref += buf
+        if ref and len(ref) != _ref_size:
+            raise ChunkStoreError("Truncated chunk reference %r" % ref)
+        return ref
+
+    def read(self, length=-1):
+        reader = self.reader or get_reader()
+        while length < 0 or len(self.buf) < length:
+            ref = self.read_ref()
+            if not ref:
+                break
+            self.buf += reader.get_chunk(ref)
+        if length < 0:
+            length = len(self.buf)
+        result, self.buf = self.buf[:length], self.buf[length:]
+        return result
+
+    def close(self):
+        return self.reffile.close()
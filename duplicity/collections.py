@@ -28,6 +28,8 @@ import gettext
 
 
 from duplicity import log
+from duplicity import changeindex
+from duplicity import chunkstore
 from duplicity import file_naming
 from duplicity import path
 from duplicity import util
@@ -60,7 +62,6 @@ class BackupSet:
         self.end_time = None  # will be set if inc
         self.partial = False  # true if a partial backup
         self.encrypted = False  # true if an encrypted backup
-        self.files_changed = []
 
     def is_complete(self):
         """
@@ -124,10 +125,6 @@ class BackupSet:
         self.encrypted = bool(pr.encrypted)
         self.info_set = True
 
-    def set_files_changed(self):
-        mf = self.get_manifest()
-        self.files_changed = mf.get_files_changed()
-
     def set_manifest(self, remote_filename):
         """
         Add local and remote manifest filenames to backup set
@@ -145,8 +142,6 @@ class BackupSet:
                     and pr.end_time == self.end_time):
                 self.local_manifest_path = \
                     globals.archive_dir.append(local_filename)
-
-                self.set_files_changed()
                 break
 
     def delete(self):
@@ -280,7 +275,15 @@ class BackupSet:
         assert 0, "Neither self.time nor self.end_time set"
 
     def get_files_changed(self):
-        return self.files_changed
+        """
+        Return FileList of the files changed in the set
+
+        The list is read from the local manifest as it is iterated, and
+        is empty without a local manifest.
+        """
+        if not self.local_manifest_path:
+            return manifest.FileList()
+        return manifest.read_files_changed(self.local_manifest_path.open("rb"))
 
     def __len__(self):
         """
@@ -346,6 +349,8 @@ class BackupChain:
             self.incset_list[i].delete()
         if self.fullset and not keep_full:
             self.fullset.delete()
+        # rebuilt when used if the full set is kept
+        changeindex.delete_index(self.start_time)
 
     def get_sets_at_time(self, time):
         """
@@ -604,6 +609,11 @@ class CollectionsStatus:
         self.orphaned_backup_sets = None
         self.incomplete_backup_sets = None
 
+        # Dictionary of chunk pack ids -> remote filenames
+        self.chunk_pack_names = {}
+        # Dictionary of change index filenames -> start times of their chains
+        self.change_index_names = {}
+
         # True if set_values() below has run
         self.values_set = None
 
@@ -710,6 +720,8 @@ class CollectionsStatus:
             self.get_backup_chains(partials + backend_filename_list)
         backup_chains = self.get_sorted_chains(backup_chains)
         self.all_backup_chains = backup_chains
+        self.chunk_pack_names = chunkstore.get_pack_names(backend_filename_list)
+        self.change_index_names = changeindex.get_index_names(local_filename_list)
 
         assert len(backup_chains) == len(self.all_backup_chains), "get_sorted_chains() did something more than re-ordering"
 
@@ -1035,9 +1047,53 @@ class CollectionsStatus:
             else:
                 local_filenames.extend(set_or_chain.get_filenames())
         local_filenames += self.local_orphaned_sig_names
+        local_filenames += self.get_unused_change_indexes()
         remote_filenames += self.remote_orphaned_sig_names
+        remote_filenames += self.get_unreferenced_chunk_packs()
         return local_filenames, remote_filenames
 
+    def get_unused_change_indexes(self):
+        """
+        Return list of the names of change indexes of chains that no
+        longer exist, in the archive dir
+        """
+        assert self.values_set
+        start_times = set(chain.start_time for chain in self.all_backup_chains)
+        return sorted(name for name, start_time in self.change_index_names.items()
+                      if start_time not in start_times)
+
+    def get_unreferenced_chunk_packs(self):
+        """
+        Return list of the names of chunk packs no backup set refers to
+
+        These are left behind by deleted backup chains and interrupted
+        backups.  If the manifest of a set cannot be read, no pack is
+        returned.
+        """
+        assert self.values_set
+        if not self.chunk_pack_names:
+            return []
+        sets = self.orphaned_backup_sets + self.incomplete_backup_sets
+        for chain in self.all_backup_chains:
+            sets.extend(chain.get_all_sets())
+        referenced = set()
+        for backup_set in sets:
+            if not backup_set.remote_manifest_name and not backup_set.local_manifest_path:
+                continue
+            try:
+                mf = backup_set.get_manifest()
+            except Exception as e:
+                mf = None
+                log.Debug(u"%s" % util.uexc(e))
+            if not mf:
+                log.Warn(_("Could not read manifest of backup set %s, "
+                           "keeping all chunk packs") % backup_set.get_timestr())
+                return []
+            for vi in mf.volume_info_dict.values():
+                referenced.update(vi.chunk_packs)
+        return [name for pack_id, name in sorted(self.chunk_pack_names.items())
+                if pack_id not in referenced]
+
     def sort_sets(self, setlist):
         """Return new list containing same elems of setlist, sorted by time"""
         pairs = [(s.get_time(), s) for s in setlist]
@@ -1167,22 +1223,27 @@ class CollectionsStatus:
     def get_file_changed_record(self, filepath):
         """
         Returns time line of specified file changed
+
+        If filepath is a directory, the changes of the files under it
+        are listed too.  They are looked up in the change index of the
+        chain, which is brought up to date first.
         """
         if not self.matched_chain_pair:
             return ""
 
-        all_backup_set = self.matched_chain_pair[1].get_all_sets()
-        specified_file_backup_set = []
-        specified_file_backup_type = []
-
-        for bs in all_backup_set:
-            filelist = [fileinfo[1] for fileinfo in bs.get_files_changed()]
-            if filepath in filelist:
-                specified_file_backup_set.append(bs)
-                index = filelist.index(filepath)
-                specified_file_backup_type.append(bs.get_files_changed()[index][0])
+        backup_chain = self.matched_chain_pair[1]
+        all_backup_set = backup_chain.get_all_sets()
+        index = changeindex.ChangeIndex(
+            changeindex.get_index_path(backup_chain.start_time))
+        try:
+            index.update(all_backup_set)
+            changes = index.lookup(filepath)
+        finally:
+            index.close()
 
-        return FileChangedStatus(filepath, list(zip(specified_file_backup_type, specified_file_backup_set)))
+        set_dict = dict((bs.get_time(), bs) for bs in all_backup_set)
+        return FileChangedStatus(filepath, [(action, set_dict[time], path)
+                                            for time, action, path in changes])
 
 
 class FileChangedStatus:
@@ -1204,7 +1265,11 @@ class FileChangedStatus:
                 type = _("Full")
             else:
                 type = _("Incremental")
-            l.append(set_schema % (type, dup_time.timetopretty(backup_set.get_time()), backup_type.title()))
+            line = set_schema % (type, dup_time.timetopretty(backup_set.get_time()), backup_type.title())
+            if len(s) > 2 and s[2] != self.filepath.strip("/"):
+                # file under the directory asked for
+                line += "  %s" % s[2]
+            l.append(line)
 
         l.append("-------------------------")
         return "\n".join(l)
@@ -42,6 +42,7 @@ from duplicity import gpg
 from duplicity import log
 from duplicity import path
 from duplicity import selection
+from duplicity import timing
 from duplicity import util
 
 
@@ -286,6 +287,9 @@ def parse_cmdline_options(arglist):
 
     parser.add_option("--compare-data", action="store_true")
 
+    # verify against the signatures, without downloading the volumes
+    parser.add_option("--fast-verify", action="store_true")
+
     # config dir for future use
     parser.add_option("--config-dir", type="file", metavar=_("path"),
                       help=optparse.SUPPRESS_HELP)
@@ -294,6 +298,9 @@ def parse_cmdline_options(arglist):
     parser.add_option("--current-time", type="int",
                       dest="current_time", help=optparse.SUPPRESS_HELP)
 
+    # Store new files as chunks, uploading only chunks not stored yet
+    parser.add_option("--dedup", action="store_true")
+
     # Don't actually do anything, but still report what would be done
     parser.add_option("--dry-run", action="store_true")
 
@@ -353,6 +360,9 @@ def parse_cmdline_options(arglist):
     # Whether we should be particularly aggressive when cleaning up
     parser.add_option("--extra-clean", action="store_true")
 
+    # diff the extents of large files in this many threads
+    parser.add_option("--extent-workers", type="int", metavar=_("number"))
+
     # used in testing only - raises exception after volume
     parser.add_option("--fail-on-volume", type="int",
                       help=optparse.SUPPRESS_HELP)
@@ -369,6 +379,12 @@ def parse_cmdline_options(arglist):
     # used to provide a suffix for sigature files only
     parser.add_option("--file-prefix-signature", type="string", dest="file_prefix_signature", action="store")
 
+    # write restored files in this many threads
+    parser.add_option("--restore-writers", type="int", metavar=_("number"))
+
+    # restore only the files that differ from the backup
+    parser.add_option("--skip-unchanged", action="store_true")
+
     # used in testing only - skips upload for a given volume
     parser.add_option("--skip-volume", type="int",
                       help=optparse.SUPPRESS_HELP)
@@ -454,6 +470,11 @@ def parse_cmdline_options(arglist):
     # Maximum block size for large files
     parser.add_option("--max-blocksize", type="int", metavar=_("number"))
 
+    # Memory in MB for the signature of one file while making its delta
+    parser.add_option("--max-signature-memory", type="int", action="callback", metavar=_("number"),
+                      callback=lambda o, s, v, p: setattr(p.values, "max_signature_memory",
+                                                          v * 1024 * 1024))
+
     # TRANSL: Used in usage help (noun)
     parser.add_option("--name", dest="backup_name", metavar=_("backup name"))
 
@@ -511,6 +532,12 @@ def parse_cmdline_options(arglist):
     # duplicity remove-older-than time [options] target_url
     parser.add_option("--restore-time", "--time", "-t", type="time", metavar=_("time"))
 
+    # limit the number of retries during the whole run
+    parser.add_option("--retry-budget", type="int", metavar=_("number"))
+
+    # seconds to wait before the first retry of a network operation
+    parser.add_option("--retry-delay", type="int", metavar=_("seconds"))
+
     # user added rsync options
     parser.add_option("--rsync-options", action="extend", metavar=_("options"))
 
@@ -590,6 +617,12 @@ def parse_cmdline_options(arglist):
     # --timeout <seconds>
     parser.add_option("--timeout", type="int", metavar=_("seconds"))
 
+    # write the time spent in each stage as JSON to this file
+    parser.add_option("--timing-file", type="file", metavar=_("path"))
+
+    # write a Chrome trace of the stages to this file
+    parser.add_option("--trace-file", type="file", metavar=_("path"))
+
     # Character used like the ":" in time strings like
     # 2002-08-06T04:22:00-07:00.  The colon isn't good for filenames on
     # windows machines.
@@ -605,6 +638,9 @@ def parse_cmdline_options(arglist):
                       dest="", action="callback",
                       callback=lambda o, s, v, p: log.setverbosity(v))
 
+    # read local files on verify --compare-data in this many threads
+    parser.add_option("--verify-readers", type="int", metavar=_("number"))
+
     parser.add_option("-V", "--version", action="callback", callback=print_ver)
 
     # volume size
@@ -953,7 +989,7 @@ def set_selection():
     global select_opts, select_files
     sel = selection.Select(globals.local_path)
     sel.ParseArgs(select_opts, select_files)
-    globals.select = sel.set_iter()
+    globals.select = timing.timed_iter("select", sel.set_iter())
 
 
 def args_to_path_backend(arg1, arg2):
@@ -1068,8 +1104,8 @@ def ProcessCommandLine(cmdline_list):
 
     args = parse_cmdline_options(cmdline_list)
 
-    # we can now try to import all the backends
-    backend.import_backends()
+    if globals.timing_file or globals.trace_file:
+        timing.start(globals.trace_file is not None)
 
     # parse_cmdline_options already verified that we got exactly 1 or 2
     # non-options arguments
@@ -27,12 +27,21 @@ first, the signature or delta is constructed of a ROPath iterator.  In
 the second, the ROPath iterator is put into tar block form.
 """
 
+from __future__ import absolute_import
 from future_builtins import map
 
+import anydbm
 import cStringIO
+import hashlib
+import os
+import shutil
+import tempfile
 import types
 import math
+from duplicity import chunkstore
+from duplicity import tempdir
 from duplicity import statistics
+from duplicity import timing
 from duplicity import util
 from duplicity import globals
 from duplicity.path import *  # @UnusedWildImport
@@ -43,6 +52,15 @@ from duplicity import progress
 stats = None
 tracker = None
 
+# Bytes at the start of a file hashed into its fingerprint
+_fingerprint_size = 64 * 1024
+
+# Most paths with the same fingerprint a new file is matched against
+_max_move_sources = 64
+
+# Rough bytes of memory librsync needs per block of a loaded signature
+_sig_memory_per_block = 64
+
 
 class DiffDirException(Exception):
     pass
@@ -67,11 +85,12 @@ def DirFull(path_iter):
     return DirDelta(path_iter, cStringIO.StringIO(""))
 
 
-def DirFull_WriteSig(path_iter, sig_outfp):
+def DirFull_WriteSig(path_iter, sig_outfp, chunk_store=None):
     """
     Return full backup like above, but also write signature to sig_outfp
     """
-    return DirDelta_WriteSig(path_iter, cStringIO.StringIO(""), sig_outfp)
+    return DirDelta_WriteSig(path_iter, cStringIO.StringIO(""), sig_outfp,
+                             chunk_store)
 
 
 def DirDelta(path_iter, dirsig_fileobj_list):
@@ -109,34 +128,56 @@ def delta_iter_error_handler(exc, new_path, sig_path, sig_tar=None):
     return None
 
 
-def get_delta_path(new_path, sig_path, sigTarFile=None):
+def get_delta_path(new_path, sig_path, sigTarFile=None, chunk_store=None):
     """
     Return new delta_path which, when read, writes sig to sig_fileobj,
     if sigTarFile is not None
+
+    New regular files are read as chunk references (difftype
+    "chunked") if chunk_store is given.
     """
     assert new_path
     if sigTarFile:
         ti = new_path.get_tarinfo()
         index = new_path.index
     delta_path = new_path.get_ropath()
-    log.Debug(_("Getting delta of %s and %s") % (new_path, sig_path))
+    if log.IsEnabled(log.DEBUG):
+        log.Debug(_("Getting delta of %s and %s") % (new_path, sig_path))
 
-    def callback(sig_string):
+    def callback(sig_fp, fingerprint):
         """
         Callback activated when FileWithSignature read to end
         """
-        ti.size = len(sig_string)
+        sig_fp.seek(0, 2)
+        ti.size = sig_fp.tell()
+        sig_fp.seek(0)
         ti.name = "signature/" + "/".join(index)
-        sigTarFile.addfile(ti, cStringIO.StringIO(sig_string))
+        # unused for regular files, older versions ignore it
+        ti.linkname = fingerprint
+        sigTarFile.addfile(ti, sig_fp)
+        sig_fp.close()
 
     if new_path.isreg() and sig_path and sig_path.isreg() and sig_path.difftype == "signature":
-        delta_path.difftype = "diff"
+        if sig_path.index == new_path.index:
+            delta_path.difftype = "diff"
+        else:
+            delta_path.difftype = "moved"
+            delta_path.basis_index = sig_path.index
         old_sigfp = sig_path.open("rb")
-        newfp = FileWithReadCounter(new_path.open("rb"))
-        if sigTarFile:
-            newfp = FileWithSignature(newfp, callback,
-                                      new_path.getsize())
-        delta_path.setfileobj(librsync.DeltaFile(old_sigfp, newfp))
+        extent_size = None
+        if globals.extent_workers > 1:
+            extent_size, old_sigfp = librsync.peek_extent_size(old_sigfp)
+        if (extent_size and
+                extent_size == get_extent_size(get_block_size(new_path.getsize())) and
+                new_path.getsize() > extent_size):
+            delta_path.setfileobj(ParallelDeltaFile(new_path, old_sigfp,
+                                                    sigTarFile and callback))
+        else:
+            newfp = FileWithReadCounter(new_path.open_sparse())
+            if sigTarFile:
+                newfp = FileWithSignature(newfp, callback,
+                                          new_path.getsize())
+            delta_path.setfileobj(librsync.get_delta_file(old_sigfp, newfp))
     else:
         delta_path.difftype = "snapshot"
         if sigTarFile:
@@ -147,10 +188,13 @@ def get_delta_path(new_path, sig_path, sigTarFile=None):
             if stats:
                 stats.SourceFileSize += delta_path.getsize()
         else:
-            newfp = FileWithReadCounter(new_path.open("rb"))
+            newfp = FileWithReadCounter(new_path.open_sparse())
             if sigTarFile:
                 newfp = FileWithSignature(newfp, callback,
                                           new_path.getsize())
+            if chunk_store and new_path.getsize() >= chunkstore.min_file_size:
+                delta_path.difftype = "chunked"
+                newfp = chunkstore.ChunkRefFile(newfp, chunk_store)
             delta_path.setfileobj(newfp)
     new_path.copy_attribs(delta_path)
     delta_path.stat.st_size = new_path.stat.st_size
@@ -161,23 +205,35 @@ def log_delta_path(delta_path, new_path=None, stats=None):
     """
     Look at delta path and log delta.  Add stats if new_path is set
     """
-    if delta_path.difftype == "snapshot":
+    if delta_path.difftype == "moved":
+        if new_path and stats:
+            stats.add_moved_file(new_path, delta_path.basis_index)
+        if log.IsEnabled(log.INFO):
+            log.Info(_("A %s (moved from %s)") %
+                     (util.ufn(delta_path.get_relative_path()),
+                      util.ufn("/".join(delta_path.basis_index))),
+                     log.InfoCode.diff_file_new,
+                     util.escape(delta_path.get_relative_path()))
+    elif delta_path.difftype in ("snapshot", "chunked"):
         if new_path and stats:
             stats.add_new_file(new_path)
-        log.Info(_("A %s") %
-                 (util.ufn(delta_path.get_relative_path())),
-                 log.InfoCode.diff_file_new,
-                 util.escape(delta_path.get_relative_path()))
+        if log.IsEnabled(log.INFO):
+            log.Info(_("A %s") %
+                     (util.ufn(delta_path.get_relative_path())),
+                     log.InfoCode.diff_file_new,
+                     util.escape(delta_path.get_relative_path()))
     else:
         if new_path and stats:
             stats.add_changed_file(new_path)
-        log.Info(_("M %s") %
-                 (util.ufn(delta_path.get_relative_path())),
-                 log.InfoCode.diff_file_changed,
-                 util.escape(delta_path.get_relative_path()))
+        if log.IsEnabled(log.INFO):
+            log.Info(_("M %s") %
+                     (util.ufn(delta_path.get_relative_path())),
+                     log.InfoCode.diff_file_changed,
+                     util.escape(delta_path.get_relative_path()))
 
 
-def get_delta_iter(new_iter, sig_iter, sig_fileobj=None):
+def get_delta_iter(new_iter, sig_iter, sig_fileobj=None, chunk_store=None,
+                   sig_infp_func=None):
     """
     Generate delta iter from new Path iter and sig Path iter.
 
@@ -186,36 +242,52 @@ def get_delta_iter(new_iter, sig_iter, sig_fileobj=None):
     instead of Paths.
 
     If sig_fileobj is not None, will also write signatures to sig_fileobj.
+    New files are then matched against the fingerprints of deleted
+    files, and stored as difftype "moved" deltas of the deleted file's
+    signature if one matches, see MoveSources.  sig_infp_func, if
+    given, returns the signature fileobjs sig_iter reads again, to match
+    files deleted after the new one too.  New files are stored in
+    chunk_store if it is given.
     """
     collated = collate2iters(new_iter, sig_iter)
     if sig_fileobj:
         sigTarFile = util.make_tarfile("w", sig_fileobj)
+        moved_from = MoveSources(sig_infp_func)
     else:
         sigTarFile = None
+        moved_from = None
+    debug = log.IsEnabled(log.DEBUG)
+    info = log.IsEnabled(log.INFO)
     for new_path, sig_path in collated:
-        log.Debug(_("Comparing %s and %s") % (new_path and util.uindex(new_path.index),
-                                              sig_path and util.uindex(sig_path.index)))
+        if debug:
+            log.Debug(_("Comparing %s and %s") % (new_path and util.uindex(new_path.index),
+                                                  sig_path and util.uindex(sig_path.index)))
         if not new_path or not new_path.type:
             # File doesn't exist (but ignore attempts to delete base dir;
             # old versions of duplicity could have written out the sigtar in
             # such a way as to fool us; LP: #929067)
             if sig_path and sig_path.exists() and sig_path.index != ():
                 # but signature says it did
-                log.Info(_("D %s") %
-                         (util.ufn(sig_path.get_relative_path())),
-                         log.InfoCode.diff_file_deleted,
-                         util.escape(sig_path.get_relative_path()))
+                if info:
+                    log.Info(_("D %s") %
+                             (util.ufn(sig_path.get_relative_path())),
+                             log.InfoCode.diff_file_deleted,
+                             util.escape(sig_path.get_relative_path()))
                 if sigTarFile:
                     ti = ROPath(sig_path.index).get_tarinfo()
                     ti.name = "deleted/" + "/".join(sig_path.index)
                     sigTarFile.addfile(ti)
+                    moved_from.add(sig_path)
                 stats.add_deleted_file(sig_path)
                 yield ROPath(sig_path.index)
         elif not sig_path or new_path != sig_path:
+            if not sig_path and moved_from:
+                sig_path = moved_from.match(new_path)
             # Must calculate new signature and create delta
             delta_path = robust.check_common_error(delta_iter_error_handler,
                                                    get_delta_path,
-                                                   (new_path, sig_path, sigTarFile))
+                                                   (new_path, sig_path, sigTarFile,
+                                                    chunk_store))
             if delta_path:
                 # log and collect stats
                 log_delta_path(delta_path, new_path, stats)
@@ -228,6 +300,219 @@ def get_delta_iter(new_iter, sig_iter, sig_fileobj=None):
     stats.close()
     if sigTarFile:
         sigTarFile.close()
+        moved_from.close()
+
+
+class MoveSources:
+    """
+    Signatures of files new files may have been moved or renamed from
+
+    If sig_infp_func is given, it returns the signature fileobjs again.
+    The paths of all regular files in them are indexed by fingerprint
+    before the first new file is matched, and a second signature
+    iterator reads ahead of the delta iterator to get the signatures of
+    paths sorting after the new file.  Signatures of deleted files are
+    spooled, for new files sorting after them.  Otherwise only files
+    deleted before a new one is found are matched.
+
+    The index and the spool are kept on disk, in a directory removed by
+    close(), so their size is not bounded by memory.  Each old path is
+    matched by one new file at most, and only if it is no longer in the
+    source directory, as restore needs the old data of the path.
+    """
+    def __init__(self, sig_infp_func=None):
+        self.sig_infp_func = sig_infp_func
+        self.dir = None
+        # "f" + fingerprint -> paths joined by "\0", "s" + file size -> "",
+        # "d" + path -> offset and length of its spooled signature
+        self.db = None
+        self.spool = None
+        self.indexed = False
+        self.ahead_iter = None
+        self.ahead = None
+
+    def open(self):
+        """Make directory holding index and spool"""
+        if not self.dir:
+            self.dir = tempfile.mkdtemp(dir=tempdir.default().dir())
+            self.db = anydbm.open(os.path.join(self.dir, "index"), "n")
+            self.spool = open(os.path.join(self.dir, "spool"), "w+b")
+
+    def close(self):
+        """Remove index and spool"""
+        if self.dir:
+            self.db.close()
+            self.spool.close()
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+        self.ahead_iter = self.ahead = None
+
+    def add_source(self, fingerprint, index):
+        """Index path index under fingerprint"""
+        key = "f" + fingerprint
+        paths = self.db[key].split("\0") if key in self.db else []
+        if len(paths) < _max_move_sources:
+            self.db[key] = "\0".join(paths + ["/".join(index)])
+            self.db["s%d" % get_fingerprint_size(fingerprint)] = ""
+
+    def remove_source(self, fingerprint, index):
+        """Stop matching path index"""
+        key = "f" + fingerprint
+        paths = self.db[key].split("\0")
+        paths.remove("/".join(index))
+        if paths:
+            self.db[key] = "\0".join(paths)
+        else:
+            del self.db[key]
+
+    def build_index(self):
+        """Index the paths of all regular files in the signatures"""
+        self.open()
+        self.indexed = True
+        if not self.sig_infp_func:
+            return
+        log.Info(_("Indexing signatures of files that may have been moved"))
+        for sig_path in get_combined_path_iter(self.sig_infp_func()):
+            if is_move_source(sig_path):
+                self.add_source(sig_path.fingerprint, sig_path.index)
+
+    def add(self, sig_path):
+        """Spool signature of deleted sig_path if it may have been moved"""
+        if not is_move_source(sig_path):
+            return
+        self.open()
+        if not self.indexed or not self.sig_infp_func:
+            self.add_source(sig_path.fingerprint, sig_path.index)
+        elif "f" + sig_path.fingerprint not in self.db:
+            return
+        self.spool.seek(0, 2)
+        offset = self.spool.tell()
+        fp = sig_path.open("rb")
+        util.copyfileobj(fp, self.spool)
+        fp.close()
+        self.db["d" + "/".join(sig_path.index)] = "%d:%d" % (offset, self.spool.tell() - offset)
+
+    def get_spooled(self, index, fingerprint):
+        """Return spooled signature of index, or None"""
+        key = "d" + "/".join(index)
+        if key not in self.db:
+            return None
+        offset, length = map(int, self.db[key].split(":"))
+        del self.db[key]
+        self.spool.seek(offset)
+        return get_move_sig_path(index, fingerprint, self.spool.read(length))
+
+    def get_ahead(self, index, fingerprint):
+        """Return signature of index read ahead, or None
+
+        The paths asked for must increase, as they do when a directory
+        is renamed; earlier ones are not found.
+        """
+        if not self.sig_infp_func:
+            return None
+        if not self.ahead_iter:
+            self.ahead_iter = get_combined_path_iter(self.sig_infp_func())
+            self.ahead = next(self.ahead_iter, None)
+        while self.ahead and self.ahead.index < index:
+            self.ahead = next(self.ahead_iter, None)
+        if (not self.ahead or self.ahead.index != index or
+                not is_move_source(self.ahead) or
+                self.ahead.fingerprint != fingerprint):
+            return None
+        return get_move_sig_path(index, fingerprint, self.ahead.get_data())
+
+    def match(self, new_path):
+        """Return signature new_path may have been moved from, or None"""
+        if not new_path.isreg() or not new_path.getsize():
+            return None
+        if not self.indexed:
+            self.build_index()
+        if "s%d" % new_path.getsize() not in self.db:
+            return None
+        try:
+            fp = new_path.open("rb")
+            try:
+                first_block = fp.read(_fingerprint_size)
+            finally:
+                fp.close()
+        except (IOError, OSError):
+            return None
+        fingerprint = get_fingerprint(new_path.getsize(), first_block)
+        if "f" + fingerprint not in self.db:
+            return None
+        for path in self.db["f" + fingerprint].split("\0"):
+            index = tuple(path.split("/"))
+            if index < new_path.index:
+                sig_path = self.get_spooled(index, fingerprint)
+            elif not new_path.new_index(index).exists():
+                sig_path = self.get_ahead(index, fingerprint)
+            else:
+                sig_path = None
+            if sig_path:
+                self.remove_source(fingerprint, index)
+                return sig_path
+        return None
+
+
+def is_move_source(sig_path):
+    """True if sig_path is the signature of a file that can be moved"""
+    return (sig_path.isreg() and sig_path.difftype == "signature" and
+            bool(sig_path.fingerprint) and
+            bool(get_fingerprint_size(sig_path.fingerprint)))
+
+
+def get_move_sig_path(index, fingerprint, sig_string):
+    """Return signature ROPath of index holding sig_string"""
+    sig_path = ROPath(index)
+    sig_path.type = "reg"
+    sig_path.difftype = "signature"
+    sig_path.fingerprint = fingerprint
+    sig_path.setfileobj(cStringIO.StringIO(sig_string))
+    return sig_path
+
+
+def get_fingerprint(size, first_block, data_hash=None):
+    """
+    Return fingerprint of file of given size, starting with first_block
+
+    first_block holds the first _fingerprint_size bytes of the file.
+    data_hash, the sha1 hexdigest of all its data, is appended if given,
+    see split_fingerprint.
+    """
+    if data_hash:
+        return "%d:%s:%s" % (size, hashlib.sha1(first_block).hexdigest(), data_hash)
+    return "%d:%s" % (size, hashlib.sha1(first_block).hexdigest())
+
+
+def split_fingerprint(fingerprint):
+    """
+    Return fingerprint without the data hash, and the data hash or None
+    """
+    fields = fingerprint.split(":")
+    if len(fields) > 2:
+        return ":".join(fields[:2]), fields[2]
+    return fingerprint, None
+
+
+def get_data_hash(fileobj):
+    """
+    Return sha1 hexdigest of the data of fileobj, which is closed
+    """
+    data_hash = hashlib.sha1()
+    while True:
+        buf = fileobj.read(librsync.job_buffer_size)
+        if not buf:
+            break
+        data_hash.update(buf)
+    assert not fileobj.close()
+    return data_hash.hexdigest()
+
+
+def get_fingerprint_size(fingerprint):
+    """
+    Return file size stored in fingerprint
+    """
+    return int(fingerprint.split(":")[0])
 
 
 def sigtar2path_iter(sigtarobj):
@@ -256,6 +541,7 @@ def sigtar2path_iter(sigtarobj):
             ropath.init_from_tarinfo(tarinfo)
             if ropath.isreg():
                 ropath.setfileobj(tf.extractfile(tarinfo))
+                ropath.fingerprint, ropath.data_hash = split_fingerprint(tarinfo.linkname)
         yield ropath
     sigtarobj.close()
 
@@ -354,13 +640,17 @@ def combine_path_iters(path_iter_list):
         refresh_triple_list(triple_list)
 
 
-def DirDelta_WriteSig(path_iter, sig_infp_list, newsig_outfp):
+def DirDelta_WriteSig(path_iter, sig_infp_list, newsig_outfp,
+                      chunk_store=None, sig_infp_func=None):
     """
     Like DirDelta but also write signature into sig_fileobj
 
     Like DirDelta, sig_infp_list can be a tar fileobj or a sorted list
     of those.  A signature will only be written to newsig_outfp if it
-    is different from (the combined) sig_infp_list.
+    is different from (the combined) sig_infp_list.  If chunk_store is
+    given, the data of new files is stored in it as chunks.
+    sig_infp_func returns a list like sig_infp_list, opened again, for
+    finding moved files, see get_delta_iter.
     """
     global stats
     stats = statistics.StatsDeltaProcess()
@@ -368,7 +658,8 @@ def DirDelta_WriteSig(path_iter, sig_infp_list, newsig_outfp):
         sig_path_iter = get_combined_path_iter(sig_infp_list)
     else:
         sig_path_iter = sigtar2path_iter(sig_infp_list)
-    delta_iter = get_delta_iter(path_iter, sig_path_iter, newsig_outfp)
+    delta_iter = get_delta_iter(path_iter, sig_path_iter, newsig_outfp,
+                                chunk_store, sig_infp_func)
     if globals.dry_run or (globals.progress and not progress.tracker.has_collected_evidence()):
         return DummyBlockIter(delta_iter)
     else:
@@ -391,11 +682,13 @@ class FileWithReadCounter:
         self.infile = infile
 
     def read(self, length=-1):
+        step = timing.begin("read")
         try:
             buf = self.infile.read(length)
         except IOError as ex:
             buf = ""
             log.Warn(_("Error %s getting delta for %s") % (str(ex), util.ufn(self.infile.name)))
+        timing.end(step, len(buf))
         if stats:
             stats.SourceFileSize += len(buf)
         return buf
@@ -404,6 +697,78 @@ class FileWithReadCounter:
         return self.infile.close()
 
 
+class ExtentReader:
+    """
+    File-like object reading a file from offset on, in a worker thread
+
+    Like FileWithReadCounter, read errors end the data, but the amount
+    read is counted by ParallelDeltaFile, outside the threads.
+    """
+    def __init__(self, path, offset):
+        self.infile = path.open("rb")
+        self.infile.seek(offset)
+
+    def read(self, length=-1):
+        try:
+            return self.infile.read(length)
+        except IOError as ex:
+            log.Warn(_("Error %s getting delta for %s") % (str(ex), util.ufn(self.infile.name)))
+            return ""
+
+    def close(self):
+        return self.infile.close()
+
+
+class ParallelDeltaFile:
+    """
+    Delta of new_path against an extent signature, made by threads
+
+    The extents of new_path are read, diffed and signed by
+    globals.extent_workers threads at once, which each need memory for
+    one extent's signature and temp space for one extent's delta.
+    When read to the end the callback, if any, is called like
+    FileWithSignature's.
+    """
+    def __init__(self, new_path, sig_fileobj, callback=None):
+        """
+        ParallelDeltaFile initializer
+
+        sig_fileobj is the extent signature of the old file, and the
+        new signature has the same extent length.
+        """
+        self.new_path, self.callback = new_path, callback
+        self.sig_gen = None
+        if callback:
+            self.sig_gen = get_sig_generator(new_path.getsize())
+        self.delta = librsync.ParallelExtentDeltaFile(
+            sig_fileobj, lambda offset: ExtentReader(new_path, offset),
+            globals.extent_workers,
+            lambda: tempfile.TemporaryFile(dir=tempdir.default().dir()),
+            self.sig_gen)
+        self.counted = 0
+        self.activated_callback = None
+
+    def read(self, length=-1):
+        buf = self.delta.read(length)
+        if stats:
+            stats.SourceFileSize += self.delta.length - self.counted
+        self.counted = self.delta.length
+        return buf
+
+    def close(self):
+        # Make sure all of the file is diffed
+        if self.callback and not self.activated_callback:
+            while self.read(librsync.job_buffer_size):
+                pass
+            self.activated_callback = 1
+            fp = self.new_path.open("rb")
+            first_block = fp.read(_fingerprint_size)
+            fp.close()
+            self.callback(self.sig_gen.getsig_file(),
+                          get_fingerprint(self.delta.length, first_block))
+        return self.delta.close()
+
+
 class FileWithSignature:
     """
     File-like object which also computes signature as it is read
@@ -416,19 +781,29 @@ class FileWithSignature:
 
         The object will act like infile, but whenever it is read it
         add infile's data to a SigGenerator object.  When the file has
-        been read to the end the callback will be called with the
-        calculated signature, and any extra_args if given.
+        been read to the end the callback will be called with a file
+        object holding the calculated signature, the fingerprint of the
+        file including the sha1 of its data, and any extra_args if
+        given.
 
-        filelen is used to calculate the block size of the signature.
+        filelen is used to calculate the block size of the signature,
+        and whether it is an extent signature.
         """
         self.infile, self.callback = infile, callback
-        self.sig_gen = librsync.SigGenerator(get_block_size(filelen))
+        self.sig_gen = get_sig_generator(filelen)
         self.activated_callback = None
         self.extra_args = extra_args
+        self.first_block = ""
+        self.length = 0
+        self.data_hash = hashlib.sha1()
 
     def read(self, length=-1):
         buf = self.infile.read(length)
         self.sig_gen.update(buf)
+        self.data_hash.update(buf)
+        if len(self.first_block) < _fingerprint_size:
+            self.first_block += buf[:_fingerprint_size - len(self.first_block)]
+        self.length += len(buf)
         return buf
 
     def close(self):
@@ -437,7 +812,14 @@ class FileWithSignature:
             while self.read(self.blocksize):
                 pass
             self.activated_callback = 1
-            self.callback(self.sig_gen.getsig(), *self.extra_args)
+            if isinstance(self.sig_gen, librsync.ExtentSigGenerator):
+                sig_fp = self.sig_gen.getsig_file()
+            else:
+                sig_fp = cStringIO.StringIO(self.sig_gen.getsig())
+            self.callback(sig_fp,
+                          get_fingerprint(self.length, self.first_block,
+                                          self.data_hash.hexdigest()),
+                          *self.extra_args)
         return self.infile.close()
 
 
@@ -507,6 +889,19 @@ class TarBlockIter:
         XXX  # Override in subclass @UndefinedVariable
 
     def next(self):
+        """
+        Return next block, timed as the tarblock stage
+        """
+        step = timing.begin("tarblock")
+        nbytes = 0
+        try:
+            result = self.next_block()
+            nbytes = len(result.data)
+            return result
+        finally:
+            timing.end(step, nbytes)
+
+    def next_block(self):
         """
         Return next block and update offset
         """
@@ -610,16 +1005,52 @@ class SigTarBlockIter(TarBlockIter):
         """
         ti = path.get_tarinfo()
         if path.isreg():
-            sfp = librsync.SigFile(path.open("rb"),
-                                   get_block_size(path.getsize()))
-            sigbuf = sfp.read()
-            sfp.close()
+            sfp = get_signature(path.open_sparse(), path.getsize())
+            sfp.seek(0, 2)
+            size = sfp.tell()
+            sfp.seek(0)
             ti.name = "signature/" + "/".join(path.index)
-            return self.tarinfo2tarblock(path.index, ti, sigbuf)
+            return self.tarinfo2tarblock_fileobj(path.index, ti, sfp, size)
         else:
             ti.name = "snapshot/" + "/".join(path.index)
             return self.tarinfo2tarblock(path.index, ti)
 
+    def tarinfo2tarblock_fileobj(self, index, tarinfo, fileobj, size):
+        """
+        Make tarblock of the header of tarinfo, for size bytes of fileobj
+
+        The data of fileobj comes in the tarblocks of process_continued,
+        so a signature is never held in memory whole.
+        """
+        tarinfo.size = size
+        if size:
+            self.process_fp, self.process_left = fileobj, size
+            self.process_size = size
+            self.process_index = index
+            self.process_waiting = True
+        else:
+            fileobj.close()
+        return TarBlock(index, tarinfo.tobuf(errors='replace'))
+
+    def process_continued(self):
+        """
+        Return tarblock of the next part of the signature being written
+        """
+        assert self.process_waiting
+        buf = self.process_fp.read(min(self.get_read_size(), self.process_left))
+        if not buf:
+            raise DiffDirException("Signature of %s is shorter than its size" %
+                                   util.ufn("/".join(self.process_index)))
+        self.process_left -= len(buf)
+        if not self.process_left:
+            self.process_fp.close()
+            self.process_fp = None
+            self.process_waiting = False
+            remainder = self.process_size % tarfile.BLOCKSIZE
+            if remainder:
+                buf += "\0" * (tarfile.BLOCKSIZE - remainder)
+        return TarBlock(self.process_index, buf)
+
 
 class DeltaTarBlockIter(TarBlockIter):
     """
@@ -652,6 +1083,9 @@ class DeltaTarBlockIter(TarBlockIter):
                 add_prefix(ti, "snapshot")
             return self.tarinfo2tarblock(index, ti)
 
+        if delta_ropath.difftype == "moved":
+            ti.linkname = "/".join(delta_ropath.basis_index)
+
         # Now handle single volume block case
         fp = delta_ropath.open("rb")
         data, last_block = self.get_data_block(fp)
@@ -662,6 +1096,10 @@ class DeltaTarBlockIter(TarBlockIter):
                 add_prefix(ti, "snapshot")
             elif delta_ropath.difftype == "diff":
                 add_prefix(ti, "diff")
+            elif delta_ropath.difftype == "moved":
+                add_prefix(ti, "moved")
+            elif delta_ropath.difftype == "chunked":
+                add_prefix(ti, "chunked")
             else:
                 assert 0, "Unknown difftype"
             return self.tarinfo2tarblock(index, ti, data)
@@ -697,6 +1135,8 @@ class DeltaTarBlockIter(TarBlockIter):
         ropath = self.process_ropath
         ti, index = ropath.get_tarinfo(), ropath.index
         ti.name = "%s/%d" % (self.process_prefix, self.process_next_vol_number)
+        if ropath.difftype == "moved":
+            ti.linkname = "/".join(ropath.basis_index)
         data, last_block = self.get_data_block(self.process_fp)
         if stats:
             stats.RawDeltaSize += len(data)
@@ -743,3 +1183,50 @@ def get_block_size(file_len):
         # Split file into about 2000 pieces, rounding to 512
         file_blocksize = int((file_len / (2000 * 512)) * 512)
         return min(file_blocksize, globals.max_blocksize)
+
+
+def get_extent_size(block_size):
+    """
+    Return length of the extents signed independently at block_size
+
+    A delta against a signature needs it all in memory, so files
+    longer than this get extent signatures, which keep the memory
+    below globals.max_signature_memory however long the file.
+    """
+    return max(globals.max_signature_memory // _sig_memory_per_block, 1) * block_size
+
+
+def get_sig_generator(file_len):
+    """
+    Return SigGenerator or ExtentSigGenerator for file of length file_len
+    """
+    block_size = get_block_size(file_len)
+    extent_size = get_extent_size(block_size)
+    if file_len > extent_size:
+        return librsync.ExtentSigGenerator(
+            block_size, extent_size,
+            tempfile.TemporaryFile(dir=tempdir.default().dir()))
+    return librsync.SigGenerator(block_size)
+
+
+def get_signature(fileobj, file_len):
+    """
+    Return file object holding the signature of fileobj's data
+
+    The signature is the one a backup stores for a file of length
+    file_len.  fileobj is read to the end and closed.
+    """
+    block_size = get_block_size(file_len)
+    if file_len <= get_extent_size(block_size):
+        sfp = librsync.SigFile(fileobj, block_size)
+        sig_string = sfp.read()
+        sfp.close()
+        return cStringIO.StringIO(sig_string)
+    sig_gen = get_sig_generator(file_len)
+    while True:
+        buf = fileobj.read(librsync.blocksize)
+        if not buf:
+            break
+        sig_gen.update(buf)
+    assert not fileobj.close()
+    return sig_gen.getsig_file()
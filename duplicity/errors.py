@@ -76,10 +76,14 @@ class UnsupportedBackendScheme(InvalidBackendURL, UserError):
 class BackendException(DuplicityError):
     """
     Raised to indicate a backend specific problem.
+
+    If the backend knows how long to wait before trying again (e.g. from
+    a Retry-After header), it passes the seconds as retry_after.
     """
-    def __init__(self, msg, code=log.ErrorCode.backend_error):
+    def __init__(self, msg, code=log.ErrorCode.backend_error, retry_after=None):
         super(BackendException, self).__init__(msg)
         self.code = code
+        self.retry_after = retry_after
 
 
 class FatalBackendException(BackendException):
@@ -89,6 +89,10 @@ gpg_options = ''
 # Maximum file blocksize
 max_blocksize = 2048
 
+# Memory a delta may use for the signature of a file, longer files get
+# signatures of extents which fit in it
+max_signature_memory = 256 * 1024 * 1024
+
 # If true, filelists and directory statistics will be split on
 # nulls instead of newlines.
 null_separator = None
@@ -96,6 +100,14 @@ null_separator = None
 # number of retries on network operations
 num_retries = 5
 
+# seconds to wait before the first retry of a failed network operation,
+# doubled for each further attempt up to retry_max_delay
+retry_delay = 10
+retry_max_delay = 300
+
+# maximum number of retries during the whole run, None for no limit
+retry_budget = None
+
 # True if Pydev debugger should be activated
 pydevd = False
 
@@ -268,6 +280,24 @@ rename = {}
 # enable data comparison on verify runs
 compare_data = False
 
+# verify against the signatures instead of the restored volumes
+fast_verify = False
+
+# number of threads reading local files on verify with --compare-data
+verify_readers = 1
+
+# number of threads writing restored files
+restore_writers = 1
+
+# number of threads diffing the extents of a file with an extent signature
+extent_workers = 1
+
+# on restore, leave files that already match the backup alone
+skip_unchanged = False
+
+# store the data of new files as deduplicated chunks
+dedup = False
+
 # When selected, triggers a dry-run before a full or incremental to compute
 # changes, then runs the real operation and keeps track of the real progress
 progress = False
@@ -287,3 +317,8 @@ use_gio = False
 
 # If set, collect only the file status, not the whole root.
 file_changed = None
+
+# Files to write the time spent in each stage to, as JSON and as a
+# Chrome trace
+timing_file = None
+trace_file = None
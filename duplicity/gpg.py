@@ -35,6 +35,7 @@ import locale
 from duplicity import globals
 from duplicity import gpginterface
 from duplicity import tempdir
+from duplicity import timing
 from duplicity import util
 
 try:
@@ -338,7 +339,9 @@ def GPGWriteFile(block_iter, filename, profile,
             except StopIteration:
                 at_end_of_blockiter = 1
                 break
+            step = timing.begin("gpg")
             file.write(data)
+            timing.end(step, len(data))
 
         file.write(block_iter.get_footer())
         if not at_end_of_blockiter:
@@ -396,7 +399,9 @@ def GzipWriteFile(block_iter, filename,
         except StopIteration:
             at_end_of_blockiter = 1
             break
+        step = timing.begin("gzip")
         gzip_file.write(new_block.data)
+        timing.end(step, len(new_block.data))
 
     assert not gzip_file.close() and not file_counted.close()
     return at_end_of_blockiter
@@ -410,6 +415,7 @@ def get_hash(hash, path, hex=1):
     form if hex is true, and in text (base64) otherwise.
     """
     # assert path.isreg()
+    step = timing.begin("hash")
     fp = path.open("rb")
     if hash == "SHA1":
         hash_obj = sha1()
@@ -424,6 +430,7 @@ def get_hash(hash, path, hex=1):
             break
         hash_obj.update(buf)
     assert not fp.close()
+    timing.end(step, step and path.getsize())
     if hex:
         return hash_obj.hexdigest()
     else:
@@ -28,11 +28,27 @@ which is written in C.  The goal was to use C as little as possible...
 """
 
 from . import _librsync
+from . import timing
+import cStringIO
+import struct
+import threading
 import types
-import array
 
 blocksize = _librsync.RS_JOB_BLOCKSIZE
 
+# Bytes read from the input, and written by librsync, per cycle
+job_buffer_size = 1024 * 1024
+
+# Extent signatures and deltas start with one of these magics and the
+# extent length.  An extent signature then holds the length and
+# signature of each extent, an extent delta the delta of each extent
+# in frames, each extent ending with an empty frame.
+extent_sig_magic = "DXS1"
+extent_delta_magic = "DXD1"
+_extent_header = struct.Struct(">4sQ")
+_sig_length = struct.Struct(">Q")
+_frame_length = struct.Struct(">I")
+
 
 class librsyncError(Exception):
     """Signifies error in internal librsync processing (bad signature, etc.)
@@ -47,20 +63,32 @@ class librsyncError(Exception):
 
 
 class LikeFile:
-    """File-like object used by SigFile, DeltaFile, and PatchFile"""
+    """File-like object used by SigFile, DeltaFile, and PatchFile
+
+    Input is handed to librsync as a view of what was read, and the
+    output is written into one reusable buffer, which grows up to
+    job_buffer_size while cycles fill it, so that large cycles don't
+    copy data around.  librsync runs without the GIL, so several
+    threads can each work on their own LikeFile at the same time.
+
+    """
     mode = "rb"
 
     # This will be replaced in subclasses by an object with
-    # appropriate cycle() method
+    # appropriate cycle_into() method
     maker = None
 
+    # Stage the cycles are timed as
+    stage = None
+
     def __init__(self, infile, need_seek=None):
         """LikeFile initializer - zero buffers, set eofs off"""
         self.check_file(infile, need_seek)
         self.infile = infile
         self.closed = self.infile_closed = None
-        self.inbuf = ""
-        self.outbuf = array.array('c')
+        self.inbuf, self.inbuf_pos = "", 0
+        self.outbuf = bytearray(blocksize)
+        self.outbuf_pos = self.outbuf_end = 0
         self.eof = self.infile_eof = None
 
     def check_file(self, file, need_seek=None):
@@ -73,42 +101,56 @@ class LikeFile:
             raise TypeError("Basis file must have a seek() method")
 
     def read(self, length=-1):
-        """Build up self.outbuf, return first length bytes"""
-        if length == -1:
-            while not self.eof:
-                self._add_to_outbuf_once()
-            real_len = len(self.outbuf)
-        else:
-            while not self.eof and len(self.outbuf) < length:
-                self._add_to_outbuf_once()
-            real_len = min(length, len(self.outbuf))
-
-        return_val = self.outbuf[:real_len].tostring()
-        del self.outbuf[:real_len]
-        return return_val
-
-    def _add_to_outbuf_once(self):
-        """Add one cycle's worth of output to self.outbuf"""
+        """Run cycles until length bytes are output, return them"""
+        pieces = []
+        while length:
+            if self.outbuf_pos == self.outbuf_end:
+                if self.eof:
+                    break
+                self._fill_outbuf()
+                continue
+            if length < 0:
+                end = self.outbuf_end
+            else:
+                end = min(self.outbuf_end, self.outbuf_pos + length)
+                length -= end - self.outbuf_pos
+            pieces.append(str(buffer(self.outbuf, self.outbuf_pos, end - self.outbuf_pos)))
+            self.outbuf_pos = end
+        return "".join(pieces)
+
+    def _fill_outbuf(self):
+        """Replace the output in self.outbuf with one cycle's worth"""
+        if self.outbuf_end == len(self.outbuf) < job_buffer_size:
+            # the last cycle filled the buffer, so output is plentiful
+            self.outbuf = bytearray(min(2 * len(self.outbuf), job_buffer_size))
         if not self.infile_eof:
             self._add_to_inbuf()
+        step = timing.begin(self.stage)
         try:
-            self.eof, len_inbuf_read, cycle_out = self.maker.cycle(self.inbuf)
+            self.eof, len_inbuf_read, len_outbuf_written = self.maker.cycle_into(
+                buffer(self.inbuf, self.inbuf_pos), self.outbuf, bool(self.infile_eof))
         except _librsync.librsyncError as e:
             raise librsyncError(str(e))
-        self.inbuf = self.inbuf[len_inbuf_read:]
-        self.outbuf.fromstring(cycle_out)
+        timing.end(step, len_inbuf_read)
+        self.inbuf_pos += len_inbuf_read
+        self.outbuf_pos, self.outbuf_end = 0, len_outbuf_written
 
     def _add_to_inbuf(self):
-        """Make sure len(self.inbuf) >= blocksize"""
+        """Make sure at least job_buffer_size bytes of input are waiting"""
         assert not self.infile_eof
-        while len(self.inbuf) < blocksize:
-            new_in = self.infile.read(blocksize)
+        pieces = [self.inbuf[self.inbuf_pos:]]
+        length = len(pieces[0])
+        while length < job_buffer_size:
+            new_in = self.infile.read(job_buffer_size - length)
             if not new_in:
                 self.infile_eof = 1
                 assert not self.infile.close()
                 self.infile_closed = 1
                 break
-            self.inbuf += new_in
+            pieces.append(new_in)
+            length += len(new_in)
+        if len(pieces) > 1:
+            self.inbuf, self.inbuf_pos = "".join(pieces), 0
 
     def close(self):
         """Close infile"""
@@ -119,6 +161,8 @@ class LikeFile:
 
 class SigFile(LikeFile):
     """File-like object which incrementally generates a librsync signature"""
+    stage = "librsync.sig"
+
     def __init__(self, infile, blocksize=_librsync.RS_DEFAULT_BLOCK_LEN):
         """SigFile initializer - takes basis file
 
@@ -135,6 +179,8 @@ class SigFile(LikeFile):
 
 class DeltaFile(LikeFile):
     """File-like object which incrementally generates a librsync delta"""
+    stage = "librsync.delta"
+
     def __init__(self, signature, new_file):
         """DeltaFile initializer - call with signature and new file
 
@@ -158,19 +204,25 @@ class DeltaFile(LikeFile):
 
 class PatchedFile(LikeFile):
     """File-like object which applies a librsync delta incrementally"""
-    def __init__(self, basis_file, delta_file):
+    stage = "librsync.patch"
+
+    def __init__(self, basis_file, delta_file, basis_offset=0):
         """PatchedFile initializer - call with basis delta
 
         Here basis_file must be a true Python file, because we may
         need to seek() around in it a lot, and this is done in C.
-        delta_file only needs read() and close() methods.
+        delta_file only needs read() and close() methods.  The delta
+        is applied to the part of basis_file from basis_offset on.
 
         """
         LikeFile.__init__(self, delta_file)
         if not isinstance(basis_file, types.FileType):
             raise TypeError("basis_file must be a (true) file")
         try:
-            self.maker = _librsync.new_patchmaker(basis_file)
+            if basis_offset:
+                self.maker = _librsync.new_patchmaker(basis_file, basis_offset)
+            else:
+                self.maker = _librsync.new_patchmaker(basis_file)
         except _librsync.librsyncError as e:
             raise librsyncError(str(e))
 
@@ -203,10 +255,12 @@ class SigGenerator:
 
     def process_buffer(self):
         """Run self.buffer through sig_maker, add to self.sig_string"""
+        step = timing.begin("librsync.sig")
         try:
             eof, len_buf_read, cycle_out = self.sig_maker.cycle(self.buffer)
         except _librsync.librsyncError as e:
             raise librsyncError(str(e))
+        timing.end(step, len_buf_read)
         self.buffer = self.buffer[len_buf_read:]
         self.sigstring_list.append(cycle_out)
         return eof
@@ -216,3 +270,423 @@ class SigGenerator:
         while not self.process_buffer():
             pass  # keep running until eof
         return ''.join(self.sigstring_list)
+
+
+class ExtentSigGenerator:
+    """Calculate an extent signature
+
+    Like SigGenerator, but the data is signed in independent extents
+    of extent_size bytes, so that making a delta only needs the
+    signature of one extent in memory at a time.  The signature is
+    written to sig_file as each extent ends.
+
+    """
+    def __init__(self, blocksize, extent_size, sig_file):
+        """Return new extent signature instance writing to sig_file"""
+        self.blocksize, self.extent_size = blocksize, extent_size
+        self.sig_file = sig_file
+        self.sig_file.write(_extent_header.pack(extent_sig_magic, extent_size))
+        self.sig_gen = None
+        self.extent_left = 0
+        self.extents = 0
+
+    def update(self, buf):
+        """Add buf to data that signature will be calculated over"""
+        pos = 0
+        while pos < len(buf):
+            if not self.sig_gen:
+                self.sig_gen = SigGenerator(self.blocksize)
+                self.extent_left = self.extent_size
+            piece = buf[pos:pos + self.extent_left]
+            self.sig_gen.update(piece)
+            pos += len(piece)
+            self.extent_left -= len(piece)
+            if not self.extent_left:
+                self.end_extent()
+
+    def end_extent(self):
+        """Write signature of the current extent to sig_file"""
+        self.add_extent_sig(self.sig_gen.getsig())
+        self.sig_gen = None
+
+    def add_extent_sig(self, sig_string):
+        """Write sig_string, the signature of the next extent, to sig_file"""
+        self.sig_file.write(_sig_length.pack(len(sig_string)))
+        self.sig_file.write(sig_string)
+        self.extents += 1
+
+    def getsig_file(self):
+        """Return sig_file, rewound, with the signature over given data"""
+        if self.sig_gen or not self.extents:
+            if not self.sig_gen:
+                self.sig_gen = SigGenerator(self.blocksize)
+            self.end_extent()
+        self.sig_file.seek(0)
+        return self.sig_file
+
+
+def _read_exactly(fileobj, length):
+    """Read length bytes from fileobj, fewer only at its end"""
+    pieces = []
+    while length:
+        buf = fileobj.read(length)
+        if not buf:
+            break
+        pieces.append(buf)
+        length -= len(buf)
+    return "".join(pieces)
+
+
+class _HeadFile:
+    """File-like object reading head first, then the rest of fileobj"""
+    def __init__(self, head, fileobj):
+        self.head, self.fileobj = head, fileobj
+
+    def read(self, length=-1):
+        if not self.head:
+            # tar members can't take a length of -1
+            if length < 0:
+                return self.fileobj.read()
+            return self.fileobj.read(length)
+        if length < 0:
+            result, self.head = self.head + self.fileobj.read(), ""
+        else:
+            result, self.head = self.head[:length], self.head[length:]
+        return result
+
+    def close(self):
+        return self.fileobj.close()
+
+
+class _ExtentFile:
+    """File-like object reading at most length bytes of fileobj
+
+    Closing it leaves fileobj open for the next extent.
+
+    """
+    def __init__(self, fileobj, length):
+        self.fileobj, self.left = fileobj, length
+
+    def read(self, length=-1):
+        if length < 0 or length > self.left:
+            length = self.left
+        buf = self.fileobj.read(length) if length else ""
+        self.left -= len(buf)
+        return buf
+
+    def close(self):
+        pass
+
+
+class _SignedFile:
+    """File-like object adding the data read from fileobj to sig_gen"""
+    def __init__(self, fileobj, sig_gen):
+        self.fileobj, self.sig_gen = fileobj, sig_gen
+
+    def read(self, length=-1):
+        buf = self.fileobj.read(length)
+        self.sig_gen.update(buf)
+        return buf
+
+    def close(self):
+        return self.fileobj.close()
+
+
+class _FrameFile:
+    """File-like object reading the frames of one extent in fileobj"""
+    def __init__(self, fileobj, frame_left):
+        self.fileobj, self.frame_left = fileobj, frame_left
+
+    def read(self, length=-1):
+        pieces = []
+        while length and self.frame_left:
+            if length < 0 or length > self.frame_left:
+                buf = _read_exactly(self.fileobj, self.frame_left)
+            else:
+                buf = _read_exactly(self.fileobj, length)
+                length -= len(buf)
+            if not buf:
+                raise librsyncError("Truncated extent delta")
+            pieces.append(buf)
+            self.frame_left -= len(buf)
+            if not self.frame_left:
+                self.frame_left = _read_frame_length(self.fileobj)
+                if self.frame_left is None:
+                    raise librsyncError("Truncated extent delta")
+        return "".join(pieces)
+
+    def close(self):
+        pass
+
+
+def _read_frame_length(fileobj):
+    """Return length of the next frame in fileobj, None at its end"""
+    buf = _read_exactly(fileobj, _frame_length.size)
+    if not buf:
+        return None
+    if len(buf) != _frame_length.size:
+        raise librsyncError("Truncated extent delta")
+    return _frame_length.unpack(buf)[0]
+
+
+class ExtentDeltaFile:
+    """File-like object which generates an extent delta
+
+    The delta of each extent of new_file is made against the signature
+    of the same extent of the old file, or an empty signature for
+    extents past its end.  signature is read up to the signature of
+    the extent being worked on.
+
+    """
+    def __init__(self, signature, new_file, extent_size):
+        """ExtentDeltaFile initializer - signature is past its header"""
+        self.signature, self.new_file = signature, new_file
+        self.extent_size = extent_size
+        self.buf = _extent_header.pack(extent_delta_magic, extent_size)
+        self.extent = self.delta = None
+        self.eof = None
+
+    def next_sig(self):
+        """Return signature of the next extent of the old file"""
+        length = _read_exactly(self.signature, _sig_length.size)
+        if not length:
+            return SigFile(cStringIO.StringIO("")).read()
+        if len(length) != _sig_length.size:
+            raise librsyncError("Truncated extent signature")
+        return _read_exactly(self.signature, _sig_length.unpack(length)[0])
+
+    def next_delta(self):
+        """Return DeltaFile of the next extent, None after the last"""
+        if self.extent and self.extent.left:
+            return None
+        sig_string = self.next_sig()
+        self.extent = _ExtentFile(self.new_file, self.extent_size)
+        return DeltaFile(sig_string, self.extent)
+
+    def read(self, length=-1):
+        while not self.eof and (length < 0 or len(self.buf) < length):
+            if not self.delta:
+                self.delta = self.next_delta()
+                if not self.delta:
+                    self.eof = 1
+                    break
+            data = self.delta.read(job_buffer_size)
+            self.buf += _frame_length.pack(len(data)) + data
+            if not data:
+                self.delta.close()
+                self.delta = None
+        if length < 0:
+            length = len(self.buf)
+        result, self.buf = self.buf[:length], self.buf[length:]
+        return result
+
+    def close(self):
+        assert not self.signature.close()
+        return self.new_file.close()
+
+
+class _ExtentJob:
+    """Delta and signature of one extent, made by a thread"""
+    def __init__(self, offset, sig_string, delta_file):
+        self.offset = offset
+        self.sig_string = sig_string
+        self.delta_file = delta_file
+        self.length = 0
+        self.new_sig_string = None
+        self.error = None
+        self.thread = None
+
+
+class ParallelExtentDeltaFile(ExtentDeltaFile):
+    """ExtentDeltaFile making the deltas of several extents at once
+
+    open_extent(offset) returns a new file object reading the new file
+    from offset on, so that up to workers threads each read and diff
+    an extent of their own, with librsync running without the GIL.
+    Each delta is written to a file from temp_file() and read out in
+    order, so the result is the same as ExtentDeltaFile's.  If sig_gen,
+    an ExtentSigGenerator with the same extent length, is given, the
+    threads sign the new data too and hand the signatures to it.
+
+    """
+    def __init__(self, signature, open_extent, workers, temp_file, sig_gen=None):
+        """ParallelExtentDeltaFile initializer - signature is at its start"""
+        header = _read_exactly(signature, _extent_header.size)
+        if len(header) != _extent_header.size or not header.startswith(extent_sig_magic):
+            raise librsyncError("Not an extent signature")
+        ExtentDeltaFile.__init__(self, signature, None,
+                                 _extent_header.unpack(header)[1])
+        assert not sig_gen or sig_gen.extent_size == self.extent_size
+        self.open_extent, self.workers = open_extent, workers
+        self.temp_file = temp_file
+        self.sig_gen = sig_gen
+        self.jobs = []
+        self.next_offset = 0
+        self.last = None
+        self.delta_file = None
+        self.length = 0
+
+    def start_jobs(self):
+        """Start threads on the next extents, up to workers at once"""
+        while not self.last and len(self.jobs) < self.workers:
+            job = _ExtentJob(self.next_offset, self.next_sig(), self.temp_file())
+            job.thread = threading.Thread(target=self.run_job, args=(job,))
+            job.thread.daemon = True
+            job.thread.start()
+            self.jobs.append(job)
+            self.next_offset += self.extent_size
+
+    def run_job(self, job):
+        """Write the delta of the extent at job.offset to job.delta_file"""
+        try:
+            infile = self.open_extent(job.offset)
+            try:
+                extent = _ExtentFile(infile, self.extent_size)
+                new_file = extent
+                if self.sig_gen:
+                    sig_gen = SigGenerator(self.sig_gen.blocksize)
+                    new_file = _SignedFile(extent, sig_gen)
+                delta = DeltaFile(job.sig_string, new_file)
+                job.sig_string = None
+                while True:
+                    data = delta.read(job_buffer_size)
+                    job.delta_file.write(_frame_length.pack(len(data)))
+                    job.delta_file.write(data)
+                    if not data:
+                        break
+                delta.close()
+                job.length = self.extent_size - extent.left
+                if self.sig_gen:
+                    job.new_sig_string = sig_gen.getsig()
+            finally:
+                infile.close()
+        except Exception as e:
+            job.error = e
+
+    def next_job(self):
+        """Wait for the delta of the next extent, return false after the last"""
+        if not self.last:
+            self.start_jobs()
+        if self.last or not self.jobs:
+            return False
+        job = self.jobs.pop(0)
+        job.thread.join()
+        if job.error:
+            job.delta_file.close()
+            raise job.error
+        # an extent shorter than the others is the last one
+        self.length += job.length
+        if job.length < self.extent_size:
+            self.last = 1
+        if self.sig_gen and (job.length or not job.offset):
+            self.sig_gen.add_extent_sig(job.new_sig_string)
+        job.delta_file.seek(0)
+        self.delta_file = job.delta_file
+        return True
+
+    def read(self, length=-1):
+        while not self.eof and (length < 0 or len(self.buf) < length):
+            data = self.delta_file.read(job_buffer_size) if self.delta_file else ""
+            if data:
+                self.buf += data
+                continue
+            if self.delta_file:
+                self.delta_file.close()
+                self.delta_file = None
+            if not self.next_job():
+                self.eof = 1
+        if length < 0:
+            length = len(self.buf)
+        result, self.buf = self.buf[:length], self.buf[length:]
+        return result
+
+    def close(self):
+        """Wait for the threads still running, close signature"""
+        for job in self.jobs:
+            job.thread.join()
+            job.delta_file.close()
+        self.jobs = []
+        if self.delta_file:
+            self.delta_file.close()
+            self.delta_file = None
+        return self.signature.close()
+
+
+def peek_extent_size(signature):
+    """Return extent length of signature file, or None if not an extent signature
+
+    Also return a file object to read the whole signature from instead.
+
+    """
+    header = _read_exactly(signature, _extent_header.size)
+    signature = _HeadFile(header, signature)
+    if len(header) == _extent_header.size and header.startswith(extent_sig_magic):
+        return _extent_header.unpack(header)[1], signature
+    return None, signature
+
+
+class ExtentPatchedFile:
+    """File-like object which applies an extent delta
+
+    The delta of each extent is applied to the same extent of
+    basis_file, which must be a true file as for PatchedFile, counting
+    from basis_offset.
+
+    """
+    def __init__(self, basis_file, delta_file, extent_size, basis_offset=0):
+        """ExtentPatchedFile initializer - delta_file is past its header"""
+        self.basis_file, self.delta_file = basis_file, delta_file
+        self.extent_size = extent_size
+        self.basis_offset = basis_offset
+        self.extents = 0
+        self.patch = None
+        self.eof = None
+
+    def read(self, length=-1):
+        pieces = []
+        while length and not self.eof:
+            if not self.patch:
+                frame_left = _read_frame_length(self.delta_file)
+                if frame_left is None:
+                    self.eof = 1
+                    break
+                self.patch = PatchedFile(self.basis_file,
+                                         _FrameFile(self.delta_file, frame_left),
+                                         self.basis_offset +
+                                         self.extents * self.extent_size)
+                self.extents += 1
+            buf = self.patch.read(length)
+            if not buf:
+                self.patch.close()
+                self.patch = None
+            elif length > 0:
+                length -= len(buf)
+            pieces.append(buf)
+        return "".join(pieces)
+
+    def close(self):
+        return self.delta_file.close()
+
+
+def get_delta_file(signature, new_file):
+    """Return DeltaFile or ExtentDeltaFile, as the signature file is"""
+    header = _read_exactly(signature, _extent_header.size)
+    if len(header) == _extent_header.size and header.startswith(extent_sig_magic):
+        return ExtentDeltaFile(signature, new_file,
+                               _extent_header.unpack(header)[1])
+    sig_string = header + signature.read()
+    assert not signature.close()
+    return DeltaFile(sig_string, new_file)
+
+
+def get_patched_file(basis_file, delta_file, basis_offset=0):
+    """Return PatchedFile or ExtentPatchedFile, as the delta file is
+
+    The delta is applied to the part of basis_file from basis_offset on.
+
+    """
+    header = _read_exactly(delta_file, _extent_header.size)
+    if len(header) == _extent_header.size and header.startswith(extent_delta_magic):
+        return ExtentPatchedFile(basis_file, delta_file,
+                                 _extent_header.unpack(header)[1], basis_offset)
+    return PatchedFile(basis_file, _HeadFile(header, delta_file), basis_offset)
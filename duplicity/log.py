@@ -64,9 +64,19 @@ def LevelName(level):
         return "ERROR"
 
 
+def IsEnabled(verb_level):
+    """Return true if messages of verb_level would be logged.
+
+    Callers logging for every file check this first, so that messages
+    nobody will see are never formatted."""
+    return _logger.isEnabledFor(DupToLoggerLevel(verb_level))
+
+
 def Log(s, verb_level, code=1, extra=None, force_print=False):
     """Write s to stderr if verbosity level low enough"""
     global _logger
+    if not force_print and not _logger.isEnabledFor(DupToLoggerLevel(verb_level)):
+        return
     if extra:
         controlLine = '%d %s' % (code, extra)
     else:
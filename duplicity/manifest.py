@@ -23,10 +23,13 @@
 
 from future_builtins import filter
 
+import cStringIO
 import re
+import tempfile
 
 from duplicity import log
 from duplicity import globals
+from duplicity import tempdir
 from duplicity import util
 
 
@@ -56,6 +59,7 @@ class Manifest:
         self.volume_info_dict = {}  # dictionary vol numbers -> vol infos
         self.fh = fh
         self.files_changed = []
+        self.files_moved = []
 
     def set_dirinfo(self):
         """
@@ -111,14 +115,44 @@ class Manifest:
                          "--allow-source-mismatch switch to avoid seeing this "
                          "message"), code, code_extra)
 
+    def set_files_moved_info(self, files_moved):
+        """
+        Set and write list of (path, path moved from) pairs
+
+        Restore needs the old data of the second path to patch the
+        first.  Written before the file list, which older versions
+        read up to the end of the manifest.
+        """
+        if files_moved:
+            self.files_moved = files_moved
+
+        if self.fh and self.files_moved:
+            self.fh.write("Movedlist %d\n" % len(self.files_moved))
+            for path, basis in self.files_moved:
+                self.fh.write("    %s  %s\n" % (Quote(path), Quote(basis)))
+
     def set_files_changed_info(self, files_changed):
+        """
+        Set and write list of changed files
+
+        files_changed is a FileList, or a list of (path, action) pairs.
+        """
         if files_changed:
             self.files_changed = files_changed
 
         if self.fh:
             self.fh.write("Filelist %d\n" % len(self.files_changed))
-            for fileinfo in self.files_changed:
-                self.fh.write("    %-7s  %s\n" % (fileinfo[1], Quote(fileinfo[0])))
+            for line in self.get_files_changed_lines():
+                self.fh.write(line)
+
+    def get_files_changed_lines(self):
+        """
+        Return iterator of the manifest lines of the changed files
+        """
+        if isinstance(self.files_changed, FileList):
+            return self.files_changed.lines()
+        return (format_fileinfo(path, action)
+                for path, action in self.files_changed)
 
     def add_volume_info(self, vi):
         """
@@ -161,9 +195,13 @@ class Manifest:
         if self.local_dirname:
             result += "Localdir %s\n" % Quote(self.local_dirname)
 
+        if self.files_moved:
+            result += "Movedlist %d\n" % len(self.files_moved)
+            for path, basis in self.files_moved:
+                result += "    %s  %s\n" % (Quote(path), Quote(basis))
+
         result += "Filelist %d\n" % len(self.files_changed)
-        for fileinfo in self.files_changed:
-            result += "    %-7s  %s\n" % (fileinfo[1], Quote(fileinfo[0]))
+        result += "".join(self.get_files_changed_lines())
 
         vol_num_list = self.volume_info_dict.keys()
         vol_num_list.sort()
@@ -192,19 +230,18 @@ class Manifest:
         self.hostname = get_field("hostname")
         self.local_dirname = get_field("localdir")
 
-        # Get file changed list
-        filelist_regexp = re.compile("(^|\\n)filelist\\s([0-9]+)\\n(.*?)(\\nvolume\\s|$)", re.I | re.S)
-        match = filelist_regexp.search(s)
-        filecount = 0
+        # Get list of moved files
+        match = re.search("(^|\\n)movedlist\\s([0-9]+)\\n", s, re.I)
         if match:
-            filecount = int(match.group(2))
-        if filecount > 0:
-            def parse_fileinfo(line):
-                fileinfo = line.strip().split()
-                return (fileinfo[0], ''.join(fileinfo[1:]))
+            lines = s[match.end():].split("\n")[:int(match.group(2))]
+            self.files_moved = [tuple(map(Unquote, line.split()))
+                                for line in lines]
 
-            self.files_changed = list(map(parse_fileinfo, match.group(3).split('\n')))
-        assert filecount == len(self.files_changed)
+        # Get file changed list, parsed only when iterated
+        match = re.search("(^|\\n)filelist\\s([0-9]+)\\n", s, re.I)
+        if match and int(match.group(2)):
+            self.files_changed = FileList(cStringIO.StringIO(s),
+                                          int(match.group(2)), match.end())
 
         next_vi_string_regexp = re.compile("(^|\\n)(volume\\s.*?)"
                                            "(\\nvolume\\s|$)", re.I | re.S)
@@ -231,6 +268,9 @@ class Manifest:
     def get_files_changed(self):
         return self.files_changed
 
+    def get_files_moved(self):
+        return self.files_moved
+
     def __eq__(self, other):
         """
         Two manifests are equal if they contain the same volume infos
@@ -281,6 +321,88 @@ class Manifest:
                       self.volume_info_dict.keys())
 
 
+class FileList:
+    """
+    List of the files changed in a backup set, in manifest form
+
+    The lines are kept in a file, a temp file when appended to or the
+    manifest they were read from, and only parsed when iterated, so a
+    long list is never held in memory.  Iterating gives (action, path)
+    pairs, as in the lists of older versions read from manifests.
+    """
+    def __init__(self, fileobj=None, count=0, start=0):
+        """
+        FileList initializer
+
+        @param fileobj: file holding count lines of the list from start
+        @type fileobj: file
+        """
+        self.fileobj = fileobj
+        self.count = count
+        self.start = start
+
+    def append(self, path, action):
+        """
+        Add changed file path to the end of the list
+        """
+        if not self.fileobj:
+            self.fileobj = tempfile.TemporaryFile(dir=tempdir.default().dir())
+        self.fileobj.seek(0, 2)
+        self.fileobj.write(format_fileinfo(path, action))
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def lines(self):
+        """
+        Generate the manifest lines of the list
+        """
+        if not self.count:
+            return
+        self.fileobj.seek(self.start)
+        for i in range(self.count):
+            line = self.fileobj.readline()
+            if not line.endswith("\n"):
+                raise ManifestError("File list ends after %d of %d lines" %
+                                    (i, self.count))
+            yield line
+
+    def __iter__(self):
+        for line in self.lines():
+            yield parse_fileinfo(line)
+
+
+def format_fileinfo(path, action):
+    """
+    Return manifest line of changed file path
+    """
+    return "    %-7s  %s\n" % (action, Quote(path))
+
+
+def parse_fileinfo(line):
+    """
+    Return (action, path) pair of manifest line of a changed file
+    """
+    fileinfo = line.split()
+    return (fileinfo[0], Unquote(''.join(fileinfo[1:])))
+
+
+def read_files_changed(fileobj):
+    """
+    Return FileList of the changed files in manifest fileobj
+
+    Only the manifest up to the list is read now.
+    """
+    while True:
+        line = fileobj.readline()
+        if not line:
+            return FileList()
+        match = re.match("filelist\\s([0-9]+)\\n", line, re.I)
+        if match:
+            return FileList(fileobj, int(match.group(1)), fileobj.tell())
+
+
 class VolumeInfoError(Exception):
     """
     Raised when there is a problem initializing a VolumeInfo from string
@@ -300,6 +422,7 @@ class VolumeInfo:
         self.end_index = None
         self.end_block = None
         self.hashes = {}
+        self.chunk_packs = []
 
     def set_info(self, vol_number,
                  start_index, start_block,
@@ -325,6 +448,12 @@ class VolumeInfo:
         """
         self.hashes[hash_name] = data
 
+    def set_chunk_packs(self, chunk_packs):
+        """
+        Set ids of the chunk packs the volume refers to
+        """
+        self.chunk_packs = chunk_packs
+
     def get_best_hash(self):
         """
         Return pair (hash_type, hash_data)
@@ -365,6 +494,8 @@ class VolumeInfo:
         for key in self.hashes:
             slist.append("%sHash %s %s" %
                          (whitespace, key, self.hashes[key]))
+        for pack_id in self.chunk_packs:
+            slist.append("%sChunkPack %s" % (whitespace, pack_id))
         return "\n".join(slist)
 
     __str__ = to_string
@@ -414,6 +545,8 @@ class VolumeInfo:
                     self.end_block = None
             elif field_name == "hash":
                 self.set_hash(other_fields[0], other_fields[1])
+            elif field_name == "chunkpack" and len(other_fields) == 1:
+                self.chunk_packs.append(other_fields[0])
 
         if self.start_index is None or self.end_index is None:
             raise VolumeInfoError("Start or end index not set")
@@ -442,6 +575,9 @@ class VolumeInfo:
         if hash_list1 != hash_list2:
             log.Notice(_("Hashes don't match"))
             return None
+        if self.chunk_packs != other.chunk_packs:
+            log.Notice(_("Chunk packs don't match"))
+            return None
         return 1
 
     def __ne__(self, other):
@@ -25,11 +25,17 @@ import re  # @UnusedImport
 import types
 import os
 import tempfile
+import threading
+import Queue
+import cStringIO
 
 from duplicity import tarfile  # @UnusedImport
 from duplicity import librsync  # @UnusedImport
 from duplicity import log  # @UnusedImport
+from duplicity import robust
+from duplicity import chunkstore
 from duplicity import diffdir
+from duplicity import globals
 from duplicity import selection
 from duplicity import tempdir
 from duplicity import util  # @UnusedImport
@@ -74,16 +80,19 @@ def patch_diff_tarfile(base_path, diff_tarfile, restrict_index=()):
     collated = diffdir.collate2iters(path_iter, diff_path_iter)
 
     ITR = IterTreeReducer(PathPatcher, [base_path])
+    info = log.IsEnabled(log.INFO)
     for basis_path, diff_ropath in collated:
         if basis_path:
-            log.Info(_("Patching %s") % (util.ufn(basis_path.get_relative_path())),
-                     log.InfoCode.patch_file_patching,
-                     util.escape(basis_path.get_relative_path()))
+            if info:
+                log.Info(_("Patching %s") % (util.ufn(basis_path.get_relative_path())),
+                         log.InfoCode.patch_file_patching,
+                         util.escape(basis_path.get_relative_path()))
             ITR(basis_path.index, basis_path, diff_ropath)
         else:
-            log.Info(_("Patching %s") % (util.ufn(diff_ropath.get_relative_path())),
-                     log.InfoCode.patch_file_patching,
-                     util.escape(diff_ropath.get_relative_path()))
+            if info:
+                log.Info(_("Patching %s") % (util.ufn(diff_ropath.get_relative_path())),
+                         log.InfoCode.patch_file_patching,
+                         util.escape(diff_ropath.get_relative_path()))
             ITR(diff_ropath.index, basis_path, diff_ropath)
     ITR.Finish()
     base_path.setdata()
@@ -98,7 +107,8 @@ def filter_path_iter(path_iter, index):
     """Rewrite path elements of path_iter so they start with index
 
     Discard any that doesn't start with index, and remove the index
-    prefix from the rest.
+    prefix from the rest.  Hard links to files outside of index lose
+    their target.
 
     """
     assert isinstance(index, tuple) and index, index
@@ -106,6 +116,11 @@ def filter_path_iter(path_iter, index):
     for path in path_iter:
         if path.index[:l] == index:
             path.index = path.index[l:]
+            if path.ishardlink():
+                if path.linkindex[:l] == index:
+                    path.linkindex = path.linkindex[l:]
+                else:
+                    path.linkindex = None
             yield path
 
 
@@ -133,34 +148,42 @@ def difftar2path_iter(diff_tarfile):
         ropath.difftype = difftype
         if difftype == "deleted":
             ropath.type = None
-        elif ropath.isreg():
+        elif difftype == "moved":
+            ropath.basis_index = tuple(tarinfo_list[0].linkname.split("/"))
+            ropath.basis_file = None  # set by integrate_patch_iters
+            ropath.basis_offset = 0
+        if ropath.isreg():
             if multivol:
                 multivol_fileobj = Multivol_Filelike(diff_tarfile, tar_iter,
                                                      tarinfo_list, index)
-                ropath.setfileobj(multivol_fileobj)
+                fileobj = multivol_fileobj
+            else:
+                fileobj = diff_tarfile.extractfile(tarinfo_list[0])
+            if difftype == "chunked":
+                # from here on just a snapshot read out of the chunk packs
+                ropath.difftype = "snapshot"
+                fileobj = chunkstore.ChunkedFile(fileobj)
+            ropath.setfileobj(fileobj)
+            if multivol:
                 yield ropath
                 continue  # Multivol_Filelike will reset tarinfo_list
-            else:
-                ropath.setfileobj(diff_tarfile.extractfile(tarinfo_list[0]))
         yield ropath
         tarinfo_list[0] = tar_iter.next()
 
 
 def get_index_from_tarinfo(tarinfo):
     """Return (index, difftype, multivol) pair from tarinfo object"""
-    for prefix in ["snapshot/", "diff/", "deleted/",
-                   "multivol_diff/", "multivol_snapshot/"]:
+    for prefix in ["snapshot/", "diff/", "deleted/", "moved/", "chunked/",
+                   "multivol_diff/", "multivol_snapshot/", "multivol_moved/",
+                   "multivol_chunked/"]:
         tiname = util.get_tarinfo_name(tarinfo)
         if tiname.startswith(prefix):
             name = tiname[len(prefix):]  # strip prefix
             if prefix.startswith("multivol"):
-                if prefix == "multivol_diff/":
-                    difftype = "diff"
-                else:
-                    difftype = "snapshot"
+                difftype = prefix[len("multivol_"):-1]
                 multivol = 1
                 name, num_subs = \
-                    re.subn("(?s)^multivol_(diff|snapshot)/?(.*)/[0-9]+$",
+                    re.subn("(?s)^multivol_(diff|snapshot|moved|chunked)/?(.*)/[0-9]+$",
                             "\\2", tiname)
                 if num_subs != 1:
                     raise PatchDirException(u"Unrecognized diff entry %s" %
@@ -286,6 +309,8 @@ class PathPatcher(ITRBranch):
     def fast_process(self, index, basis_path, diff_ropath):
         """For use when neither is a directory"""
         if not diff_ropath:
+            if basis_path and basis_path.ishardlink():
+                self.relink(basis_path)
             return  # no change
         elif not basis_path:
             if diff_ropath.difftype == "deleted":
@@ -308,6 +333,21 @@ class PathPatcher(ITRBranch):
             assert diff_ropath.difftype == "diff", diff_ropath.difftype
             basis_path.patch_with_attribs(diff_ropath)
 
+    def relink(self, basis_path):
+        """Link unchanged basis_path again to the file it links to
+
+        Patching or replacing that file gives it a new inode, leaving
+        basis_path behind with the old data.
+
+        """
+        target = self.base_path.new_index(basis_path.linkindex)
+        if (target.isreg() and
+                (target.stat.st_dev, target.stat.st_ino) !=
+                (basis_path.stat.st_dev, basis_path.stat.st_ino)):
+            ropath = basis_path.get_ropath()
+            basis_path.delete()
+            ropath.copy(basis_path)
+
 
 class TarFile_FromFileobjs:
     """Like a tarfile.TarFile iterator, but read from multiple fileobjs"""
@@ -483,7 +523,15 @@ def patch_seq2ropath(patch_seq):
                                     "has %d entries" % len(patch_seq)
         return first.get_ropath()
 
-    current_file = first.open("rb")
+    if first.difftype == "moved":
+        if not first.basis_file:
+            raise PatchDirException("Data %s was moved from is missing" %
+                                    util.ufn("/".join(first.basis_index)))
+        current_file = librsync.get_patched_file(first.basis_file,
+                                                 first.open("rb"),
+                                                 first.basis_offset)
+    else:
+        current_file = first.open("rb")
 
     for delta_ropath in patch_seq[1:]:
         assert delta_ropath.difftype == "diff", delta_ropath.difftype
@@ -497,23 +545,33 @@ def patch_seq2ropath(patch_seq):
             assert not current_file.close()
             tempfp.seek(0)
             current_file = tempfp
-        current_file = librsync.PatchedFile(current_file,
-                                            delta_ropath.open("rb"))
+        current_file = librsync.get_patched_file(current_file,
+                                                 delta_ropath.open("rb"))
     result = patch_seq[-1].get_ropath()
     result.setfileobj(current_file)
     return result
 
 
-def integrate_patch_iters(iter_list):
+def integrate_patch_iters(iter_list, move_sources=None, basis_files=None):
     """Combine a list of iterators of ropath patches
 
     The iter_list should be sorted in patch order, and the elements in
     each iter_list need to be orderd by index.  The output will be an
     iterator of the final ROPaths in index order.
 
+    move_sources, if given, holds a set for each iter of the indicies
+    its "moved" patches are deltas of.  Their data as of the previous
+    iter is kept until the moved patch, which comes later, needs it.
+    The data of those sorting after the moved patch comes too late, it
+    must be in basis_files, see spool_basis_files.
+
     """
     collated = collate_iters(iter_list)
+    if basis_files is None:
+        basis_files = BasisSpool()
     for patch_seq in collated:
+        if move_sources:
+            get_move_basis_files(patch_seq, move_sources, basis_files)
         normalized = normalize_ps(patch_seq)
         try:
             final_ropath = patch_seq2ropath(normalized)
@@ -526,20 +584,144 @@ def integrate_patch_iters(iter_list):
                      (util.uexc(e), util.ufn(filename)),
                      log.WarningCode.cannot_process,
                      util.escape(filename))
+    basis_files.close()
+
+
+class BasisSpool:
+    """Data of the paths moved files were moved from, in one temp file
+
+    Each basis is appended to the spool under a key (iter number,
+    index), and its offset and length kept.  A moved patch gets the
+    spool opened again, so there is one file descriptor per patch being
+    read rather than one per basis kept, and patches read in threads do
+    not share a file position.
+
+    """
+    def __init__(self):
+        self.name = None
+        self.fileobj = None
+        self.extents = {}  # key -> (offset, length)
+
+    def __len__(self):
+        return len(self.extents)
+
+    def __iter__(self):
+        return iter(self.extents)
+
+    def __contains__(self, key):
+        return key in self.extents
+
+    def add(self, key, fileobj):
+        """Append data of fileobj, which is closed, to spool as key"""
+        if not self.fileobj:
+            self.name = tempdir.default().mktemp()
+            self.fileobj = open(self.name, "w+b")
+        self.fileobj.seek(0, 2)
+        offset = self.fileobj.tell()
+        util.copyfileobj(fileobj, self.fileobj)
+        fileobj.close()
+        self.extents[key] = (offset, self.fileobj.tell() - offset)
+
+    def pop(self, key):
+        """Return spool opened for reading and offset of key's data
+
+        (None, 0) is returned if key is not spooled.
+
+        """
+        if key not in self.extents:
+            return None, 0
+        offset, length = self.extents.pop(key)
+        self.fileobj.flush()
+        return open(self.name, "rb"), offset
+
+    def close(self):
+        """Remove spool, files opened by pop() can still be read"""
+        if self.fileobj:
+            self.fileobj.close()
+            os.unlink(self.name)
+            tempdir.default().forget(self.name)
+            self.fileobj = None
+        self.extents = {}
+
+
+def get_move_basis_files(patch_seq, move_sources, basis_files):
+    """Keep data moved files were moved from, hand it to moved patches
+
+    basis_files is a BasisSpool keyed by (iter number, index), holding
+    the data of index as of the iter before.
+
+    """
+    index = [x for x in patch_seq if x][0].index
+    for i in range(len(patch_seq)):
+        delta = patch_seq[i]
+        if (index in move_sources[i] and delta and
+                delta.difftype != "diff"):
+            try:
+                normalized = normalize_ps(patch_seq[:i])
+                basis = normalized and patch_seq2ropath(normalized)
+                if basis and basis.isreg():
+                    basis_files.add((i, index), basis.open("rb"))
+            except Exception as e:
+                log.Warn(_("Error '%s' patching %s") %
+                         (util.uexc(e), util.ufn("/".join(index))),
+                         log.WarningCode.cannot_process,
+                         util.escape("/".join(index)))
+        if delta and delta.difftype == "moved":
+            delta.basis_file, delta.basis_offset = \
+                basis_files.pop((i, delta.basis_index))
+
+
+def spool_basis_files(rop_iter, i, basis_files):
+    """Keep data of rop_iter for the moved patches of iter i
+
+    rop_iter holds the paths moved patches of iter i are deltas of, as
+    restored from the iters before i.  They are put in basis_files, a
+    BasisSpool, for integrate_patch_iters, for paths sorting after their
+    moved patch.
+
+    """
+    for ropath in rop_iter:
+        if ropath.isreg():
+            basis_files.add((i, ropath.index), ropath.open("rb"))
 
 
-def tarfiles2rop_iter(tarfile_list, restrict_index=()):
+def tarfiles2rop_iter(tarfile_list, restrict_index=(), move_sources=None,
+                      basis_files=None, restrict_set=None):
     """Integrate tarfiles of diffs into single ROPath iter
 
     Then filter out all the diffs in that index which don't start with
-    the restrict_index.
+    the restrict_index.  If restrict_set is given, the diffs of paths
+    whose full indicies are not in it are also dropped, before
+    integration as the tarfiles may hold only some of their diffs.
+    move_sources and basis_files are passed to integrate_patch_iters,
+    the paths in move_sources are kept until after integration.
 
     """
     diff_iters = [difftar2path_iter(x) for x in tarfile_list]
+    sources = set()
+    if move_sources:
+        sources = sources.union(*move_sources)
+    if restrict_set is not None or (restrict_index and sources):
+        l = len(restrict_index)
+
+        def wanted(path):
+            if restrict_set is not None and path.index not in restrict_set:
+                return False
+            return path.index[:l] == restrict_index
+
+        def keep(path):
+            return wanted(path) or path.index in sources
+        diff_iters = [filter(keep, x) for x in diff_iters]
+        rop_iter = integrate_patch_iters(diff_iters, move_sources, basis_files)
+        if sources:
+            rop_iter = filter(wanted, rop_iter)
+        if restrict_index:
+            rop_iter = filter_path_iter(rop_iter, restrict_index)
+        return rop_iter
     if restrict_index:
         # Apply filter before integration
         diff_iters = [filter_path_iter(x, restrict_index) for x in diff_iters]
-    return integrate_patch_iters(diff_iters)
+    return integrate_patch_iters(diff_iters, move_sources, basis_files)
 
 
 def Write_ROPaths(base_path, rop_iter):
@@ -548,26 +730,162 @@ def Write_ROPaths(base_path, rop_iter):
     Returns 1 if something was actually written, 0 otherwise.
 
     """
-    ITR = IterTreeReducer(ROPath_IterWriter, [base_path])
-    return_val = 0
-    for ropath in rop_iter:
-        return_val = 1
-        ITR(ropath.index, ropath)
-    ITR.Finish()
+    finished_dirs = []
+    writer_pool = None
+    if globals.restore_writers > 1:
+        writer_pool = WriterPool(globals.restore_writers)
+    try:
+        ITR = IterTreeReducer(ROPath_IterWriter,
+                              [base_path, finished_dirs, writer_pool])
+        return_val = 0
+        for ropath in rop_iter:
+            return_val = 1
+            ITR(ropath.index, ropath)
+        ITR.Finish()
+        finish_dirs(finished_dirs, writer_pool)
+    finally:
+        if writer_pool:
+            writer_pool.close()
     base_path.setdata()
     return return_val
 
 
+def finish_dirs(finished_dirs, writer_pool=None):
+    """Copy attributes to the directories in finished_dirs and empty it
+
+    finished_dirs holds (ropath, path) pairs of directories whose
+    contents have been written, in the order they were left.  Files
+    still being written by writer_pool are waited for first.
+
+    """
+    if writer_pool:
+        writer_pool.wait()
+    for ropath, path in finished_dirs:
+        ropath.copy_attribs(path)
+    del finished_dirs[:]
+
+
+class WriterPool:
+    """Write regular files of a restore in worker threads
+
+    The data of a file is read, and so decompressed and patched, in
+    order by the caller, and handed to a worker to write it out and
+    copy its attributes.  The number of workers limits the files open
+    at once, and submit() blocks while max_buffered bytes are waiting
+    to be written.  The first unexpected error of a worker is raised
+    again by the next submit() or wait().
+
+    """
+    # files larger than this are written by the caller
+    max_file_size = 1024 * 1024
+    max_buffered = 64 * 1024 * 1024
+
+    def __init__(self, workers):
+        self.queue = Queue.Queue()
+        self.cv = threading.Condition()
+        self.pending = 0
+        self.buffered = 0
+        self.error = None
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        """Write files from the queue until told to stop"""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            ropath, path, data = job
+            try:
+                robust.check_common_error(self.on_error, path.writefileobj,
+                                          (cStringIO.StringIO(data), ropath))
+            except Exception as e:
+                with self.cv:
+                    self.error = self.error or e
+            with self.cv:
+                self.pending -= 1
+                self.buffered -= len(data)
+                self.cv.notifyAll()
+
+    def on_error(self, exc, fileobj, ropath):
+        """Log an error writing ropath, like ITRBranch.on_error"""
+        filename = ropath.get_relative_path()
+        log.Warn(_("Error '%s' processing %s") % (exc, util.ufn(filename)),
+                 log.WarningCode.cannot_process,
+                 util.escape(filename))
+
+    def check_error(self):
+        """Raise the first unexpected error of a worker, if any"""
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, ropath, path, data):
+        """Write data to path with the attributes of ropath"""
+        with self.cv:
+            while self.buffered and self.buffered + len(data) > self.max_buffered:
+                self.check_error()
+                self.cv.wait()
+            self.check_error()
+            self.pending += 1
+            self.buffered += len(data)
+        self.queue.put((ropath, path, data))
+
+    def wait(self):
+        """Wait until all files submitted are written"""
+        with self.cv:
+            while self.pending:
+                self.cv.wait()
+            self.check_error()
+
+    def close(self):
+        """Stop the workers once they are done"""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class ReadAheadFile:
+    """File object returning data read ahead first, then the rest of fileobj"""
+    def __init__(self, data, fileobj):
+        self.data = data
+        self.fileobj = fileobj
+
+    def read(self, length=-1):
+        if not self.data:
+            return self.fileobj.read(length)
+        if length < 0:
+            result, self.data = self.data + self.fileobj.read(), ""
+        else:
+            result, self.data = self.data[:length], self.data[length:]
+        return result
+
+    def close(self):
+        return self.fileobj.close()
+
+
 class ROPath_IterWriter(ITRBranch):
     """Used in Write_ROPaths above
 
     We need to use an ITR because we have to update the
     permissions/times of directories after we write the files in them.
+    Directories left are collected in finished_dirs, shared by all
+    branches, and updated a batch at a time.
 
     """
-    def __init__(self, base_path):
+    # directories updated at once
+    batch_size = 1000
+
+    def __init__(self, base_path, finished_dirs, writer_pool=None):
         """Set base_path, Path of root of tree"""
         self.base_path = base_path
+        self.finished_dirs = finished_dirs
+        self.writer_pool = writer_pool
         self.dir_diff_ropath = None
         self.dir_new_path = None
 
@@ -587,23 +905,61 @@ class ROPath_IterWriter(ITRBranch):
             # base may exist, but nothing else
             assert index == (), index
         else:
+            if ropath.isdir() and self.dir_new_path.exists() and not self.dir_new_path.isdir():
+                self.dir_new_path.delete()
             self.dir_new_path.mkdir()
         self.dir_diff_ropath = ropath
 
     def end_process(self):
-        """Update information of a directory when leaving it"""
+        """Queue update of the information of a directory when leaving it"""
         if self.dir_diff_ropath:
-            self.dir_diff_ropath.copy_attribs(self.dir_new_path)
+            self.finished_dirs.append((self.dir_diff_ropath, self.dir_new_path))
+            if len(self.finished_dirs) >= self.batch_size:
+                finish_dirs(self.finished_dirs, self.writer_pool)
 
     def can_fast_process(self, index, ropath):
         """Can fast process (no recursion) if ropath isn't a directory"""
-        log.Info(_("Writing %s of type %s") %
-                 (util.ufn(ropath.get_relative_path()), ropath.type),
-                 log.InfoCode.patch_file_writing,
-                 "%s %s" % (util.escape(ropath.get_relative_path()), ropath.type))
+        if log.IsEnabled(log.INFO):
+            log.Info(_("Writing %s of type %s") %
+                     (util.ufn(ropath.get_relative_path()), ropath.type),
+                     log.InfoCode.patch_file_writing,
+                     "%s %s" % (util.escape(ropath.get_relative_path()), ropath.type))
         return not ropath.isdir()
 
     def fast_process(self, index, ropath):
-        """Write non-directory ropath to destination"""
+        """Write non-directory ropath to destination
+
+        When restoring over an existing tree, a regular file is
+        overwritten in place, anything else in the way is removed.
+
+        """
         if ropath.exists():
-            ropath.copy(self.base_path.new_index(index))
+            new_path = self.base_path.new_index(index)
+            if new_path.exists() and not (new_path.isreg() and ropath.isreg()):
+                if new_path.isdir():
+                    new_path.deltree()
+                else:
+                    new_path.delete()
+            if self.writer_pool and ropath.isreg():
+                self.submit(ropath, new_path)
+                return
+            if self.writer_pool and ropath.ishardlink():
+                # the file linked to may still be being written
+                self.writer_pool.wait()
+            ropath.copy(new_path)
+
+    def submit(self, ropath, new_path):
+        """Hand ropath to the writer pool, or write it here if it is large"""
+        fileobj = ropath.open("rb")
+        max_size = self.writer_pool.max_file_size
+        data = ""
+        while len(data) < max_size:
+            buf = fileobj.read(max_size - len(data))
+            if not buf:
+                break
+            data += buf
+        if len(data) < max_size:
+            assert not fileobj.close()
+            self.writer_pool.submit(ropath, new_path, data)
+        else:
+            new_path.writefileobj(ReadAheadFile(data, fileobj), ropath)
@@ -30,10 +30,15 @@ from future_builtins import filter
 
 import stat
 import errno
+import hashlib
+import math
 import socket
+import sys
 import time
 import re
 import gzip
+import threading
+import Queue
 
 from duplicity import tarfile
 from duplicity import file_naming
@@ -48,6 +53,44 @@ from duplicity.lazy import *  # @UnusedWildImport
 
 _copy_blocksize = 64 * 1024
 _tmp_path_counter = 1
+_zero_block = "\0" * _copy_blocksize
+
+# lseek() whence values finding data and holes in sparse files, only
+# known for sure on Linux where Python 2 does not define them
+if sys.platform.startswith("linux"):
+    _SEEK_DATA, _SEEK_HOLE = 3, 4
+else:
+    _SEEK_DATA = _SEEK_HOLE = None
+
+# futimens() sets the times of an open file; the Python 2 os module
+# only sets them by name, so call it through libc where there is one
+_futimens = None
+try:
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _futimens = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).futimens
+    _futimens.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    _futimens.restype = ctypes.c_int
+except (ImportError, OSError, AttributeError, TypeError):
+    _futimens = None
+
+
+def set_times(fd, name, atime, mtime):
+    """Set access and modification times of file name, open as fd"""
+    if not _futimens:
+        os.utime(name, (atime, mtime))
+        return
+    times = (_timespec * 2)()
+    for ts, t in zip(times, (atime, mtime)):
+        ts.tv_sec = int(math.floor(t))
+        ts.tv_nsec = min(int((t - ts.tv_sec) * 1e9), 999999999)
+    if _futimens(fd, times):
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), name)
 
 
 class StatResult:
@@ -61,6 +104,70 @@ class PathException(Exception):
     pass
 
 
+class SparseFile:
+    """Read only file object that does not read the holes of a file
+
+    The data extents are found with lseek(SEEK_DATA/SEEK_HOLE) and
+    only they are read, holes are returned as zeros without asking the
+    kernel.  The file is read up to its size when opened.
+
+    """
+    def __init__(self, name):
+        self.fileobj = open(name, "rb")
+        self.name = name
+        self.fd = self.fileobj.fileno()
+        self.size = os.fstat(self.fd).st_size
+        self.pos = 0
+        # self.pos is in a hole if self.hole, up to self.extent_end
+        self.hole, self.extent_end = False, 0
+
+    def find_extent(self):
+        """Set the extent self.pos is in"""
+        try:
+            data = os.lseek(self.fd, self.pos, _SEEK_DATA)
+            if data == self.pos:
+                hole = os.lseek(self.fd, self.pos, _SEEK_HOLE)
+                os.lseek(self.fd, self.pos, os.SEEK_SET)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # nothing but a hole up to the end
+                self.hole, self.extent_end = True, self.size
+            else:
+                # filesystem can't tell, read everything
+                os.lseek(self.fd, self.pos, os.SEEK_SET)
+                self.hole, self.extent_end = False, self.size
+            return
+        if data > self.pos:
+            self.hole, self.extent_end = True, min(data, self.size)
+        else:
+            self.hole, self.extent_end = False, min(hole, self.size)
+
+    def read(self, length=-1):
+        if length < 0:
+            length = self.size - self.pos
+        bufs = []
+        while length > 0 and self.pos < self.size:
+            if self.pos >= self.extent_end:
+                self.find_extent()
+            size = min(length, self.extent_end - self.pos)
+            if self.hole:
+                if size == _copy_blocksize:
+                    buf = _zero_block
+                else:
+                    buf = "\0" * size
+            else:
+                buf = os.read(self.fd, size)
+                if not buf:
+                    break  # file shrank while reading
+            bufs.append(buf)
+            self.pos += len(buf)
+            length -= len(buf)
+        return "".join(bufs)
+
+    def close(self):
+        return self.fileobj.close()
+
+
 class ROPath:
     """Read only Path
 
@@ -134,6 +241,21 @@ class ROPath:
         """True if self is fifo"""
         return self.type == "fifo"
 
+    def ishardlink(self):
+        """True if self is another name of an earlier regular file"""
+        return self.type == "hardlink"
+
+    def sethardlink(self, index):
+        """Make self a hard link to the regular file at index
+
+        The file at index must come before self in the backup, so only
+        its data is stored.  self.linkindex is relative to the same
+        root as self.index.
+
+        """
+        self.type = "hardlink"
+        self.linkindex = index
+
     def issock(self):
         """True is self is socket"""
         return self.type == "sock"
@@ -193,7 +315,8 @@ class ROPath:
         if type == tarfile.REGTYPE or type == tarfile.AREGTYPE:
             self.type = "reg"
         elif type == tarfile.LNKTYPE:
-            raise PathException("Hard links not supported yet")
+            self.type = "hardlink"
+            self.linkindex = tuple(tarinfo.linkname.split("/"))
         elif type == tarfile.SYMTYPE:
             self.type = "sym"
             self.symtext = tarinfo.linkname
@@ -244,6 +367,8 @@ class ROPath:
         new_ropath.type, new_ropath.mode = self.type, self.mode
         if self.issym():
             new_ropath.symtext = self.symtext
+        elif self.ishardlink():
+            new_ropath.linkindex = self.linkindex
         elif self.isdev():
             new_ropath.devnums = self.devnums
         if self.exists():
@@ -280,6 +405,9 @@ class ROPath:
             elif self.issym():
                 ti.type = tarfile.SYMTYPE
                 ti.linkname = self.symtext
+            elif self.ishardlink():
+                ti.type = tarfile.LNKTYPE
+                ti.linkname = "/".join(self.linkindex)
             elif self.isdev():
                 if self.type == "chr":
                     ti.type = tarfile.CHRTYPE
@@ -338,6 +466,9 @@ class ROPath:
         elif self.issym():
             # here only symtext matters
             return self.symtext == other.symtext
+        elif self.ishardlink():
+            # attributes and data belong to the file linked to
+            return self.linkindex == other.linkindex
         elif self.isdev():
             return self.perms_equal(other) and self.devnums == other.devnums
         assert 0
@@ -345,14 +476,16 @@ class ROPath:
     def __ne__(self, other):
         return not self.__eq__(other)
 
-    def compare_verbose(self, other, include_data=0):
+    def compare_verbose(self, other, include_data=0, data_equal=None):
         """Compare ROPaths like __eq__, but log reason if different
 
         This is placed in a separate function from __eq__ because
         __eq__ should be very time sensitive, and logging statements
         would slow it down.  Used when verifying.
 
-        Only run if include_data is true.
+        Only run if include_data is true.  If given, data_equal(other)
+        is used to compare the data of regular files instead of
+        reading self's data.
 
         """
         def log_diff(log_string):
@@ -387,7 +520,7 @@ class ROPath:
                           dup_time.timetopretty(int(self.stat.st_mtime))))
                 return 0
             if self.isreg():
-                if self.compare_data(other):
+                if (data_equal or self.compare_data)(other):
                     return 1
                 else:
                     log_diff(_("Data for file %s is different"))
@@ -401,6 +534,14 @@ class ROPath:
                 log_diff(_("Symlink %%s points to %s, expected %s") %
                          (other.symtext, self.symtext))
                 return 0
+        elif self.ishardlink():
+            if self.linkindex == other.linkindex:
+                return 1
+            else:
+                log_diff(_("Hard link %%s points to %s, expected %s") %
+                         (util.ufn("/".join(other.linkindex)),
+                          util.ufn("/".join(self.linkindex))))
+                return 0
         elif self.isdev():
             if not self.perms_equal(other):
                 log_diff(_("File %%s has permissions %s, expected %s") %
@@ -441,7 +582,8 @@ class ROPath:
     def copy(self, other):
         """Copy self to other.  Also copies data.  Other must be Path"""
         if self.isreg():
-            other.writefileobj(self.open("rb"))
+            other.writefileobj(self.open("rb"), self)
+            return  # attributes copied while the file was open
         elif self.isdir():
             os.mkdir(other.name)
         elif self.issym():
@@ -449,6 +591,9 @@ class ROPath:
             os.lchown(other.name, self.stat.st_uid, self.stat.st_gid)
             other.setdata()
             return  # no need to copy symlink attributes
+        elif self.ishardlink():
+            self.copy_hardlink(other)
+            return  # attributes are those of the file linked to
         elif self.isfifo():
             os.mkfifo(other.name)
         elif self.issock():
@@ -461,9 +606,51 @@ class ROPath:
             other.makedev(devtype, *self.devnums)
         self.copy_attribs(other)
 
+    def copy_hardlink(self, other):
+        """Link other to the file at self.linkindex under other's root
+
+        The file linked to has been written before, unless it was left
+        out of a partial restore or cannot be linked to, in which case
+        other is skipped with a warning.
+
+        """
+        target = None
+        if self.linkindex:
+            target = other.new_index(self.linkindex)
+        if not target or not target.isreg():
+            log.Warn(_("Warning: cannot restore hard link %s, the file it "
+                       "links to was not restored") % util.ufn(other.name))
+            return
+        if other.exists():
+            other.delete()
+        try:
+            os.link(target.name, other.name)
+        except OSError as e:
+            log.Warn(_("Warning: cannot link %s to %s: %s")
+                     % (util.ufn(other.name), util.ufn(target.name), e))
+        other.setdata()
+
     def copy_attribs(self, other):
-        """Only copy attributes from self to other"""
+        """Only copy attributes from self to other
+
+        Regular files and directories are opened once and changed
+        through the file descriptor, rather than looking up their name
+        for every change.
+
+        """
         if isinstance(other, Path):
+            fd = None
+            if self.isreg() or self.isdir():
+                try:
+                    fd = os.open(other.name, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+                except OSError:
+                    pass
+            if fd is not None:
+                try:
+                    self.copy_attribs_fd(other, fd)
+                finally:
+                    os.close(fd)
+                return
             util.maybe_ignore_errors(lambda: os.chown(other.name, self.stat.st_uid, self.stat.st_gid))
             util.maybe_ignore_errors(lambda: os.chmod(other.name, self.mode))
             util.maybe_ignore_errors(lambda: os.utime(other.name, (time.time(), self.stat.st_mtime)))
@@ -477,6 +664,14 @@ class ROPath:
             other.stat = stat
             other.mode = self.mode
 
+    def copy_attribs_fd(self, other, fd):
+        """Copy attributes from self to Path other, open as fd"""
+        util.maybe_ignore_errors(lambda: os.fchown(fd, self.stat.st_uid, self.stat.st_gid))
+        util.maybe_ignore_errors(lambda: os.fchmod(fd, self.mode))
+        util.maybe_ignore_errors(lambda: set_times(fd, other.name, time.time(), self.stat.st_mtime))
+        other.stat = os.fstat(fd)
+        other.set_from_stat()
+
     def __unicode__(self):
         """Return string representation"""
         return u"(%s %s)" % (util.uindex(self.index), self.type)
@@ -560,6 +755,18 @@ class Path(ROPath):
             result = open(self.name, mode)
         return result
 
+    def open_sparse(self):
+        """
+        Like open("rb"), but skip reading the holes of a sparse file
+
+        The result only has read() and close() methods, which is all
+        the backup needs.  Files without holes get a real file object.
+        """
+        if (not self.fileobj and _SEEK_DATA and self.isreg() and
+                self.stat.st_blocks * 512 < self.stat.st_size):
+            return SparseFile(self.name)
+        return self.open("rb")
+
     def makedev(self, type, major, minor):
         """Make a device file with specified type, major/minor nums"""
         cmdlist = ['mknod', self.name, type, str(major), str(minor)]
@@ -613,17 +820,37 @@ class Path(ROPath):
             else:
                 return Path("/".join(components[:-1]))
 
-    def writefileobj(self, fin):
-        """Copy file object fin to self.  Close both when done."""
+    def writefileobj(self, fin, attribs=None):
+        """Copy file object fin to self.  Close both when done.
+
+        Blocks of zeros are skipped instead of written, leaving holes
+        in the file where the filesystem supports them.  If attribs is
+        given, its attributes are copied to self before the file is
+        closed.
+
+        """
         fout = self.open("wb")
+        hole = False
         while 1:
             buf = fin.read(_copy_blocksize)
             if not buf:
                 break
-            fout.write(buf)
+            if buf == _zero_block:
+                fout.seek(_copy_blocksize, os.SEEK_CUR)
+                hole = True
+            else:
+                fout.write(buf)
+                hole = False
+        if hole:
+            # the file ends in a hole, set its size
+            fout.truncate()
+        if attribs:
+            fout.flush()
+            attribs.copy_attribs_fd(self, fout.fileno())
         if fin.close() or fout.close():
             raise PathException("Error closing file object")
-        self.setdata()
+        if not attribs:
+            self.setdata()
 
     def rename(self, new_path):
         """Rename file at current path to new_path."""
@@ -647,11 +874,10 @@ class Path(ROPath):
         temp_path = self.get_temp_in_same_dir()
         fbase = self.open("rb")
         fdiff = diff_ropath.open("rb")
-        patch_fileobj = librsync.PatchedFile(fbase, fdiff)
-        temp_path.writefileobj(patch_fileobj)
+        patch_fileobj = librsync.get_patched_file(fbase, fdiff)
+        temp_path.writefileobj(patch_fileobj, diff_ropath)
         assert not fbase.close()
         assert not fdiff.close()
-        diff_ropath.copy_attribs(temp_path)
         temp_path.rename(self)
 
     def get_temp_in_same_dir(self):
@@ -789,3 +1015,116 @@ class PathDeleter(ITRBranch):
 
     def fast_process(self, index, path):
         path.delete()
+
+
+class _HashJob:
+    """Digests of the blocks of a file read by a HashReaderPool worker"""
+    def __init__(self, path):
+        self.path = path
+        self.digests = []
+        self.cancelled = False
+        self.error = None
+
+
+class HashReaderPool:
+    """Read regular files ahead in worker threads, keeping hashes of the data
+
+    Used by verify with --compare-data.  submit(path) queues path to be
+    read in blocks of blocksize, of which only the sha1 is kept, and
+    compare() then compares a file object with them block by block as
+    the workers get to them, stopping at the first difference.  Files
+    submitted but not compared should be cancelled, so their workers
+    stop reading them.
+
+    """
+    blocksize = 1024 * 1024
+
+    def __init__(self, workers):
+        self.queue = Queue.Queue()
+        self.cv = threading.Condition()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        """Hash files from the queue until told to stop"""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                fp = job.path.open("rb")
+                try:
+                    while not job.cancelled:
+                        buf = fp.read(self.blocksize)
+                        digest = buf and hashlib.sha1(buf).digest()
+                        with self.cv:
+                            job.digests.append(digest)
+                            self.cv.notifyAll()
+                        if not buf:
+                            break
+                finally:
+                    fp.close()
+            except Exception as e:
+                with self.cv:
+                    job.error = e
+                    self.cv.notifyAll()
+
+    def submit(self, path):
+        """Start reading regular file path, return its job"""
+        job = _HashJob(path)
+        self.queue.put(job)
+        return job
+
+    def cancel(self, job):
+        """Stop reading the file of job"""
+        job.cancelled = True
+
+    def get_digest(self, job, i):
+        """Wait for the sha1 of block i of job, "" after the last"""
+        with self.cv:
+            while len(job.digests) <= i and not job.error:
+                self.cv.wait()
+            if job.error:
+                raise job.error
+            return job.digests[i]
+
+    def compare(self, fileobj, job):
+        """Return true if the data of fileobj is that of job's file
+
+        fileobj is closed, and job cancelled, after the first block
+        that differs.
+
+        """
+        try:
+            i = 0
+            while True:
+                buf = fileobj.read(self.blocksize)
+                while buf and len(buf) < self.blocksize:
+                    more = fileobj.read(self.blocksize - len(buf))
+                    if not more:
+                        break
+                    buf += more
+                if (buf and hashlib.sha1(buf).digest()) != self.get_digest(job, i):
+                    return False
+                if not buf:
+                    return True
+                i += 1
+        finally:
+            self.cancel(job)
+            assert not fileobj.close()
+
+    def close(self):
+        """Drop the files not started yet, stop the workers"""
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -172,12 +172,17 @@ class Select:
             log.Warn(_("Warning: base %s doesn't exist, continuing") %
                      util.ufn(path.name))
             return
-        log.Debug(_("Selecting %s") % util.ufn(path.name))
+        debug = log.IsEnabled(log.DEBUG)
+        if debug:
+            log.Debug(_("Selecting %s") % util.ufn(path.name))
         yield path
         if not path.isdir():
             return
         diryield_stack = [diryield(path)]
         delayed_path_stack = []
+        # (st_dev, st_ino) -> index of the first name of multiply
+        # linked regular files, later names become hard links to it
+        links = {}
 
         while diryield_stack:
             try:
@@ -190,10 +195,18 @@ class Select:
             if val == 0:
                 if delayed_path_stack:
                     for delayed_path in delayed_path_stack:
-                        log.Log(_("Selecting %s") % util.ufn(delayed_path.name), 6)
+                        if log.IsEnabled(6):
+                            log.Log(_("Selecting %s") % util.ufn(delayed_path.name), 6)
                         yield delayed_path
                     del delayed_path_stack[:]
-                log.Debug(_("Selecting %s") % util.ufn(subpath.name))
+                if debug:
+                    log.Debug(_("Selecting %s") % util.ufn(subpath.name))
+                if subpath.isreg() and subpath.stat.st_nlink > 1:
+                    key = (subpath.stat.st_dev, subpath.stat.st_ino)
+                    if key in links:
+                        subpath.sethardlink(links[key])
+                    else:
+                        links[key] = subpath.index
                 yield subpath
                 if subpath.isdir():
                     diryield_stack.append(diryield(subpath))
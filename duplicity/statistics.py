@@ -28,6 +28,7 @@ import time
 import os
 
 from duplicity import dup_time
+from duplicity import manifest
 
 
 class StatsException(Exception):
@@ -50,7 +51,9 @@ class StatsObj:
                        'DeltaEntries',
                        'RawDeltaSize')
     stat_misc_attrs = ('Errors',
-                       'TotalDestinationSizeChange')
+                       'TotalDestinationSizeChange',
+                       'Retries',
+                       'RetryTime')
     stat_time_attrs = ('StartTime',
                        'EndTime',
                        'ElapsedTime')
@@ -184,6 +187,11 @@ class StatsObj:
                             (tdsc, self.get_byte_summary_string(tdsc)))
         if self.Errors is not None:
             misc_string += "Errors %d\n" % self.Errors
+        if self.Retries is not None:
+            misc_string += "Retries %d\n" % self.Retries
+        if self.RetryTime is not None:
+            misc_string += ("RetryTime %.2f (%s)\n" %
+                            (self.RetryTime, dup_time.inttopretty(self.RetryTime)))
         return misc_string
 
     def get_byte_summary_string(self, byte_count):
@@ -306,7 +314,8 @@ class StatsDeltaProcess(StatsObj):
             self.__dict__[attr] = 0
         self.Errors = 0
         self.StartTime = time.time()
-        self.files_changed = []
+        self.files_changed = manifest.FileList()
+        self.files_moved = []
 
     def add_new_file(self, path):
         """Add stats of new file path to statistics"""
@@ -318,6 +327,12 @@ class StatsDeltaProcess(StatsObj):
         self.DeltaEntries += 1
         self.add_delta_entries_file(path, 'new')
 
+    def add_moved_file(self, path, basis_index):
+        """Add stats of new file path stored as delta of deleted file"""
+        self.add_new_file(path)
+        self.files_moved.append((path.get_relative_path(),
+                                 "/".join(basis_index)))
+
     def add_changed_file(self, path):
         """Add stats of file that has changed since last backup"""
         filesize = path.getsize()
@@ -346,7 +361,10 @@ class StatsDeltaProcess(StatsObj):
 
     def add_delta_entries_file(self, path, action_type):
         if path.isreg():
-            self.files_changed.append((path.get_relative_path(), action_type))
+            self.files_changed.append(path.get_relative_path(), action_type)
 
     def get_delta_entries_file(self):
         return self.files_changed
+
+    def get_moved_files(self):
+        return self.files_moved
@@ -0,0 +1,244 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Time spent in each stage of the backup and restore pipelines
+
+With --timing-file or --trace-file, the stages below add up the wall
+clock and CPU time, calls and bytes of each of their steps:
+
+  select           walking the source directory
+  read             reading source files
+  librsync.sig     librsync generating signatures
+  librsync.delta   librsync generating deltas
+  librsync.patch   librsync applying deltas
+  tarblock         building tar blocks of the volumes
+  gpg, gzip        writing volumes
+  hash             hashing volumes
+  backend.put      uploading files
+  backend.get      downloading files
+
+Stages run inside each other, a tar block is built from reads and
+deltas for instance, so each also gets a self time without the stages
+it ran.  The totals are written as JSON at the end of the run, and each
+step as a Chrome trace event, which chrome://tracing and Perfetto show
+on a time line per thread.
+
+A step is timed by calling begin() and end(); both return at once when
+timing is off.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+from duplicity import log
+from duplicity import util
+
+enabled = False
+
+# Trace events kept at most, later ones are counted as dropped
+max_events = 1000000
+
+# Per thread CPU time where getrusage() has it
+if hasattr(resource, "RUSAGE_THREAD"):
+    _rusage_thread = resource.RUSAGE_THREAD
+elif sys.platform.startswith("linux"):
+    _rusage_thread = 1
+else:
+    _rusage_thread = None
+
+_lock = threading.Lock()
+_local = threading.local()
+_stages = {}
+_events = None
+_dropped_events = 0
+_start_wall = _start_cpu = 0
+
+
+def _cpu_time():
+    """Return CPU time of the running thread, or of the process"""
+    if _rusage_thread is not None:
+        usage = resource.getrusage(_rusage_thread)
+        return usage.ru_utime + usage.ru_stime
+    return time.clock()
+
+
+class Stage:
+    """Totals of the steps of a stage"""
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.bytes = 0
+        self.wall = self.cpu = 0.0
+        self.self_wall = self.self_cpu = 0.0
+
+    def to_dict(self):
+        return {"calls": self.calls,
+                "bytes": self.bytes,
+                "wall": round(self.wall, 6),
+                "cpu": round(self.cpu, 6),
+                "self_wall": round(self.self_wall, 6),
+                "self_cpu": round(self.self_cpu, 6)}
+
+
+class _Step:
+    """A step of a stage being timed"""
+    __slots__ = ["name", "wall", "cpu", "child_wall", "child_cpu"]
+
+    def __init__(self, name):
+        self.name = name
+        self.child_wall = self.child_cpu = 0.0
+        self.wall = time.time()
+        self.cpu = _cpu_time()
+
+
+def start(trace=False):
+    """Start timing, keeping trace events if trace is true"""
+    global enabled, _events, _dropped_events, _start_wall, _start_cpu
+    with _lock:
+        _stages.clear()
+        _events = [] if trace else None
+        _dropped_events = 0
+        _start_wall = time.time()
+        _start_cpu = time.clock()
+        enabled = True
+
+
+def stop():
+    """Stop timing"""
+    global enabled
+    enabled = False
+
+
+def begin(name):
+    """Start a step of stage name, return it to pass to end()"""
+    if not enabled:
+        return None
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    step = _Step(name)
+    stack.append(step)
+    return step
+
+
+def end(step, nbytes=0):
+    """End step begun by begin(), which handled nbytes"""
+    global _dropped_events
+    if step is None:
+        return
+    wall = time.time() - step.wall
+    cpu = _cpu_time() - step.cpu
+    stack = _local.stack
+    while stack and stack.pop() is not step:
+        # inner step left by an exception
+        pass
+    if stack:
+        stack[-1].child_wall += wall
+        stack[-1].child_cpu += cpu
+    with _lock:
+        stage = _stages.get(step.name)
+        if not stage:
+            stage = _stages[step.name] = Stage(step.name)
+        stage.calls += 1
+        stage.bytes += nbytes
+        stage.wall += wall
+        stage.cpu += cpu
+        stage.self_wall += wall - step.child_wall
+        stage.self_cpu += cpu - step.child_cpu
+        if _events is not None:
+            if len(_events) < max_events:
+                _events.append((step.name, step.wall, wall, nbytes,
+                                threading.current_thread().ident))
+            else:
+                _dropped_events += 1
+
+
+def timed_iter(name, iterator):
+    """Return iterator timing each of its next() calls as stage name"""
+    if not enabled:
+        return iterator
+
+    def gen():
+        while True:
+            step = begin(name)
+            try:
+                value = iterator.next()
+            except StopIteration:
+                end(step)
+                return
+            except Exception:
+                end(step)
+                raise
+            end(step)
+            yield value
+    return gen()
+
+
+def get_summary():
+    """Return dictionary of the totals of all stages"""
+    with _lock:
+        return {"wall": round(time.time() - _start_wall, 6),
+                "cpu": round(time.clock() - _start_cpu, 6),
+                "stages": dict((name, stage.to_dict())
+                               for name, stage in _stages.items())}
+
+
+def get_trace():
+    """Return dictionary of the trace events in Chrome trace format"""
+    pid = os.getpid()
+    with _lock:
+        events = [{"name": name, "cat": name.split(".")[0], "ph": "X",
+                   "ts": int((start - _start_wall) * 1000000),
+                   "dur": int(duration * 1000000),
+                   "pid": pid, "tid": tid, "args": {"bytes": nbytes}}
+                  for name, start, duration, nbytes, tid in _events or []]
+        dropped = _dropped_events
+    return {"traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"dropped_events": dropped}}
+
+
+def write(action, summary_filename=None, trace_filename=None):
+    """Stop timing and write the summary and trace of action"""
+    if not enabled:
+        return
+    stop()
+    summary = get_summary()
+    summary["action"] = action
+    for name in sorted(summary["stages"]):
+        stage = summary["stages"][name]
+        log.Info(_("Stage %s: %d calls, %d bytes, %.3fs wall (%.3fs self), "
+                   "%.3fs CPU (%.3fs self)") %
+                 (name, stage["calls"], stage["bytes"], stage["wall"],
+                  stage["self_wall"], stage["cpu"], stage["self_cpu"]))
+    for filename, data, indent in [(summary_filename, summary, 1),
+                                   (trace_filename, _events is not None and get_trace(), None)]:
+        if filename and data:
+            try:
+                with open(filename, "w") as fileobj:
+                    json.dump(data, fileobj, indent=indent, sort_keys=True)
+            except EnvironmentError as e:
+                log.Warn(_("Unable to write timing to %s: %s") %
+                         (util.ufn(filename), util.uexc(e)))
@@ -21,8 +21,11 @@
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 import os
+import StringIO
+import tarfile
 import unittest
 
+from duplicity import log
 from . import CmdError, FunctionalTestCase
 
 
@@ -159,5 +162,98 @@ class VerifyTest(FunctionalTestCase):
         else:
             self.fail('Expected Hash Mismatch Error not thrown')
 
+    def fast_verify_fails(self, options=[]):
+        """Return true if verify --fast-verify finds differences"""
+        try:
+            self.verify('testfiles/various_file_types', options=["--fast-verify"] + options)
+        except CmdError as e:
+            self.assertEqual(e.exit_status, 1, str(e))
+            return True
+        return False
+
+    def change_data(self, filename):
+        """Change the data of filename, keeping its size and mtime"""
+        file_info = os.stat(filename)
+        with open(filename, 'r+') as f:
+            f.write('x' * min(10, file_info.st_size))
+        os.utime(filename, (file_info.st_atime, file_info.st_mtime))
+
+    def strip_data_hashes(self):
+        """Rewrite the cached signatures as written before they had data hashes"""
+        for dirpath, dirnames, filenames in os.walk("testfiles/cache"):
+            for filename in filenames:
+                if not filename.endswith(".sigtar.gz"):
+                    continue
+                sigtar = os.path.join(dirpath, filename)
+                members = []
+                tf = tarfile.open(sigtar, "r:gz")
+                for tarinfo in tf:
+                    data = tf.extractfile(tarinfo).read() if tarinfo.isreg() else None
+                    tarinfo.linkname = ":".join(tarinfo.linkname.split(":")[:2])
+                    members.append((tarinfo, data))
+                tf.close()
+                tf = tarfile.open(sigtar, "w:gz", format=tarfile.GNU_FORMAT)
+                for tarinfo, data in members:
+                    tf.addfile(tarinfo, data is not None and StringIO.StringIO(data) or None)
+                tf.close()
+
+    def test_fast_verify(self):
+        """Test verify --fast-verify against the signatures"""
+        self.backup("full", "testfiles/various_file_types", options=[])
+        self.assertFalse(self.fast_verify_fails())
+        self.assertFalse(self.fast_verify_fails(["--compare-data"]))
+
+        self.change_data('testfiles/various_file_types/executable')
+        self.assertFalse(self.fast_verify_fails())
+        self.assertTrue(self.fast_verify_fails(["--compare-data"]))
+
+    def test_fast_verify_without_data_hashes(self):
+        """Test verify --fast-verify compares librsync signatures of older backups"""
+        self.backup("full", "testfiles/various_file_types", options=[])
+        self.strip_data_hashes()
+        self.assertFalse(self.fast_verify_fails(["--compare-data"]))
+
+        self.change_data('testfiles/various_file_types/executable')
+        self.assertTrue(self.fast_verify_fails(["--compare-data"]))
+
+    def test_fast_verify_missing_and_new_files(self):
+        """Test verify --fast-verify finds missing and new files"""
+        dirname = 'testfiles/various_file_types'
+        self.backup("full", dirname, options=[])
+        # keep the directory as backed up, so only the files differ
+        dir_info = os.stat(dirname)
+        os.rename(dirname + '/executable', 'testfiles/executable')
+        os.utime(dirname, (dir_info.st_atime, dir_info.st_mtime))
+        self.assertTrue(self.fast_verify_fails())
+        os.rename('testfiles/executable', dirname + '/executable')
+        os.utime(dirname, (dir_info.st_atime, dir_info.st_mtime))
+        self.assertFalse(self.fast_verify_fails())
+
+        with open(dirname + '/new_file', 'w') as f:
+            f.write('This is a new file.')
+        os.utime(dirname, (dir_info.st_atime, dir_info.st_mtime))
+        self.assertTrue(self.fast_verify_fails())
+
+    def test_fast_verify_deleted_files(self):
+        """Test verify --fast-verify skips files deleted by an incremental"""
+        self.backup("full", "testfiles/various_file_types", options=[])
+        os.unlink('testfiles/various_file_types/executable')
+        self.backup("inc", "testfiles/various_file_types", options=[])
+        self.assertFalse(self.fast_verify_fails(["--compare-data"]))
+
+    def test_fast_verify_no_sigs(self):
+        """Test verify --fast-verify gives an error without signatures"""
+        self.backup("full", "testfiles/various_file_types", options=[])
+        for dirname in ["testfiles/output"] + [d[0] for d in os.walk("testfiles/cache")]:
+            for filename in os.listdir(dirname):
+                if "-signatures." in filename:
+                    os.unlink(os.path.join(dirname, filename))
+        try:
+            self.verify('testfiles/various_file_types', options=["--fast-verify"])
+        except CmdError as e:
+            self.assertEqual(e.exit_status, log.ErrorCode.no_sigs, str(e))
+        else:
+            self.fail('Expected CmdError not thrown')
+
 if __name__ == "__main__":
     unittest.main()
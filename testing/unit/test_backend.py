@@ -19,7 +19,11 @@
 # along with duplicity; if not, write to the Free Software Foundation,
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
+import errno
 import mock
+import socket
+import subprocess
+import sys
 import unittest
 
 import duplicity.backend
@@ -135,6 +139,40 @@ class ParsedUrlTest(UnitTestCase):
                           "ssh://foo@bar:pass@example.com/home")
 
 
+class ImportBackendTest(UnitTestCase):
+    """Test that backends are imported on demand"""
+    def test_modules(self):
+        """Test that the scheme map matches what the backends register"""
+        duplicity.backend.import_backends()
+        backends = duplicity.backend._backends
+        self.assertEqual(sorted(backends), sorted(duplicity.backend._backend_modules))
+        for scheme, factory in backends.items():
+            module = 'duplicity.backends.' + duplicity.backend._backend_modules[scheme]
+            self.assertTrue(factory in vars(sys.modules[module]).values(), scheme)
+        prefixes = duplicity.backend._backend_prefixes
+        self.assertEqual(sorted(prefixes), sorted(duplicity.backend._backend_prefix_modules))
+        for prefix, factory in prefixes.items():
+            module = 'duplicity.backends.' + duplicity.backend._backend_prefix_modules[prefix]
+            self.assertTrue(factory in vars(sys.modules[module]).values(), prefix)
+
+    def test_lazy(self):
+        """Test that only the backend for the url gets imported"""
+        script = ("import sys\n"
+                  "from duplicity import log\n"
+                  "log.setup()\n"
+                  "import duplicity.backend\n"
+                  "duplicity.backend.get_backend_object('par2+file://testfiles/output')\n"
+                  "print sorted(m for m in sys.modules\n"
+                  "             if m.startswith('duplicity.backends.') and sys.modules[m])\n")
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(output.strip(), str(['duplicity.backends.localbackend',
+                                              'duplicity.backends.par2backend']))
+
+    def test_unknown_scheme(self):
+        self.assertRaises(UnsupportedBackendScheme,
+                          duplicity.backend.get_backend_object, 'nosuch://host/path')
+
+
 class BackendWrapperTest(UnitTestCase):
 
     def setUp(self):
@@ -280,5 +318,61 @@ class BackendWrapperTest(UnitTestCase):
         self.mock._close.assert_called_once_with()
 
 
+class RetryPolicyTest(UnitTestCase):
+    """Test the delays and budget of backend retries"""
+    def setUp(self):
+        super(RetryPolicyTest, self).setUp()
+        self.set_global('retry_delay', 10)
+        self.set_global('retry_max_delay', 300)
+        self.mock = mock.MagicMock()
+        self.backend = duplicity.backend.BackendWrapper(self.mock)
+        self.retry_count = duplicity.backend.retry_count
+        self.retry_time = duplicity.backend.retry_time
+        duplicity.backend.retry_count = 0
+
+    def tearDown(self):
+        duplicity.backend.retry_count = self.retry_count
+        duplicity.backend.retry_time = self.retry_time
+        super(RetryPolicyTest, self).tearDown()
+
+    def test_delays(self):
+        delay = duplicity.backend._get_retry_delay
+        for i in range(20):
+            assert 5 <= delay(Exception(), 1) <= 10
+            assert 20 <= delay(Exception(), 3) <= 40
+            assert 150 <= delay(Exception(), 10) <= 300
+            assert 15 <= delay(TemporaryLoadException('busy'), 1) <= 30
+            reset = socket.error(errno.ECONNRESET, 'Connection reset by peer')
+            assert 0.5 <= delay(reset, 1) <= 1
+            assert 2 <= delay(reset, 3) <= 4
+        assert delay(TemporaryLoadException('busy', retry_after=7), 1) == 7
+        assert delay(BackendException('busy', retry_after=7000), 1) == 300
+
+    def test_parse_retry_after(self):
+        parse = duplicity.backend.parse_retry_after
+        self.assertEqual(parse('120'), 120)
+        self.assertEqual(parse(None), None)
+        self.assertEqual(parse('soon'), None)
+        self.assertEqual(parse('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
+    @mock.patch('sys.exit')
+    @mock.patch('time.sleep')
+    def test_budget(self, sleep_mock, exit_mock):
+        self.set_global('num_retries', 5)
+        self.set_global('retry_budget', 3)
+        self.mock._put.side_effect = Exception
+        self.backend.put(self.mock, 'a')
+        self.assertEqual(self.mock._put.call_count, 4)
+        self.assertEqual(sleep_mock.call_count, 3)
+        self.assertEqual(exit_mock.call_count, 1)
+        self.assertEqual(duplicity.backend.retry_count, 3)
+
+        # the budget is shared by all operations of the run
+        self.mock._get.side_effect = Exception
+        self.backend.get('a', self.mock)
+        self.assertEqual(self.mock._get.call_count, 1)
+        self.assertEqual(duplicity.backend.retry_count, 3)
+
+
 if __name__ == "__main__":
     unittest.main()
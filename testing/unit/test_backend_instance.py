@@ -18,14 +18,25 @@
 # along with duplicity; if not, write to the Free Software Foundation,
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
+import BaseHTTPServer
+import hashlib
+import json
+import mock
 import os
+import SocketServer
 import StringIO
+import threading
+import time
 import unittest
+import urllib
+import urlparse
 
 import duplicity.backend
+from duplicity import globals
 from duplicity import log
 from duplicity import path
 from duplicity.errors import BackendException
+from duplicity.errors import TemporaryLoadException
 from . import UnitTestCase
 
 
@@ -179,6 +190,89 @@ class LocalBackendTest(BackendInstanceBase):
         self.backend = duplicity.backend.get_backend_object(url)
         self.assertEqual(self.backend.__class__.__name__, 'LocalBackend')
 
+    def test_get_links(self):
+        self.backend._put(self.local, 'a')
+        getfile = path.Path('testfiles/getfile')
+        self.backend._get('a', getfile)
+        self.assertEqual(os.stat('testfiles/output/a').st_ino,
+                         os.stat('testfiles/getfile').st_ino)
+
+        # a later put must not write through the link
+        self.local.writefileobj(StringIO.StringIO("bye"))
+        self.backend._put(self.local, 'a')
+        self.assertEqual(getfile.get_data(), "hello")
+
+    def test_put_copies(self):
+        from duplicity.backends import localbackend
+        data = os.urandom(3 * 1024 * 1024 + 7)
+        self.local.writefileobj(StringIO.StringIO(data))
+        self.backend._put(self.local, 'a')
+        self.assertEqual(path.Path('testfiles/output/a').get_data(), data)
+
+        # without any kernel help
+        with mock.patch.object(localbackend, '_clone', return_value=False):
+            with mock.patch.object(localbackend, '_copy_file_range', None):
+                with mock.patch.object(localbackend, '_sendfile', None):
+                    self.backend._put(self.local, 'b')
+        self.assertEqual(path.Path('testfiles/output/b').get_data(), data)
+
+
+class MultiBackendTest(BackendInstanceBase):
+    def setUp(self):
+        super(MultiBackendTest, self).setUp()
+        self.set_global('num_retries', 1)
+        os.makedirs('testfiles/output1')
+        os.makedirs('testfiles/output2')
+        with open('testfiles/multi.json', 'w') as f:
+            json.dump([{'url': 'file://testfiles/output1'},
+                       {'url': 'file://testfiles/output2'}], f)
+        url = 'multi://%s/testfiles/multi.json' % os.getcwd()
+        self.backend = duplicity.backend.get_backend_object(url)
+        self.assertEqual(self.backend.__class__.__name__, 'MultiBackend')
+
+    def test_stripe(self):
+        self.backend._put(self.local, 'a')
+        self.backend._put(self.local, 'b')
+        self.assertEqual(os.listdir('testfiles/output1'), ['a'])
+        self.assertEqual(os.listdir('testfiles/output2'), ['b'])
+
+
+class MultiBackendMirrorTest(BackendInstanceBase):
+    def setUp(self):
+        super(MultiBackendMirrorTest, self).setUp()
+        self.set_global('num_retries', 1)
+        os.makedirs('testfiles/output1')
+        os.makedirs('testfiles/output2')
+        # a store that cannot be written to
+        open('testfiles/blocker', 'w').close()
+        with open('testfiles/multi.json', 'w') as f:
+            json.dump([{'url': 'file://testfiles/output1'},
+                       {'url': 'file://testfiles/output2'},
+                       {'url': 'file://testfiles/blocker/output3'}], f)
+        url = 'multi://%s/testfiles/multi.json?mode=mirror&quorum=2' % os.getcwd()
+        self.backend = duplicity.backend.get_backend_object(url)
+        self.assertEqual(self.backend.__class__.__name__, 'MultiBackend')
+
+    def test_mirror(self):
+        self.backend._put(self.local, 'a')
+        self.assertEqual(os.listdir('testfiles/output1'), ['a'])
+        self.assertEqual(os.listdir('testfiles/output2'), ['a'])
+
+    def test_get_from_other_mirror(self):
+        self.backend._put(self.local, 'a')
+        os.unlink('testfiles/output1/a')
+        getfile = path.Path('testfiles/getfile')
+        self.backend._get('a', getfile)
+        self.assertTrue(self.local.compare_data(getfile))
+
+    def test_quorum(self):
+        os.rmdir('testfiles/output2')
+        self.assertRaises(BackendException, self.backend._put, self.local, 'a')
+        os.makedirs('testfiles/output2')
+        # the retry only writes to the stores that are still missing the file
+        self.backend._put(self.local, 'a')
+        self.assertEqual(os.listdir('testfiles/output2'), ['a'])
+
 
 class Par2BackendTest(BackendInstanceBase):
     def setUp(self):
@@ -187,8 +281,101 @@ class Par2BackendTest(BackendInstanceBase):
         self.backend = duplicity.backend.get_backend_object(url)
         self.assertEqual(self.backend.__class__.__name__, 'Par2Backend')
 
-    # TODO: Add par2-specific tests here, to confirm that we can recover from
-    # a missing file
+    def test_repair(self):
+        volume = 'duplicity-full.20150101T000000Z.vol1.difftar.gz'
+        self.local.writefileobj(StringIO.StringIO("hello" * 20000))
+        self.backend._put(self.local, volume)
+        self.backend._close()  # uploads the pending recovery files
+        self.assertTrue(volume + '.par2' in os.listdir('testfiles/output'))
+        self.assertFalse(volume + '.par2' in self.backend._list())
+
+        with open('testfiles/output/' + volume, 'r+b') as f:
+            f.seek(1000)
+            f.write("corrupt")
+        getfile = path.Path('testfiles/getfile')
+        self.backend._get(volume, getfile)
+        self.assertFalse(self.local.compare_data(getfile))
+        self.assertTrue(self.backend._repair(volume, getfile))
+        self.assertTrue(self.local.compare_data(getfile))
+
+
+class SimBackendTest(BackendInstanceBase):
+    def setUp(self):
+        super(SimBackendTest, self).setUp()
+        self.backend = self.get_backend('')
+        self.assertEqual(self.backend.__class__.__name__, 'SimBackend')
+
+    def get_backend(self, query):
+        return duplicity.backend.get_backend_object('sim+file://testfiles/output' + query)
+
+    def test_options(self):
+        backend = self.get_backend('?latency=0.5&bandwidth=1.5M&upload=64k&page_size=10')
+        self.assertEqual(backend.latency, 0.5)
+        self.assertEqual(backend.download_link.bandwidth, 1.5 * 1024 * 1024)
+        self.assertEqual(backend.upload_link.bandwidth, 64 * 1024)
+        self.assertEqual(backend.page_size, 10)
+        self.assertEqual(backend.error_rate, 0)
+        for query in ['?latency=x', '?error_rate=2', '?speed=1', '?latency']:
+            self.assertRaises(BackendException, self.get_backend, query)
+
+    def test_delays(self):
+        backend = self.get_backend('?latency=0.02&bandwidth=100k&page_size=2')
+        self.local.writefileobj(StringIO.StringIO("x" * 5120))
+        start = time.time()
+        backend._put(self.local, 'a')
+        backend._put(self.local, 'b')
+        backend._put(self.local, 'c')
+        self.assertEqual(backend._list(), ['a', 'b', 'c'])
+        # 5 requests and 15 KiB
+        self.assertTrue(time.time() - start >= 0.25)
+        self.assertEqual(backend.stats['requests'], 5)
+        self.assertEqual(backend.stats['bytes_up'], 3 * 5120)
+
+    def test_errors(self):
+        backend = self.get_backend('?error_rate=0.2&throttle_rate=0.3&retry_after=7&seed=3')
+        errors = []
+        for i in range(100):
+            try:
+                backend._put(self.local, 'a')
+            except BackendException as e:
+                errors.append(e)
+        self.assertEqual(len(errors), backend.stats['errors'] + backend.stats['throttles'])
+        throttles = [e for e in errors if isinstance(e, TemporaryLoadException)]
+        self.assertEqual(len(throttles), backend.stats['throttles'])
+        self.assertTrue(10 < backend.stats['errors'] < 30)
+        self.assertTrue(20 < backend.stats['throttles'] < 40)
+        self.assertEqual(throttles[0].retry_after, 7)
+
+        # the same seed fails the same requests
+        again = self.get_backend('?error_rate=0.2&throttle_rate=0.3&retry_after=7&seed=3')
+        for i in range(100):
+            try:
+                again._put(self.local, 'a')
+            except BackendException:
+                pass
+        self.assertEqual(again.stats, backend.stats)
+
+    def test_retry(self):
+        self.set_global('num_retries', 20)
+        self.set_global('retry_delay', 0)
+        backend = duplicity.backend.BackendWrapper(
+            self.get_backend('?error_rate=0.3&throttle_rate=0.3&retry_after=0&seed=1'))
+        for i in range(10):
+            backend.put(self.local, 'f%d' % i)
+        self.assertTrue(backend.backend.stats['requests'] > 10)
+        self.assertEqual(len(os.listdir('testfiles/output')), 10)
+
+    def test_consistency_delay(self):
+        backend = self.get_backend('?consistency_delay=0.2')
+        backend._put(self.local, 'a')
+        backend._put(self.local, 'b')
+        self.assertEqual(backend._list(), [])
+        time.sleep(0.3)
+        self.assertEqual(backend._list(), ['a', 'b'])
+        backend._delete('a')
+        self.assertEqual(backend._list(), ['a', 'b'])
+        time.sleep(0.3)
+        self.assertEqual(backend._list(), ['b'])
 
 
 # class RsyncBackendTest(BackendInstanceBase):
@@ -237,5 +424,295 @@ class FTPSBackendTest(BackendInstanceBase):
         self.assertEqual(self.backend.__class__.__name__, 'LFTPBackend')
 
 
+class WebDAVStandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Minimal keep-alive WebDAV server storing files in a local directory"""
+    protocol_version = "HTTP/1.1"
+    root = None
+    connections = 0
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        WebDAVStandIn.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _local(self):
+        return os.path.join(self.root, urllib.unquote(self.path).lstrip('/'))
+
+    def _reply(self, status, body=""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PROPFIND(self):
+        local = self._local()
+        if not os.path.isdir(local):
+            return self._reply(404)
+        entries = ["<D:response><D:href>%s</D:href></D:response>" % self.path]
+        for fn in sorted(os.listdir(local)):
+            entries.append("<D:response><D:href>%s%s</D:href></D:response>" %
+                           (self.path, urllib.quote(fn)))
+        self._reply(207, '<?xml version="1.0"?><D:multistatus xmlns:D="DAV:">%s'
+                    '</D:multistatus>' % "".join(entries))
+
+    def do_MKCOL(self):
+        os.makedirs(self._local())
+        self._reply(201)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        try:
+            with open(self._local(), "wb") as f:
+                f.write(data)
+        except IOError:
+            return self._reply(409)
+        self._reply(201)
+
+    def do_GET(self):
+        try:
+            with open(self._local(), "rb") as f:
+                self._reply(200, f.read())
+        except IOError:
+            self._reply(404)
+
+    def do_DELETE(self):
+        try:
+            os.unlink(self._local())
+        except OSError:
+            return self._reply(404)
+        self._reply(204)
+
+
+class WebDAVBackendTest(BackendInstanceBase):
+    def setUp(self):
+        super(WebDAVBackendTest, self).setUp()
+        os.makedirs('testfiles/webdav/output')
+        WebDAVStandIn.root = os.path.abspath('testfiles/webdav')
+        WebDAVStandIn.connections = 0
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), WebDAVStandIn)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.set_environ('FTP_PASSWORD', 'pass')
+        url = 'webdav://user@127.0.0.1:%d/output' % self.server.server_port
+        self.backend = duplicity.backend.get_backend_object(url)
+        self.assertEqual(self.backend.__class__.__name__, 'WebDAVBackend')
+
+    def tearDown(self):
+        super(WebDAVBackendTest, self).tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        self.backend._list()
+        for name in ['a', 'b', 'c']:
+            self.backend._put(self.local, name)
+        getfile = path.Path('testfiles/getfile')
+        self.backend._get('b', getfile)
+        self.backend._delete('c')
+        self.assertEqual(sorted(self.backend._list()), ['a', 'b'])
+        self.assertEqual(WebDAVStandIn.connections, 1)
+
+    def test_list_creates_directory(self):
+        url = 'webdav://user@127.0.0.1:%d/output/sub/dir' % self.server.server_port
+        backend = duplicity.backend.get_backend_object(url)
+        self.assertEqual(backend._list(), [])
+        self.assertTrue(os.path.isdir('testfiles/webdav/output/sub/dir'))
+        backend._close()
+
+    def test_list_many(self):
+        for i in range(2000):
+            open('testfiles/webdav/output/vol%d' % i, 'w').close()
+        files = self.backend._list()
+        self.assertTrue('vol1' in files)
+        self.assertTrue('vol1999' in files)
+
+
+class S3StandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Minimal path-style S3 server, including multipart uploads"""
+    protocol_version = "HTTP/1.1"
+    objects = {}
+    uploads = {}
+    connections = 0
+    fail_parts = set()
+    lock = threading.Lock()
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.lock:
+            S3StandIn.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse.urlparse(self.path)
+        parts = urllib.unquote(url.path).lstrip('/').split('/', 1)
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        return parts[0], parts[1] if len(parts) > 1 else '', query
+
+    def _reply(self, status, body="", headers={}):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, body):
+        self._reply(200, '<?xml version="1.0" encoding="UTF-8"?>' + body,
+                    {'Content-Type': 'application/xml'})
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_HEAD(self):
+        bucket, key, query = self._parse()
+        if not key:
+            return self._reply(200)
+        if key not in self.objects:
+            return self._reply(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.objects[key])))
+        self.send_header("ETag", '"%s"' % hashlib.md5(self.objects[key]).hexdigest())
+        self.end_headers()
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        if not key:
+            prefix = query.get('prefix', '')
+            contents = "".join("<Contents><Key>%s</Key><Size>%d</Size>"
+                               "<StorageClass>STANDARD</StorageClass></Contents>" % (k, len(v))
+                               for k, v in sorted(self.objects.items())
+                               if k.startswith(prefix))
+            return self._xml("<ListBucketResult><Name>%s</Name><IsTruncated>false</IsTruncated>"
+                             "%s</ListBucketResult>" % (bucket, contents))
+        if 'uploadId' in query:
+            parts = "".join("<Part><PartNumber>%d</PartNumber><ETag>\"%s\"</ETag><Size>%d</Size></Part>"
+                            % (n, hashlib.md5(d).hexdigest(), len(d))
+                            for n, d in sorted(self.uploads[query['uploadId']].items()))
+            return self._xml("<ListPartsResult><IsTruncated>false</IsTruncated>%s"
+                             "</ListPartsResult>" % parts)
+        if key not in self.objects:
+            return self._reply(404)
+        self._reply(200, self.objects[key])
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        data = self._body()
+        if 'uploadId' in query:
+            part = int(query['partNumber'])
+            with self.lock:
+                if part in self.fail_parts:
+                    self.fail_parts.discard(part)
+                    return self._reply(400)
+                self.uploads[query['uploadId']][part] = data
+        else:
+            self.objects[key] = data
+        self._reply(200, headers={"ETag": '"%s"' % hashlib.md5(data).hexdigest()})
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        self._body()
+        if 'uploads' in query:
+            with self.lock:
+                upload_id = str(len(self.uploads) + 1)
+                self.uploads[upload_id] = {}
+            return self._xml("<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>"
+                             "<UploadId>%s</UploadId></InitiateMultipartUploadResult>"
+                             % (bucket, key, upload_id))
+        parts = self.uploads.pop(query['uploadId'])
+        self.objects[key] = "".join(d for n, d in sorted(parts.items()))
+        self._xml("<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key>"
+                  "</CompleteMultipartUploadResult>" % (bucket, key))
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        if 'uploadId' in query:
+            self.uploads.pop(query['uploadId'], None)
+        else:
+            self.objects.pop(key, None)
+        self._reply(204)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class BotoMultiBackendTest(BackendInstanceBase):
+    def setUp(self):
+        super(BotoMultiBackendTest, self).setUp()
+        try:
+            from duplicity.backends import _boto_multi
+        except ImportError:
+            return  # boto is not installed
+        S3StandIn.objects = {}
+        S3StandIn.uploads = {}
+        S3StandIn.connections = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), S3StandIn)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.set_environ('AWS_ACCESS_KEY_ID', 'id')
+        self.set_environ('AWS_SECRET_ACCESS_KEY', 'secret')
+        self.set_global('s3_unencrypted_connection', True)
+        self.set_global('s3_multipart_max_procs', 2)
+        self.set_global('s3_multipart_minimum_chunk_size', 4096)
+        self.set_global('s3_multipart_chunk_size', 4096)
+        url = 's3://127.0.0.1:%d/bucket/prefix' % self.server.server_port
+        self.backend = _boto_multi.BotoBackend(duplicity.backend.ParsedUrl(url))
+
+    def tearDown(self):
+        super(BotoMultiBackendTest, self).tearDown()
+        if self.backend is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def test_multipart(self):
+        if self.backend is None:
+            return
+        big = path.Path('testfiles/big')
+        big.writefileobj(StringIO.StringIO(os.urandom(5 * 4096 + 100)))
+        connections = S3StandIn.connections
+        self.backend._put(big, 'a')
+        self.backend._put(big, 'b')
+        self.assertEqual(S3StandIn.objects['prefix/a'], big.get_data())
+        self.assertEqual(S3StandIn.objects['prefix/b'], big.get_data())
+        # parent plus one persistent connection per worker
+        self.assertTrue(S3StandIn.connections - connections <= 3, S3StandIn.connections)
+
+    def test_part_retry_keeps_pool(self):
+        if self.backend is None:
+            return
+        big = path.Path('testfiles/big')
+        big.writefileobj(StringIO.StringIO(os.urandom(3 * 4096)))
+        pool = self.backend._pool
+        S3StandIn.fail_parts = set([2])
+        self.backend._put(big, 'a')
+        self.assertEqual(S3StandIn.objects['prefix/a'], big.get_data())
+        self.assertTrue(self.backend._pool is pool)
+
+    def test_workers_close_volume(self):
+        if self.backend is None:
+            return
+        big = path.Path('testfiles/big')
+        big.writefileobj(StringIO.StringIO(os.urandom(5 * 4096)))
+        self.backend._put(big, 'a')
+        volume = os.path.realpath(big.name)
+        for worker in self.backend._pool._pool:
+            fd_dir = '/proc/%d/fd' % worker.pid
+            if not os.path.isdir(fd_dir):
+                return  # no /proc to look into
+            for fd in os.listdir(fd_dir):
+                try:
+                    target = os.readlink(os.path.join(fd_dir, fd))
+                except OSError:
+                    continue  # closed meanwhile
+                self.assertNotEqual(target, volume)
+
+
 if __name__ == "__main__":
     unittest.main()
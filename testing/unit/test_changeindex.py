@@ -0,0 +1,128 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import unittest
+
+from duplicity import changeindex
+from duplicity.path import Path
+from . import UnitTestCase
+
+
+class FakeSet:
+    """Backup set with a local manifest listing files_changed"""
+    def __init__(self, time, files_changed):
+        self.time = time
+        self.files_changed = files_changed
+        self.local_manifest_path = True
+
+    def get_time(self):
+        return self.time
+
+    def get_files_changed(self):
+        return self.files_changed
+
+
+class ChangeIndexTest(UnitTestCase):
+    """Test looking up changed files in a change index"""
+    def setUp(self):
+        super(ChangeIndexTest, self).setUp()
+        self.unpack_testfiles()
+        self.set_global('archive_dir', Path("testfiles/cache"))
+        self.index_path = changeindex.get_index_path(1000)
+
+    def get_sets(self):
+        full = FakeSet(1000, [("new", "dir/file %d" % i) for i in range(500)] +
+                       [("new", "dir"), ("new", "dir-x"), ("new", "a\\b\nc")])
+        inc1 = FakeSet(2000, [("changed", "dir/file 7"), ("deleted", "dir-x")])
+        inc2 = FakeSet(3000, [("deleted", "dir/file 7"), ("new", "dir/sub/y")])
+        return [full, inc1, inc2]
+
+    def test_encode_path(self):
+        for path in ["a", "a b", "a\\x20b", "\n\t\x00\x7f\xff"]:
+            encoded = changeindex.encode_path(path)
+            assert len(encoded.split()) == 1, encoded
+            assert changeindex.decode_path(encoded) == path
+
+    def test_get_index_names(self):
+        index_name = self.index_path.get_filename()
+        names = changeindex.get_index_names([index_name, index_name + ".part",
+                                             "duplicity-change-index.x", "other"])
+        assert names == {index_name: 1000, index_name + ".part": 1000}, names
+
+    def test_lookup(self):
+        run_lines = changeindex._run_lines
+        changeindex._run_lines = 64
+        self.addCleanup(setattr, changeindex, "_run_lines", run_lines)
+        sets = self.get_sets()
+        index = changeindex.ChangeIndex(self.index_path)
+        index.update(sets[:2])
+        assert index.times == [1000, 2000]
+        assert index.lookup("dir/file 7") == [(1000, "new", "dir/file 7"),
+                                              (2000, "changed", "dir/file 7")]
+        index.close()
+
+        # a backup adds the next set, unless the index is behind
+        changeindex.add_backup(1000, 1000, 4000, sets[2].files_changed)
+        changeindex.add_backup(1000, 2000, 3000, sets[2].files_changed)
+        index = changeindex.ChangeIndex(self.index_path)
+        assert index.times == [1000, 2000, 3000]
+        index.update(sets)
+        assert index.times == [1000, 2000, 3000]
+        assert index.lookup("dir/file 7") == [(1000, "new", "dir/file 7"),
+                                              (2000, "changed", "dir/file 7"),
+                                              (3000, "deleted", "dir/file 7")]
+        assert index.lookup("dir/file 499") == [(1000, "new", "dir/file 499")]
+        assert index.lookup("dir/file 5000") == []
+        assert index.lookup("a\\b\nc") == [(1000, "new", "a\\b\nc")]
+        assert index.lookup("dir-x") == [(1000, "new", "dir-x"),
+                                         (2000, "deleted", "dir-x")]
+
+        # directories list the files under them
+        changes = index.lookup("dir/")
+        assert len(changes) == 504, len(changes)
+        assert changes[0] == (1000, "new", "dir")
+        assert changes[-1] == (3000, "new", "dir/sub/y")
+        assert index.lookup("dir/sub") == [(3000, "new", "dir/sub/y")]
+        assert len(index.lookup("")) == 507
+        index.close()
+
+    def test_rebuild(self):
+        sets = self.get_sets()
+        index = changeindex.ChangeIndex(self.index_path)
+        index.update(sets)
+        index.close()
+
+        # a different chain starting at the same time
+        sets[1] = FakeSet(2500, [("new", "other")])
+        index = changeindex.ChangeIndex(self.index_path)
+        index.update(sets[:2])
+        assert index.times == [1000, 2500]
+        assert index.lookup("other") == [(2500, "new", "other")]
+        assert index.lookup("dir-x") == [(1000, "new", "dir-x")]
+        index.close()
+
+        # sets are indexed up to the first without a local manifest
+        sets[1].local_manifest_path = None
+        index = changeindex.ChangeIndex(self.index_path)
+        index.update(sets)
+        assert index.times == [1000]
+        index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
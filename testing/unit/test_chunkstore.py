@@ -0,0 +1,138 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import cStringIO
+import hashlib
+import os
+import unittest
+
+from duplicity import backend
+from duplicity import chunkstore
+from duplicity import diffdir
+from duplicity import patchdir
+from duplicity import selection
+from duplicity import tarfile
+from duplicity.path import Path
+from . import UnitTestCase
+
+
+def make_data(size, seed=""):
+    """Return size bytes of random looking data"""
+    blocks = [hashlib.sha1("%s%d" % (seed, i)).digest()
+              for i in range(size // 20 + 1)]
+    return "".join(blocks)[:size]
+
+
+class ChunkStoreTest(UnitTestCase):
+    """Test chunking and storing chunks"""
+    def setUp(self):
+        super(ChunkStoreTest, self).setUp()
+        self.unpack_testfiles()
+        os.mkdir("testfiles/output/backend")
+        self.backend = backend.get_backend("file://testfiles/output/backend")
+        self.set_global('backend', self.backend)
+        self.set_global('encryption', False)
+        self.set_global('compression', True)
+        self.set_global('volsize', 512 * 1024)
+
+    def get_store(self):
+        return chunkstore.ChunkStore(self.backend,
+                                     Path("testfiles/cache/chunk-index"))
+
+    def get_packs(self):
+        return sorted(chunkstore.get_pack_names(self.backend.list()).values())
+
+    def test_chunk_iter(self):
+        """Test chunk sizes and that an insertion only changes nearby chunks"""
+        data = make_data(2 * 1024 * 1024) + "text line\n" * 50000
+        chunks = list(chunkstore.chunk_iter(cStringIO.StringIO(data),
+                                            read_size=100000))
+        assert "".join(chunks) == data
+        assert len(chunks) > 10, len(chunks)
+        for chunk in chunks[:-1]:
+            assert (chunkstore._min_chunk_size <= len(chunk) <=
+                    chunkstore._max_chunk_size), len(chunk)
+
+        edited = data[:1000] + "inserted" + data[1000:]
+        edited_chunks = list(chunkstore.chunk_iter(cStringIO.StringIO(edited)))
+        assert "".join(edited_chunks) == edited
+        assert len(set(chunks) - set(edited_chunks)) == 1
+
+    def test_store(self):
+        """Test chunks are stored once and read back"""
+        data = make_data(1024 * 1024)
+        store = self.get_store()
+        refs = chunkstore.ChunkRefFile(cStringIO.StringIO(data), store).read()
+        assert len(refs) % chunkstore._ref_size == 0
+        assert store.new_bytes == len(data) and not store.stored_chunks
+        again = chunkstore.ChunkRefFile(cStringIO.StringIO(data), store).read()
+        assert again == refs
+        assert store.stored_bytes == len(data)
+        packs = store.take_referenced()
+        store.close()
+        assert len(packs) >= 2, packs
+        assert len(self.get_packs()) == len(packs)
+
+        reader = chunkstore.ChunkReader(self.backend)
+        fp = chunkstore.ChunkedFile(cStringIO.StringIO(refs), reader)
+        assert fp.read(1000) + fp.read() == data
+
+        # the index is kept, unless the packs it refers to are gone
+        store = self.get_store()
+        assert chunkstore.ChunkRefFile(cStringIO.StringIO(data), store).read() == refs
+        store.close()
+        assert len(self.get_packs()) == len(packs)
+        self.backend.delete(self.get_packs())
+        store = self.get_store()
+        assert chunkstore.ChunkRefFile(cStringIO.StringIO(data), store).read() != refs
+        store.close()
+        assert store.new_bytes == len(data)
+
+    def test_backup(self):
+        """Test backup and restore of chunked files"""
+        os.mkdir("testfiles/dedup")
+        data = make_data(300 * 1024)
+        for filename in ["a", "b", "small"]:
+            with open("testfiles/dedup/" + filename, "wb") as fp:
+                fp.write(data[:100] if filename == "small" else data)
+
+        store = self.get_store()
+        diff = Path("testfiles/output/diff.tar")
+        diffdir.write_block_iter(
+            diffdir.DirFull_WriteSig(selection.Select(Path("testfiles/dedup")).set_iter(),
+                                     Path("testfiles/output/sig.tar").open("wb"),
+                                     store), diff)
+        store.close()
+        assert store.new_bytes == len(data)
+        assert store.stored_bytes == len(data)
+
+        tf = tarfile.TarFile(diff.name, "r")
+        names = [ti.name for ti in tf]
+        tf.close()
+        assert "chunked/a" in names and "chunked/b" in names, names
+        assert "snapshot/small" in names, names
+
+        restore_path = Path("testfiles/output/restore")
+        patchdir.Write_ROPaths(restore_path, patchdir.tarfiles2rop_iter(
+            [tarfile.TarFile(diff.name, "r")]))
+        assert restore_path.compare_recursive(Path("testfiles/dedup"), 1)
+        assert restore_path.append("b").get_data() == data
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,6 +24,7 @@ import sys
 import random
 import unittest
 
+from duplicity import changeindex
 from duplicity import collections
 from duplicity import backend
 from duplicity import globals
@@ -221,6 +222,25 @@ class CollectionTest(UnitTestCase):
             errors.append("### Didn't receive extraneous filename " + filename)
         assert not errors, "\n" + "\n".join(errors)
 
+    def test_get_extraneous_change_indexes(self):
+        """Test listing change indexes of chains that no longer exist"""
+        chain_index = changeindex.get_index_path(
+            dup_time.genstrtotime("2002-08-17T16:17:01-07:00"))
+        old_index = changeindex.get_index_path(
+            dup_time.genstrtotime("1999-08-17T16:17:01-07:00"))
+        for index_path in [chain_index, old_index]:
+            index_path.touch()
+        old_part = old_index.name + ".part"
+        path.Path(old_part).touch()
+
+        cs = self.get_filelist2_cs()
+        local_received_list, remote_received_list = cs.get_extraneous(False)  # @UnusedVariable
+        assert local_received_list == [old_index.get_filename(),
+                                       os.path.basename(old_part)], local_received_list
+
+        cs.all_backup_chains[-1].delete()
+        assert not chain_index.exists()
+
     def test_get_olderthan(self):
         """Test getting list of files older than a certain time"""
         cs = self.get_filelist2_cs()
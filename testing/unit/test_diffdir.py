@@ -207,6 +207,54 @@ class DDTest(UnitTestCase):
             diffdir.write_block_iter(diffdir.SigTarBlockIter(get_sel(cur_dir)),
                                      cur_full_sigs)
 
+    def test_data_hash(self):
+        """Test signatures written while diffing record the data's sha1"""
+        sig = Path("testfiles/output/sig.tar")
+        diffdir.write_block_iter(
+            diffdir.DirFull_WriteSig(selection.Select(Path("testfiles/dir1")).set_iter(),
+                                     sig.open("wb")),
+            Path("testfiles/output/diff.tar"))
+        count = 0
+        for sig_path in diffdir.sigtar2path_iter(sig.open("rb")):
+            if not sig_path.isreg():
+                continue
+            path = Path("testfiles/dir1").new_index(sig_path.index)
+            first_block = path.open("rb").read(diffdir._fingerprint_size)
+            assert sig_path.fingerprint == diffdir.get_fingerprint(path.getsize(), first_block)
+            assert sig_path.data_hash == diffdir.get_data_hash(path.open("rb"))
+            count += 1
+        assert count > 0
+
+    def test_sig_blocks(self):
+        """Test signatures are written in blocks, not read whole"""
+        self.set_global('max_signature_memory', 4 * diffdir._sig_memory_per_block)
+        os.mkdir("testfiles/output/sigdir")
+        filename = "testfiles/output/sigdir/big"
+        with open(filename, "wb") as fp:
+            fp.write("".join(chr(i % 251) for i in range(200000)))
+
+        sigtar = diffdir.SigTarBlockIter(
+            selection.Select(Path("testfiles/output/sigdir")).set_iter())
+        sigtar.get_read_size = lambda: 1024
+        sizes = []
+        with open("testfiles/output/sigtar", "wb") as fp:
+            for block in sigtar:
+                sizes.append(len(block.data))
+                fp.write(block.data)
+            fp.write(sigtar.get_footer())
+        assert max(sizes) <= 1024 + tarfile.BLOCKSIZE, sizes
+        sig = diffdir.get_signature(open(filename, "rb"), 200000).read()
+        assert len(sizes) > len(sig) // 1024, sizes
+
+        tf = tarfile.TarFile("testfiles/output/sigtar", "r")
+        names = []
+        for tarinfo in tf:
+            names.append(tarinfo.name)
+            if tarinfo.name == "signature/big":
+                assert tf.extractfile(tarinfo).read() == sig
+        tf.close()
+        assert names == ["snapshot", "signature/big"], names
+
     def test_combine_path_iters(self):
         """Test diffdir.combine_path_iters"""
         class Dummy:
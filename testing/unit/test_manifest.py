@@ -19,6 +19,7 @@
 # along with duplicity; if not, write to the Free Software Foundation,
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
+import cStringIO
 import types
 import unittest
 
@@ -56,6 +57,16 @@ class VolumeInfoTest(UnitTestCase):
         vi2.from_string(s)
         assert vi == vi2
 
+    def test_chunk_packs(self):
+        """Test VolumeInfo with chunk packs"""
+        vi = manifest.VolumeInfo()
+        vi.set_info(1, ("a",), None, ("b",), 3)
+        vi.set_chunk_packs(["0123456789abcdef0123", "fedcba9876543210fedc"])
+        vi2 = manifest.VolumeInfo()
+        vi2.from_string(vi.to_string())
+        assert vi == vi2
+        assert vi2.chunk_packs == vi.chunk_packs
+
     def test_contains(self):
         """Test to see if contains() works"""
         vi = manifest.VolumeInfo()
@@ -99,6 +110,54 @@ class ManifestTest(UnitTestCase):
         m2 = manifest.Manifest().from_string(s)
         assert m == m2
 
+    def test_files_moved(self):
+        """Test list of moved files survives to_string and from_string"""
+        m = manifest.Manifest()
+        vi = manifest.VolumeInfo()
+        vi.set_info(1, (), None, (), None)
+        m.add_volume_info(vi)
+        self.set_global('local_path', path.Path("Foobar"))
+        m.set_dirinfo()
+        moved = [("new/dir/file", "old/dir/file"), ("with space", "x\ny")]
+        m.set_files_moved_info(moved)
+        m.set_files_changed_info([("new/dir/file", "new"), ("other", "new")])
+
+        m2 = manifest.Manifest().from_string(m.to_string())
+        assert m2.get_files_moved() == moved, m2.get_files_moved()
+        assert len(m2.get_files_changed()) == 2
+
+    def test_files_changed(self):
+        """Test spooled list of changed files is written and read back"""
+        files_changed = manifest.FileList()
+        for i in range(1000):
+            files_changed.append("dir/file %d" % i, "new")
+        files_changed.append("changed", "changed")
+        expected = [("new", "dir/file %d" % i) for i in range(1000)]
+        expected.append(("changed", "changed"))
+        assert list(files_changed) == expected
+
+        # written to the end of the manifest file, as during a backup
+        fh = cStringIO.StringIO()
+        m = manifest.Manifest(fh)
+        self.set_global('local_path', path.Path("Foobar"))
+        m.set_dirinfo()
+        vi = manifest.VolumeInfo()
+        vi.set_info(1, ("a",), None, ("b",), None)
+        m.add_volume_info(vi)
+        m.set_files_changed_info(files_changed)
+        s = fh.getvalue()
+
+        m2 = manifest.Manifest().from_string(s)
+        assert m2 == m
+        assert len(m2.get_files_changed()) == 1001
+        assert list(m2.get_files_changed()) == expected
+        assert list(manifest.read_files_changed(cStringIO.StringIO(s))) == expected
+        assert manifest.Manifest().from_string(m2.to_string()) == m
+        assert list(manifest.read_files_changed(cStringIO.StringIO(""))) == []
+
+        truncated = manifest.read_files_changed(cStringIO.StringIO(s[:-20]))
+        self.assertRaises(manifest.ManifestError, list, truncated)
+
 
 if __name__ == "__main__":
     unittest.main()
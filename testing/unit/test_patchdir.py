@@ -23,6 +23,8 @@ from future_builtins import map
 
 import sys
 import cStringIO
+import mock
+import resource
 import unittest
 
 from duplicity import diffdir
@@ -58,6 +60,368 @@ class PatchingTest(UnitTestCase):
                              'testfiles/dir2',
                              'testfiles/dir3'])
 
+    def make_hardlink_dirs(self):
+        """Make directories with hard links changing between them"""
+        def write(filename, data):
+            with open(filename, "wb") as fp:
+                fp.write(data)
+
+        dirs = ["testfiles/hardlink%d" % i for i in range(1, 4)]
+        for dirname in dirs:
+            os.mkdir(dirname)
+
+        # a, b and c are the same file, d is on its own
+        write("testfiles/hardlink1/a", "hello")
+        os.link("testfiles/hardlink1/a", "testfiles/hardlink1/b")
+        os.link("testfiles/hardlink1/a", "testfiles/hardlink1/c")
+        write("testfiles/hardlink1/d", "world")
+
+        # data of a changes, c becomes a file of its own and d gets
+        # a second name
+        write("testfiles/hardlink2/a", "hello again")
+        os.link("testfiles/hardlink2/a", "testfiles/hardlink2/b")
+        write("testfiles/hardlink2/c", "hello")
+        write("testfiles/hardlink2/d", "world")
+        os.link("testfiles/hardlink2/d", "testfiles/hardlink2/e")
+
+        # a is gone, b and c are the same file again
+        write("testfiles/hardlink3/b", "hello again")
+        os.link("testfiles/hardlink3/b", "testfiles/hardlink3/c")
+        write("testfiles/hardlink3/d", "world")
+
+        for i, dirname in enumerate(dirs):
+            mtime = 10000 * (i + 1)
+            for filename in os.listdir(dirname):
+                os.utime(os.path.join(dirname, filename), (mtime, mtime))
+            os.utime(dirname, (mtime, mtime))
+        return dirs
+
+    def test_hardlinks(self):
+        """Test cycle on directories with hard links"""
+        self.total_sequence(self.make_hardlink_dirs())
+        seq_path = Path("testfiles/output/sequence")
+        assert seq_path.append("b").stat.st_ino == \
+            seq_path.append("c").stat.st_ino
+        assert seq_path.append("b").stat.st_nlink == 2
+
+    def test_hardlink_restore(self):
+        """Test hard links are stored once and linked on restore"""
+        self.make_hardlink_dirs()
+        diff = Path("testfiles/output/diff.tar")
+        diffdir.write_block_iter(
+            diffdir.DirFull(self.get_sel(Path("testfiles/hardlink1"))), diff)
+
+        tf = tarfile.TarFile("testfiles/output/diff.tar", "r")
+        links = [(ti.name, ti.linkname) for ti in tf if ti.islnk()]
+        tf.close()
+        assert links == [("snapshot/b", "a"), ("snapshot/c", "a")], links
+
+        restore_path = Path("testfiles/output/restore")
+        tf = tarfile.TarFile("testfiles/output/diff.tar", "r")
+        patchdir.Write_ROPaths(restore_path, patchdir.tarfiles2rop_iter([tf]))
+        assert restore_path.compare_recursive(Path("testfiles/hardlink1"), 1)
+        assert restore_path.append("a").stat.st_nlink == 3
+
+    def test_restore_over(self):
+        """Test restoring over an existing tree replaces what differs"""
+        self.set_global('force', True)
+        diffdir.write_block_iter(
+            diffdir.DirFull(self.get_sel(Path("testfiles/dir1"))),
+            Path("testfiles/output/diff.tar"))
+
+        def restore():
+            tf = tarfile.TarFile("testfiles/output/diff.tar", "r")
+            patchdir.Write_ROPaths(restore_path, patchdir.tarfiles2rop_iter([tf]))
+
+        restore_path = Path("testfiles/output/restore")
+        restore()
+        with open("testfiles/output/restore/regular_file", "wb") as fp:
+            fp.write("changed")
+        os.unlink("testfiles/output/restore/symbolic_link")
+        os.mkdir("testfiles/output/restore/symbolic_link")
+        Path("testfiles/output/restore/directory_to_file").deltree()
+        with open("testfiles/output/restore/directory_to_file", "wb") as fp:
+            fp.write("in the way")
+        os.unlink("testfiles/output/restore/fifo")
+        restore()
+        restore_path.setdata()
+        assert restore_path.compare_recursive(Path("testfiles/dir1"), 1)
+
+    def test_restore_writers(self):
+        """Test restoring with a pool of writer threads"""
+        self.set_global('restore_writers', 4)
+        limits = patchdir.WriterPool.max_file_size, patchdir.WriterPool.max_buffered
+        patchdir.WriterPool.max_file_size = 64 * 1024
+        patchdir.WriterPool.max_buffered = 256 * 1024
+        try:
+            for dirname in ["testfiles/dir1"] + self.make_hardlink_dirs():
+                diffdir.write_block_iter(
+                    diffdir.DirFull(self.get_sel(Path(dirname))),
+                    Path("testfiles/output/diff.tar"))
+                restore_path = Path("testfiles/output/restore")
+                tf = tarfile.TarFile("testfiles/output/diff.tar", "r")
+                patchdir.Write_ROPaths(restore_path, patchdir.tarfiles2rop_iter([tf]))
+                restore_path.setdata()
+                assert restore_path.compare_recursive(Path(dirname), 1)
+                restore_path.deltree()
+        finally:
+            patchdir.WriterPool.max_file_size, patchdir.WriterPool.max_buffered = limits
+
+    def make_extent_dirs(self):
+        """Make directories with files longer than the extents"""
+        self.set_global('max_signature_memory', 4 * diffdir._sig_memory_per_block)
+        assert diffdir.get_extent_size(diffdir.get_block_size(9000)) == 2048
+        sizes = [{"a": 5000, "b": 9000, "c": 4096, "d": 100},
+                 {"a": 9000, "b": 3000, "c": 4096, "d": 6000},
+                 {"a": 2048, "b": 3001, "c": 0, "d": 6000}]
+        dirs = ["testfiles/extents%d" % i for i in range(1, 4)]
+        for i, dirname in enumerate(dirs):
+            os.mkdir(dirname)
+            for filename, size in sizes[i].items():
+                path = os.path.join(dirname, filename)
+                with open(path, "wb") as fp:
+                    fp.write(("%s%d " % (filename, i) * size)[:size])
+                os.utime(path, (10000 * (i + 1), 10000 * (i + 1)))
+            os.utime(dirname, (10000 * (i + 1), 10000 * (i + 1)))
+        return dirs
+
+    def test_extents(self):
+        """Test cycle on files signed and diffed in extents"""
+        self.total_sequence(self.make_extent_dirs())
+
+        sig = diffdir.get_signature(open("testfiles/extents2/a", "rb"), 9000)
+        assert sig.read(4) == librsync.extent_sig_magic
+        sig = diffdir.get_signature(open("testfiles/extents1/d", "rb"), 100)
+        assert sig.read(4) != librsync.extent_sig_magic
+
+    def test_extent_workers(self):
+        """Test diffing and signing extents in threads"""
+        self.set_global('extent_workers', 3)
+        dirs = self.make_extent_dirs()
+        self.total_sequence(dirs)
+
+        old_sig = Path("testfiles/output/sig.tar")
+        diffdir.write_block_iter(diffdir.DirSig(self.get_sel(Path(dirs[0]))), old_sig)
+        new_sig = Path("testfiles/output/newsig.tar")
+        diffdir.write_block_iter(
+            diffdir.DirDelta_WriteSig(self.get_sel(Path(dirs[1])),
+                                      [old_sig.open("rb")], new_sig.open("wb")),
+            Path("testfiles/output/diff.tar"))
+        tf = tarfile.TarFile(new_sig.name, "r")
+        for ti in tf:
+            if ti.name.startswith("signature/"):
+                filename = os.path.join(dirs[1], ti.name[len("signature/"):])
+                sig = diffdir.get_signature(open(filename, "rb"),
+                                            os.path.getsize(filename))
+                assert tf.extractfile(ti).read() == sig.read(), ti.name
+        tf.close()
+
+    def test_moved(self):
+        """Test files of a renamed directory are stored as moved"""
+        def write(filename, data):
+            with open(filename, "wb") as fp:
+                fp.write(data)
+
+        for dirname in ["testfiles/move1/a", "testfiles/move2/b"]:
+            os.makedirs(dirname)
+        big = "".join(chr(i % 251) for i in range(200000))
+        write("testfiles/move1/a/big", big)
+        write("testfiles/move1/a/small", "small")
+        write("testfiles/move2/b/big", big)
+        write("testfiles/move2/b/small", "small")
+        write("testfiles/move2/c", "new")
+        for dirname in ["testfiles/move1", "testfiles/move2"]:
+            for path in selection.Select(Path(dirname)).set_iter():
+                os.utime(path.name, (10000, 10000))
+
+        sig1 = Path("testfiles/output/sig1.tar")
+        diff1 = Path("testfiles/output/diff1.tar")
+        diffdir.write_block_iter(
+            diffdir.DirFull_WriteSig(self.get_sel(Path("testfiles/move1")),
+                                     sig1.open("wb")), diff1)
+        diff2 = Path("testfiles/output/diff2.tar")
+        diffdir.write_block_iter(
+            diffdir.DirDelta_WriteSig(self.get_sel(Path("testfiles/move2")),
+                                      [sig1.open("rb")],
+                                      Path("testfiles/output/sig2.tar").open("wb")),
+            diff2)
+        moved = diffdir.stats.get_moved_files()
+        assert sorted(moved) == [("b/big", "a/big"), ("b/small", "a/small")], moved
+
+        tf = tarfile.TarFile(diff2.name, "r")
+        names = [(ti.name, ti.linkname) for ti in tf]
+        tf.close()
+        assert ("moved/b/small", "a/small") in names, names
+        assert ("multivol_moved/b/big/1", "a/big") in names, names
+
+        move_sources = [set(), set([("a", "big"), ("a", "small")])]
+        restore_path = Path("testfiles/output/restore")
+        patchdir.Write_ROPaths(restore_path, patchdir.tarfiles2rop_iter(
+            [tarfile.TarFile(diff1.name, "r"), tarfile.TarFile(diff2.name, "r")],
+            (), move_sources))
+        assert restore_path.compare_recursive(Path("testfiles/move2"), 1)
+        assert restore_path.append("b").append("big").get_data() == big
+
+        # restoring just the renamed directory needs its old name too
+        restore_path = Path("testfiles/output/restore_b")
+        patchdir.Write_ROPaths(restore_path, patchdir.tarfiles2rop_iter(
+            [tarfile.TarFile(diff1.name, "r"), tarfile.TarFile(diff2.name, "r")],
+            ("b",), move_sources))
+        assert restore_path.compare_recursive(Path("testfiles/move2/b"), 1)
+        assert restore_path.append("big").get_data() == big
+
+    def test_moved_to_earlier_path(self):
+        """Test files moved to paths sorting before their old ones"""
+        def write(filename, data):
+            with open(filename, "wb") as fp:
+                fp.write(data)
+
+        for dirname in ["testfiles/move1/z", "testfiles/move1/y",
+                        "testfiles/move2/b", "testfiles/move2/y"]:
+            os.makedirs(dirname)
+        big = "".join(chr(i % 251) for i in range(200000))
+        write("testfiles/move1/y/kept", "kept")
+        write("testfiles/move1/z/big", big)
+        write("testfiles/move1/z/small", "small")
+        write("testfiles/move2/b/big", big[:-1] + "x")
+        write("testfiles/move2/b/kept", "kept")
+        write("testfiles/move2/b/small", "small")
+        write("testfiles/move2/y/kept", "kept")
+        for dirname in ["testfiles/move1", "testfiles/move2"]:
+            for path in selection.Select(Path(dirname)).set_iter():
+                os.utime(path.name, (10000, 10000))
+
+        sig1 = Path("testfiles/output/sig1.tar")
+        diff1 = Path("testfiles/output/diff1.tar")
+        diffdir.write_block_iter(
+            diffdir.DirFull_WriteSig(self.get_sel(Path("testfiles/move1")),
+                                     sig1.open("wb")), diff1)
+
+        # without reading the signatures again, only earlier paths match
+        diffdir.write_block_iter(
+            diffdir.DirDelta_WriteSig(self.get_sel(Path("testfiles/move2")),
+                                      [sig1.open("rb")],
+                                      Path("testfiles/output/sig2.tar").open("wb")),
+            Path("testfiles/output/diff2.tar"))
+        assert diffdir.stats.get_moved_files() == [], diffdir.stats.get_moved_files()
+
+        diff2 = Path("testfiles/output/diff2.tar")
+        diffdir.write_block_iter(
+            diffdir.DirDelta_WriteSig(self.get_sel(Path("testfiles/move2")),
+                                      [sig1.open("rb")],
+                                      Path("testfiles/output/sig2.tar").open("wb"),
+                                      sig_infp_func=lambda: [sig1.open("rb")]),
+            diff2)
+        # y/kept is still there, so b/kept is not moved from it
+        moved = diffdir.stats.get_moved_files()
+        assert sorted(moved) == [("b/big", "z/big"), ("b/small", "z/small")], moved
+
+        sources = set([("z", "big"), ("z", "small")])
+        basis_files = patchdir.BasisSpool()
+        patchdir.spool_basis_files(
+            (ropath for ropath in patchdir.tarfiles2rop_iter(
+                [tarfile.TarFile(diff1.name, "r")]) if ropath.index in sources),
+            1, basis_files)
+        assert sorted(basis_files) == [(1, ("z", "big")), (1, ("z", "small"))]
+        restore_path = Path("testfiles/output/restore")
+        patchdir.Write_ROPaths(restore_path, patchdir.tarfiles2rop_iter(
+            [tarfile.TarFile(diff1.name, "r"), tarfile.TarFile(diff2.name, "r")],
+            (), [set(), set()], basis_files))
+        assert restore_path.compare_recursive(Path("testfiles/move2"), 1)
+        assert not basis_files
+
+    def test_moved_many_files(self):
+        """Test restoring more moved files than can be open at once"""
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limit = len(os.listdir("/proc/self/fd")) + 32
+        count = limit + 10
+        for dirname in ["testfiles/move1/a", "testfiles/move1/z",
+                        "testfiles/move2/b", "testfiles/move2/c"]:
+            os.makedirs(dirname)
+        for i in range(count):
+            data = "file %d " % i * 200
+            # a/ moves to c/ after it, z/ to b/ before it
+            for filename in ["testfiles/move1/a/%d" % i, "testfiles/move2/c/%d" % i]:
+                with open(filename, "wb") as fp:
+                    fp.write("a" + data)
+            for filename in ["testfiles/move1/z/%d" % i, "testfiles/move2/b/%d" % i]:
+                with open(filename, "wb") as fp:
+                    fp.write("z" + data)
+        for dirname in ["testfiles/move1", "testfiles/move2"]:
+            for path in selection.Select(Path(dirname)).set_iter():
+                os.utime(path.name, (10000, 10000))
+
+        sig1 = Path("testfiles/output/sig1.tar")
+        diff1 = Path("testfiles/output/diff1.tar")
+        diffdir.write_block_iter(
+            diffdir.DirFull_WriteSig(self.get_sel(Path("testfiles/move1")),
+                                     sig1.open("wb")), diff1)
+        diff2 = Path("testfiles/output/diff2.tar")
+        diffdir.write_block_iter(
+            diffdir.DirDelta_WriteSig(self.get_sel(Path("testfiles/move2")),
+                                      [sig1.open("rb")],
+                                      Path("testfiles/output/sig2.tar").open("wb"),
+                                      sig_infp_func=lambda: [sig1.open("rb")]),
+            diff2)
+        moved = diffdir.stats.get_moved_files()
+        assert len(moved) == 2 * count, len(moved)
+
+        move_sources = [set(), set(("a", str(i)) for i in range(count))]
+        later_sources = set(("z", str(i)) for i in range(count))
+        restore_path = Path("testfiles/output/restore")
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        try:
+            basis_files = patchdir.BasisSpool()
+            patchdir.spool_basis_files(
+                (ropath for ropath in patchdir.tarfiles2rop_iter(
+                    [tarfile.TarFile(diff1.name, "r")])
+                 if ropath.index in later_sources),
+                1, basis_files)
+            assert len(basis_files) == count, len(basis_files)
+            patchdir.Write_ROPaths(restore_path, patchdir.tarfiles2rop_iter(
+                [tarfile.TarFile(diff1.name, "r"), tarfile.TarFile(diff2.name, "r")],
+                (), move_sources, basis_files))
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        assert restore_path.compare_recursive(Path("testfiles/move2"), 1)
+
+    def test_restrict_set(self):
+        """Test restoring only some paths from some of the volumes"""
+        for dirname in ["testfiles/set1", "testfiles/set1_x", "testfiles/set2"]:
+            os.makedirs(dirname)
+        for dirname, data, mtime in [("testfiles/set1", "old", 10000),
+                                     ("testfiles/set1_x", "old", 10000),
+                                     ("testfiles/set2", "new", 20000)]:
+            for filename in ["x", "y"]:
+                if filename == "x" or dirname != "testfiles/set1_x":
+                    with open(os.path.join(dirname, filename), "wb") as fp:
+                        fp.write(data + filename * 1000)
+            for path in selection.Select(Path(dirname)).set_iter():
+                os.utime(path.name, (mtime, mtime))
+
+        sig1 = Path("testfiles/output/sig1.tar")
+        diffdir.write_block_iter(
+            diffdir.DirFull_WriteSig(self.get_sel(Path("testfiles/set1")),
+                                     sig1.open("wb")),
+            Path("testfiles/output/diff1.tar"))
+        # the full volume holding x only, as fetched for restoring x
+        diff1_x = Path("testfiles/output/diff1_x.tar")
+        diffdir.write_block_iter(
+            diffdir.DirFull(self.get_sel(Path("testfiles/set1_x"))), diff1_x)
+        # the inc volume holds changes of both x and y
+        diff2 = Path("testfiles/output/diff2.tar")
+        diffdir.write_block_iter(
+            diffdir.DirDelta(self.get_sel(Path("testfiles/set2")), sig1.open("rb")),
+            diff2)
+
+        with mock.patch("duplicity.log.Warn") as warn:
+            ropaths = list(patchdir.tarfiles2rop_iter(
+                [tarfile.TarFile(diff1_x.name, "r"), tarfile.TarFile(diff2.name, "r")],
+                restrict_set=set([(), ("x",)])))
+        assert not warn.called, warn.call_args_list
+        assert [ropath.index for ropath in ropaths] == [(), ("x",)], ropaths
+        assert ropaths[1].get_data() == "new" + "x" * 1000
+
     def get_sel(self, path):
         """Get selection iter over the given directory"""
         return selection.Select(path).set_iter()
@@ -19,6 +19,7 @@
 # along with duplicity; if not, write to the Free Software Foundation,
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
+import cStringIO
 import sys
 import unittest
 
@@ -89,6 +90,103 @@ class PathTest(UnitTestCase):
         assert not file2.compare_verbose(reg_file)
         assert file2.compare_verbose(file2)
 
+    def make_sparse(self, filename):
+        """Write a file with data between holes, return its contents"""
+        fp = open(filename, "wb")
+        fp.write("a" * 1000)
+        fp.seek(1024 * 1024)
+        fp.write("b" * 70000)
+        fp.truncate(3 * 1024 * 1024)
+        fp.close()
+        return ("a" * 1000 + "\0" * (1024 * 1024 - 1000) + "b" * 70000 +
+                "\0" * (2 * 1024 * 1024 - 70000))
+
+    def test_open_sparse(self):
+        """Test reading a sparse file without its holes"""
+        data = self.make_sparse("testfiles/output/sparse")
+        p = Path("testfiles/output/sparse")
+        for blocksize in [-1, 1000, 4096, 64 * 1024, 4 * 1024 * 1024]:
+            fp = p.open_sparse()
+            bufs = []
+            while 1:
+                buf = fp.read(blocksize)
+                if not buf:
+                    break
+                bufs.append(buf)
+                if blocksize == -1:
+                    blocksize = 1
+            assert not fp.close()
+            assert "".join(bufs) == data, blocksize
+
+    def test_writefileobj_sparse(self):
+        """Test blocks of zeros are written as holes"""
+        data = self.make_sparse("testfiles/output/sparse")
+        p = Path("testfiles/output/sparse")
+        copy = Path("testfiles/output/copy")
+        copy.writefileobj(p.open("rb"))
+        assert copy.getsize() == len(data)
+        assert copy.open("rb").read() == data
+        if p.stat.st_blocks * 512 < p.getsize():
+            # filesystem supports holes
+            assert copy.stat.st_blocks * 512 < copy.getsize()
+
+    def test_copy_attribs(self):
+        """Test attributes are copied and the stat cache kept up to date"""
+        os.mkdir("testfiles/output/dir")
+        with open("testfiles/output/file", "wb") as fp:
+            fp.write("data")
+        for name, mode, mtime in [("dir", 0o750, 1234567890.5),
+                                  ("file", 0o640, -1000)]:
+            p = Path("testfiles/output/" + name)
+            os.chmod(p.name, mode)
+            os.utime(p.name, (mtime, mtime))
+            p.setdata()
+            copy = Path("testfiles/output/copy_" + name)
+            p.copy(copy)
+            for q in [copy, Path(copy.name)]:
+                assert q.mode == mode, (name, q.mode)
+                assert q.stat.st_mtime == mtime, (name, q.stat.st_mtime)
+            assert copy == p
+
+    def test_hash_reader_pool(self):
+        """Test comparing file objects with files hashed in threads"""
+        class ReadFile:
+            def __init__(self, data):
+                self.fp = cStringIO.StringIO(data)
+                self.closed = False
+
+            def read(self, length=-1):
+                return self.fp.read(length)
+
+            def close(self):
+                self.read_count = self.fp.tell()
+                self.closed = True
+
+        data = "".join(chr(i % 251) for i in range(10000))
+        with open("testfiles/output/file", "wb") as fp:
+            fp.write(data)
+        p = Path("testfiles/output/file")
+        pool = HashReaderPool(3)
+        pool.blocksize = 1000
+        try:
+            for other, equal, read_count in [(data, True, len(data)),
+                                             (data[:4000] + "x" + data[4001:], False, 5000),
+                                             (data[:9999], False, 9999),
+                                             (data + "x", False, len(data) + 1),
+                                             ("", False, 0)]:
+                fileobj = ReadFile(other)
+                job = pool.submit(p)
+                assert pool.compare(fileobj, job) == equal
+                assert job.cancelled and fileobj.closed
+                assert fileobj.read_count == read_count, fileobj.read_count
+            missing = pool.submit(Path("testfiles/output/missing"))
+            self.assertRaises(EnvironmentError, pool.compare,
+                              ReadFile(data), missing)
+            pool.submit(p)
+        finally:
+            pool.close()
+        for thread in pool.threads:
+            assert not thread.is_alive()
 
 if __name__ == "__main__":
     unittest.main()
@@ -84,6 +84,21 @@ RawDeltaSize 11 (11 bytes)
 TotalDestinationSizeChange 12 (12 bytes)
 """, "'%s'" % stats_string
 
+    def test_retry_stats_string(self):
+        """Test retries showing up in the stats string"""
+        s = StatsObj()
+        s.Retries = 3
+        s.RetryTime = 61.5
+        stats_string = s.get_stats_string()
+        assert stats_string == """\
+Retries 3
+RetryTime 61.50 (1 minute 1.50 seconds)
+""", "'%s'" % stats_string
+
+        s2 = StatsObj()
+        s2.set_stats_from_string(stats_string)
+        assert s2.Retries == 3 and s2.RetryTime == 61.5
+
     def test_line_string(self):
         """Test conversion to a single line"""
         s = StatsObj()
@@ -0,0 +1,123 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import json
+import StringIO
+import threading
+import time
+import unittest
+
+from duplicity import backend
+from duplicity import path
+from duplicity import timing
+from duplicity.errors import BackendException
+from . import UnitTestCase
+
+
+class TimingTest(UnitTestCase):
+    """Test timing the stages of a run"""
+    def tearDown(self):
+        timing.stop()
+        super(TimingTest, self).tearDown()
+
+    def test_disabled(self):
+        assert timing.begin("read") is None
+        timing.end(None, 10)
+        it = iter([1, 2])
+        assert timing.timed_iter("select", it) is it
+
+    def test_stages(self):
+        timing.start(True)
+        outer = timing.begin("tarblock")
+        for i in range(3):
+            step = timing.begin("read")
+            time.sleep(0.01)
+            timing.end(step, 100)
+        timing.end(outer, 1000)
+        assert list(timing.timed_iter("select", iter("ab"))) == ["a", "b"]
+
+        def worker():
+            timing.end(timing.begin("backend.put"), 5)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+        stages = timing.get_summary()["stages"]
+        assert sorted(stages) == ["backend.put", "read", "select", "tarblock"]
+        assert stages["read"]["calls"] == 3
+        assert stages["read"]["bytes"] == 300
+        assert stages["read"]["wall"] >= 0.03
+        assert stages["tarblock"]["wall"] >= stages["read"]["wall"]
+        assert stages["tarblock"]["self_wall"] < 0.01
+        assert stages["select"]["calls"] == 3
+        assert stages["backend.put"]["bytes"] == 5
+
+        trace = json.loads(json.dumps(timing.get_trace()))
+        events = trace["traceEvents"]
+        assert len(events) == 8
+        assert events[3]["name"] == "tarblock"
+        assert events[3]["ph"] == "X"
+        assert events[3]["args"]["bytes"] == 1000
+        assert events[3]["ts"] <= events[0]["ts"]
+        assert events[3]["dur"] >= 30000
+        assert events[-1]["tid"] != events[0]["tid"]
+
+    def test_failed_transfers(self):
+        class FlakyBackend:
+            def __init__(self):
+                self.attempts = 0
+
+            def _put(self, source_path, remote_filename):
+                self.attempts += 1
+                if self.attempts == 1:
+                    raise BackendException("failed")
+                time.sleep(0.05)
+
+        self.unpack_testfiles()
+        self.set_global('retry_delay', 0)
+        source = path.Path("testfiles/source")
+        source.writefileobj(StringIO.StringIO("x" * 100))
+        timing.start()
+        outer = timing.begin("tarblock")
+        backend.BackendWrapper(FlakyBackend()).put(source, "a")
+        timing.end(outer)
+
+        stages = timing.get_summary()["stages"]
+        assert stages["backend.put"]["calls"] == 2
+        assert stages["backend.put"]["bytes"] == 100
+        # the failed step is not left on the stack under the outer one
+        assert stages["tarblock"]["self_wall"] < 0.01
+        assert stages["tarblock"]["wall"] >= stages["backend.put"]["wall"]
+
+    def test_max_events(self):
+        timing.start(True)
+        max_events = timing.max_events
+        timing.max_events = 2
+        try:
+            for i in range(5):
+                timing.end(timing.begin("read"), 1)
+        finally:
+            timing.max_events = max_events
+        trace = timing.get_trace()
+        assert len(trace["traceEvents"]) == 2
+        assert trace["otherData"]["dropped_events"] == 3
+        assert timing.get_summary()["stages"]["read"]["calls"] == 5
+
+
+if __name__ == "__main__":
+    unittest.main()